@@ -0,0 +1,385 @@
+# Description: Batched move generation for the XiangQi game with NumPy. N positions are held as an int8 array of
+# shape (N, 10, 9) with the signed piece codes of CompactBoard, and the pseudo legal and legal moves of all of them
+# are computed at once as boolean masks over a fixed vocabulary of every (from, to) move any piece can make. Chariots,
+# cannons and the flying general read the rank and file rays from their square, the other pieces the move tables of
+# the General to Pawn classes, and a move is legal unless the rays or reversed tables from the mover's general then
+# find an attacker. --check compares the masks move for move with XiangqiGame. Needs NumPy.
+# Run with: python XiangqiBatch.py --positions 20000 --check 500
+
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from XiangqiGame import XiangqiGame, ENGINE_OBJECTS, ENGINE_BITBOARD, FACTION_RED, FACTION_BLACK, STATUS_UNFINISHED, \
+    PIECE_GENERAL, PIECE_GUARD, PIECE_ELEPHANT, PIECE_HORSE, PIECE_CHARIOT, PIECE_CANNON, PIECE_PAWN, \
+    PIECE_OFF_BOARD, MAILBOX_PADDING, MAILBOX_WIDTH, MAILBOX_HEIGHT, GENERAL_MOVES, GUARD_MOVES, ELEPHANT_MOVES, \
+    HORSE_MOVES, PAWN_MOVES, GENERAL_ATTACKS, GUARD_ATTACKS, ELEPHANT_ATTACKS, HORSE_ATTACKS, PAWN_ATTACKS, \
+    coord_to_string
+
+SIDE_RED = 1
+SIDE_BLACK = -1
+# an extra square appended to every board, always empty, pads the rays and tables below
+EMPTY_SQUARE = 90
+# rays run up the file, down the file, right along the rank and left along the rank
+RAY_STEPS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+FILE_RAYS = [0, 1]
+# positions handled per block, which bounds the size of the intermediate arrays
+BLOCK_SIZE = 4096
+STEP_TABLES = ((PIECE_GENERAL, GENERAL_MOVES, GENERAL_ATTACKS), (PIECE_GUARD, GUARD_MOVES, GUARD_ATTACKS),
+               (PIECE_ELEPHANT, ELEPHANT_MOVES, ELEPHANT_ATTACKS), (PIECE_HORSE, HORSE_MOVES, HORSE_ATTACKS),
+               (PIECE_PAWN, PAWN_MOVES, PAWN_ATTACKS))
+
+
+def build_vocabulary():
+    """builds the move vocabulary, the sorted (from square, to square) pairs of every move a piece of either side
+    can make on an empty board: every rank and file move, and the guard, elephant and horse moves"""
+    moves = set()
+    for square in range(90):
+        for to_square in range(90):
+            if to_square != square and (to_square // 9 == square // 9 or to_square % 9 == square % 9):
+                moves.add((square, to_square))
+        for faction in (FACTION_RED, FACTION_BLACK):
+            for move_table in (GUARD_MOVES, ELEPHANT_MOVES, HORSE_MOVES):
+                for to_row, to_column, block_row, block_column in move_table[faction][square]:
+                    moves.add((square, to_row * 9 + to_column))
+    moves = sorted(moves)
+    return np.array([move[0] for move in moves], dtype=np.intp), np.array([move[1] for move in moves], dtype=np.intp)
+
+
+MOVE_FROM, MOVE_TO = build_vocabulary()
+MOVE_COUNT = len(MOVE_FROM)
+# the vocabulary index of every from * 90 + to move code, -1 for moves no piece can make
+MOVE_INDEX = np.full(90 * 90, -1, dtype=np.intp)
+MOVE_INDEX[MOVE_FROM * 90 + MOVE_TO] = np.arange(MOVE_COUNT)
+
+
+def build_rays():
+    """returns the (90, 4, 9) squares along the four rays from every square, nearest first and padded with the
+    empty square, the matching mask of real squares and the vocabulary index of the move to each ray square"""
+    rays = np.full((90, 4, 9), EMPTY_SQUARE, dtype=np.intp)
+    ray_moves = np.zeros((90, 4, 9), dtype=np.intp)
+    for square in range(90):
+        for direction, (row_step, column_step) in enumerate(RAY_STEPS):
+            row = square // 9 + row_step
+            column = square % 9 + column_step
+            distance = 0
+            while 0 <= row <= 9 and 0 <= column <= 8:
+                rays[square, direction, distance] = row * 9 + column
+                ray_moves[square, direction, distance] = MOVE_INDEX[square * 90 + row * 9 + column]
+                row += row_step
+                column += column_step
+                distance += 1
+    return rays, rays != EMPTY_SQUARE, ray_moves
+
+
+RAYS, RAY_VALID, RAY_MOVES = build_rays()
+
+
+def build_step_tables():
+    """returns the tables of the pieces that step, each indexed by side (0 red, 1 black), piece code and square:
+    the (2, 8, 90, 8) vocabulary moves a piece makes from the square and the squares that must be empty for them,
+    padded with -1 and the empty square, then the (2, 90, 23) squares a piece attacks the square from, the code it
+    must have there and the square that must be empty, padded with an empty square no piece code matches"""
+    step_moves = np.full((2, 8, 90, 8), -1, dtype=np.intp)
+    step_blocks = np.full((2, 8, 90, 8), EMPTY_SQUARE, dtype=np.intp)
+    attack_width = 23
+    attack_from = np.full((2, 90, attack_width), EMPTY_SQUARE, dtype=np.intp)
+    attack_codes = np.full((2, 90, attack_width), PIECE_OFF_BOARD, dtype=np.int8)
+    attack_blocks = np.full((2, 90, attack_width), EMPTY_SQUARE, dtype=np.intp)
+    for side, faction in ((0, FACTION_RED), (1, FACTION_BLACK)):
+        attack_counts = [0] * 90
+        for piece_type, move_table, attack_table in STEP_TABLES:
+            for square in range(90):
+                for index, (row, column, block_row, block_column) in enumerate(move_table[faction][square]):
+                    step_moves[side, piece_type, square, index] = MOVE_INDEX[square * 90 + row * 9 + column]
+                    if block_row is not None:
+                        step_blocks[side, piece_type, square, index] = block_row * 9 + block_column
+                for row, column, block_row, block_column in attack_table[faction][square]:
+                    index = attack_counts[square]
+                    attack_from[side, square, index] = row * 9 + column
+                    attack_codes[side, square, index] = piece_type
+                    if block_row is not None:
+                        attack_blocks[side, square, index] = block_row * 9 + block_column
+                    attack_counts[square] += 1
+    return step_moves, step_blocks, attack_from, attack_codes, attack_blocks
+
+
+STEP_MOVES, STEP_BLOCKS, STEP_ATTACK_FROM, STEP_ATTACK_CODES, STEP_ATTACK_BLOCKS = build_step_tables()
+
+
+def board_array(compact_board):
+    """returns the (10, 9) int8 array of a CompactBoard's piece codes"""
+    mailbox = np.frombuffer(compact_board.get_squares(), dtype=np.int8).reshape(MAILBOX_HEIGHT, MAILBOX_WIDTH)
+    return mailbox[MAILBOX_PADDING:MAILBOX_PADDING + 10, MAILBOX_PADDING:MAILBOX_PADDING + 9].copy()
+
+
+def encode_games(games):
+    """returns the (N, 10, 9) boards and (N,) sides to move of a list of games, sides being SIDE_RED or
+    SIDE_BLACK"""
+    boards = np.empty((len(games), 10, 9), dtype=np.int8)
+    sides = np.empty(len(games), dtype=np.int8)
+    for index, game in enumerate(games):
+        boards[index] = board_array(game.get_compact_board())
+        sides[index] = SIDE_RED if game.get_turn() == FACTION_RED else SIDE_BLACK
+    return boards, sides
+
+
+def move_index(from_row, from_column, to_row, to_column):
+    """returns the vocabulary index of a move, raising ValueError for a move no piece can make"""
+    index = MOVE_INDEX[(from_row * 9 + from_column) * 90 + to_row * 9 + to_column]
+    if index < 0:
+        raise ValueError("no piece can move from " + coord_to_string(from_row, from_column) + " to " +
+                         coord_to_string(to_row, to_column))
+    return int(index)
+
+
+def mask_moves(mask):
+    """returns the moves of one position's mask as (from_row, from_column, to_row, to_column) tuples"""
+    moves = []
+    for index in np.flatnonzero(mask):
+        from_square = MOVE_FROM[index]
+        to_square = MOVE_TO[index]
+        moves.append((int(from_square // 9), int(from_square % 9), int(to_square // 9), int(to_square % 9)))
+    return moves
+
+
+def padded_squares(boards):
+    """returns the (N, 91) int8 squares of (N, 10, 9) boards with the empty square appended"""
+    squares = np.zeros((len(boards), 91), dtype=np.int8)
+    squares[:, :90] = boards.reshape(len(boards), 90)
+    return squares
+
+
+def side_indices(sides):
+    """returns the 0 for red, 1 for black table index of an array of sides"""
+    return (sides == SIDE_BLACK).astype(np.intp)
+
+
+def pseudo_legal_candidates(squares, sides):
+    """returns the (positions, vocabulary moves) arrays of every pseudo legal move of a block of padded squares,
+    the moves get_potential_moves gives"""
+    side_column = sides[:, None]
+    positions, from_squares = np.nonzero(squares[:, :90] * side_column > 0)
+    piece_sides = sides[positions]
+    piece_types = np.abs(squares[positions, from_squares]).astype(np.intp)
+    found_positions = []
+    found_moves = []
+
+    # chariots take every square up to and including the first piece if it is an enemy, cannons every square up to
+    # the first piece and the piece after that screen if it is an enemy
+    sliders = (piece_types == PIECE_CHARIOT) | (piece_types == PIECE_CANNON)
+    slider_positions = positions[sliders]
+    slider_squares = from_squares[sliders]
+    contents = squares[slider_positions[:, None, None], RAYS[slider_squares]]
+    occupied = contents != 0
+    pieces_passed = np.cumsum(occupied, axis=2, dtype=np.int8)
+    enemies = occupied & (contents * piece_sides[sliders][:, None, None] < 0)
+    capture_count = np.where(piece_types[sliders] == PIECE_CANNON, 2, 1).astype(np.int8)[:, None, None]
+    reached = RAY_VALID[slider_squares] & ((pieces_passed == 0) | (enemies & (pieces_passed == capture_count)))
+    slider_index, direction, distance = np.nonzero(reached)
+    found_positions.append(slider_positions[slider_index])
+    found_moves.append(RAY_MOVES[slider_squares[slider_index], direction, distance])
+
+    # the general captures the first piece up its forward file if that is the other general
+    generals = piece_types == PIECE_GENERAL
+    general_positions = positions[generals]
+    general_squares = from_squares[generals]
+    forward = side_indices(piece_sides[generals])
+    contents = squares[general_positions[:, None], RAYS[general_squares, forward]]
+    occupied = contents != 0
+    first = occupied.argmax(axis=1)
+    flying = occupied.any(axis=1) & (np.abs(contents[np.arange(len(contents)), first]) == PIECE_GENERAL)
+    found_positions.append(general_positions[flying])
+    found_moves.append(RAY_MOVES[general_squares[flying], forward[flying], first[flying]])
+
+    # the other pieces step through their move tables, horses and elephants only past an empty leg or eye
+    steppers = ~sliders
+    stepper_positions = positions[steppers][:, None]
+    table_index = (side_indices(piece_sides[steppers]), piece_types[steppers], from_squares[steppers])
+    moves = STEP_MOVES[table_index]
+    targets = squares[stepper_positions, MOVE_TO[moves]]
+    allowed = (moves >= 0) & (targets * piece_sides[steppers][:, None] <= 0) & \
+              (squares[stepper_positions, STEP_BLOCKS[table_index]] == 0)
+    stepper_index, slot = np.nonzero(allowed)
+    found_positions.append(positions[steppers][stepper_index])
+    found_moves.append(moves[stepper_index, slot])
+    return np.concatenate(found_positions), np.concatenate(found_moves)
+
+
+def attacked_block(squares, targets, attackers):
+    """returns the (N,) mask of which padded squares have their target square, which holds a general, attacked by
+    the side attackers. Like XiangqiGame.is_square_attacked this probes outward from the target: a chariot or facing
+    general first along a ray, a cannon second, then the reversed step tables"""
+    rows = np.arange(len(squares))[:, None]
+    attacker_column = attackers[:, None]
+    contents = squares[rows[:, :, None], RAYS[targets]]
+    occupied = contents != 0
+    pieces_passed = np.cumsum(occupied, axis=2, dtype=np.int8)
+    first = np.where(occupied & (pieces_passed == 1), contents, 0).sum(axis=2)
+    second = np.where(occupied & (pieces_passed == 2), contents, 0).sum(axis=2)
+    attacked = ((first == attacker_column * PIECE_CHARIOT) | (second == attacker_column * PIECE_CANNON)).any(axis=1)
+    attacked |= (first[:, FILE_RAYS] == attacker_column * PIECE_GENERAL).any(axis=1)
+    table_index = (side_indices(attackers), targets)
+    steppers = squares[rows, STEP_ATTACK_FROM[table_index]] == attacker_column * STEP_ATTACK_CODES[table_index]
+    steppers &= squares[rows, STEP_ATTACK_BLOCKS[table_index]] == 0
+    return attacked | steppers.any(axis=1)
+
+
+def find_generals(squares, sides):
+    """returns the (N,) square of each side's general and the (N,) mask of positions that have one"""
+    generals = squares[:, :90] == (sides[:, None] * PIECE_GENERAL)
+    return generals.argmax(axis=1), generals.any(axis=1)
+
+
+def pseudo_legal_block(squares, sides):
+    """returns the (N, moves) pseudo legal mask of a block of padded squares"""
+    moves = np.zeros((len(squares), MOVE_COUNT), dtype=bool)
+    positions, indices = pseudo_legal_candidates(squares, sides)
+    moves[positions, indices] = True
+    return moves
+
+
+def legal_block(squares, sides):
+    """returns the (N, moves) legal mask of a block of padded squares. Only a move that can expose the mover's
+    general is made on a copy of its board and tested: any move out of check, a general move, a move from or to the
+    general's rank or file, which opens a line or adds a cannon screen, or a move off a square diagonal to the
+    general, which can free a horse's leg"""
+    moves = np.zeros((len(squares), MOVE_COUNT), dtype=bool)
+    positions, indices = pseudo_legal_candidates(squares, sides)
+    general_squares, has_general = find_generals(squares, sides)
+    checked = has_general & attacked_block(squares, general_squares, -sides)
+    movers = sides[positions]
+    from_squares = MOVE_FROM[indices]
+    to_squares = MOVE_TO[indices]
+    general_rows = general_squares[positions] // 9
+    general_columns = general_squares[positions] % 9
+    from_rows = from_squares // 9
+    from_columns = from_squares % 9
+    tested = checked[positions] | (squares[positions, from_squares] == movers * PIECE_GENERAL)
+    tested |= (from_rows == general_rows) | (from_columns == general_columns)
+    tested |= (to_squares // 9 == general_rows) | (to_squares % 9 == general_columns)
+    tested |= (np.abs(from_rows - general_rows) == 1) & (np.abs(from_columns - general_columns) == 1)
+    tested &= has_general[positions]
+
+    tested_index = np.flatnonzero(tested)
+    children = squares[positions[tested_index]]
+    rows = np.arange(len(children))
+    children[rows, to_squares[tested_index]] = children[rows, from_squares[tested_index]]
+    children[rows, from_squares[tested_index]] = 0
+    targets = np.where(children[rows, to_squares[tested_index]] == movers[tested_index] * PIECE_GENERAL,
+                       to_squares[tested_index], general_squares[positions[tested_index]])
+    exposed = attacked_block(children, targets, -movers[tested_index])
+    # a side without a general, as in some test positions, cannot be checked
+    safe = np.ones(len(positions), dtype=bool)
+    safe[tested_index[exposed]] = False
+    moves[positions[safe], indices[safe]] = True
+    return moves
+
+
+def check_block(squares, sides):
+    """returns the (N,) in check mask of a block of padded squares"""
+    general_squares, has_general = find_generals(squares, sides)
+    return has_general & attacked_block(squares, general_squares, -sides)
+
+
+def blocks(boards, sides, function):
+    """runs function over the padded squares and sides of every block of positions and returns the results joined"""
+    boards = np.asarray(boards, dtype=np.int8)
+    sides = np.asarray(sides, dtype=np.int8)
+    if boards.ndim != 3 or boards.shape[1:] != (10, 9) or sides.shape != (len(boards),):
+        raise ValueError("boards must have shape (N, 10, 9) and sides shape (N,)")
+    results = [function(padded_squares(boards[start:start + BLOCK_SIZE]), sides[start:start + BLOCK_SIZE])
+               for start in range(0, len(boards), BLOCK_SIZE)]
+    if len(results) == 0:
+        return function(padded_squares(boards), sides)
+    return np.concatenate(results)
+
+
+def pseudo_legal_moves(boards, sides):
+    """returns the (N, MOVE_COUNT) mask of the pseudo legal moves of the side to move in each of N positions, the
+    moves get_potential_moves gives"""
+    return blocks(boards, sides, pseudo_legal_block)
+
+
+def legal_moves(boards, sides):
+    """returns the (N, MOVE_COUNT) mask of the legal moves of the side to move in each of N positions"""
+    return blocks(boards, sides, legal_block)
+
+
+def in_check(boards, sides):
+    """returns the (N,) mask of the positions whose side to move is in check"""
+    return blocks(boards, sides, check_block)
+
+
+def sample_games(count, seed=0, max_plies=120):
+    """returns count games at positions reached by random legal moves from the start, for testing and benchmarks"""
+    rng = random.Random(seed)
+    games = []
+    while len(games) < count:
+        game = XiangqiGame(engine=ENGINE_BITBOARD, quiet=True)
+        for ply in range(rng.randrange(max_plies)):
+            moves = game.get_legal_moves(game.get_turn())
+            if len(moves) == 0 or game.get_game_state() != STATUS_UNFINISHED:
+                break
+            move = rng.choice(moves)
+            game.play_move(coord_to_string(move[0], move[1]), coord_to_string(move[2], move[3]))
+        games.append(game)
+    return games
+
+
+def cross_check(games):
+    """compares the batched legal moves of a list of games with XiangqiGame.get_legal_moves and returns the
+    positions that differ as a list of dictionaries"""
+    boards, sides = encode_games(games)
+    masks = legal_moves(boards, sides)
+    mismatches = []
+    for game, mask in zip(games, masks):
+        expected = set(game.get_legal_moves(game.get_turn()))
+        found = set(mask_moves(mask))
+        if expected != found:
+            mismatches.append({"fen": game.to_fen(), "missing": sorted(expected - found),
+                               "extra": sorted(found - expected)})
+    return mismatches
+
+
+def main():
+    """command line entry point, times batched against per game legal move generation and cross checks them"""
+    parser = argparse.ArgumentParser(description="XiangQi batched move generation")
+    parser.add_argument("--positions", type=int, default=10000, help="positions in the timed batch")
+    parser.add_argument("--per-game", type=int, default=500, help="positions timed one game at a time")
+    parser.add_argument("--check", type=int, default=0, help="positions to cross check against XiangqiGame")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    games = sample_games(max(arguments.per_game, arguments.check, 1), arguments.seed)
+    boards, sides = encode_games(games)
+    repeats = -(-arguments.positions // len(games))
+    boards = np.tile(boards, (repeats, 1, 1))[:arguments.positions]
+    sides = np.tile(sides, repeats)[:arguments.positions]
+    start = time.perf_counter()
+    masks = legal_moves(boards, sides)
+    batch_seconds = time.perf_counter() - start
+
+    report = {"positions": len(boards), "moves": int(masks.sum()), "vocabulary": MOVE_COUNT,
+              "batch_seconds": round(batch_seconds, 6),
+              "batch_positions_per_second": round(len(boards) / batch_seconds, 1)}
+    for engine in (ENGINE_OBJECTS, ENGINE_BITBOARD):
+        per_game = [XiangqiGame.from_fen(game.to_fen(), engine, True) for game in games[:arguments.per_game]]
+        start = time.perf_counter()
+        for game in per_game:
+            game.get_legal_moves(game.get_turn())
+        seconds = time.perf_counter() - start
+        report[engine.lower() + "_positions_per_second"] = round(len(per_game) / seconds, 1) if per_game else None
+    if arguments.check > 0:
+        mismatches = cross_check(games[:arguments.check])
+        report["checked"] = arguments.check
+        report["mismatches"] = mismatches[:10]
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,167 @@
+# Description: Perft benchmark runner for the XiangQi move generator. Counts the leaf nodes of the legal move tree
+# from the starting position and a fixed set of test positions, reporting nodes per second as JSON so runs can be
+# compared over time. Run with: python XiangqiBenchmark.py --depth 3 --engine BITBOARD --divide
+# The --memory option instead reports the resident size of a game, fresh and after it has been played for a number
+# of random plies, for sizing servers that hold many games at once
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from XiangqiGame import XiangqiGame, ENGINE_OBJECTS, ENGINE_BITBOARD, START_FEN, STATUS_UNFINISHED, coord_to_string
+from XiangqiParallel import parallel_divide
+
+# test positions as Xiangqi FEN. expected holds known node counts by depth, the starting position values are the
+# published perft results and the others were cross checked between the game piece and bitboard engines
+PERFT_POSITIONS = [
+    {"name": "start", "fen": START_FEN,
+     "expected": {1: 44, 2: 1920, 3: 79666, 4: 3290240}},
+    {"name": "central cannon", "fen": "rnbakabr1/9/1c4nc1/p1p1p1p1p/9/9/P1P1P1P1P/1C2C1N2/9/RNBAKAB1R w - - 4 3",
+     "expected": {1: 34, 2: 1307, 3: 45366}},
+    {"name": "screen horses", "fen": "1rbakab1r/9/1cn3nc1/p3p1p1p/2p6/6P2/P1P1P3P/2N1C2C1/9/1RBAKABNR w - - 8 5",
+     "expected": {1: 37, 2: 1366, 3: 51688}},
+    {"name": "open files", "fen": "r1bakabn1/9/1cn1c4/p1p1p1p1r/8p/9/P1P1P1P1P/1CN1C4/3R5/2BAKABNR w - - 8 5",
+     "expected": {1: 46, 2: 1549, 3: 66324}},
+    {"name": "middlegame", "fen": "4ka2r/3c5/b3b4/4p3p/2p3p2/9/4n1PcP/B7N/2N1K4/3A1AB1R w - - 6 23",
+     "expected": {1: 16, 2: 727, 3: 11597}},
+    {"name": "endgame", "fen": "2ba2b2/1n3k3/9/2p3pc1/8p/2P6/r5P1P/9/4K3R/R1BN5 w - - 0 26",
+     "expected": {1: 20, 2: 649, 3: 14223}},
+]
+# random plies played on every game before its played size is measured
+DEFAULT_MEMORY_PLIES = 100
+
+
+def load_position(position, engine=ENGINE_OBJECTS):
+    """returns a game set up at a test position"""
+    return XiangqiGame.from_fen(position["fen"], engine)
+
+
+def run_perft(game, depth, divide=False, workers=1):
+    """runs perft on a game and returns the result as a dictionary, splitting the root moves across worker
+    processes when workers is more than 1"""
+    start = time.perf_counter()
+    worker_results = None
+    if workers > 1:
+        split = parallel_divide(game, depth, workers)
+        nodes = split["nodes"]
+        divide_counts = split["divide"] if divide else None
+        worker_results = split["workers"]
+    elif divide:
+        divide_counts = game.divide(depth)
+        nodes = sum(divide_counts.values())
+    else:
+        divide_counts = None
+        nodes = game.perft(depth)
+    seconds = time.perf_counter() - start
+    result = {"depth": depth, "nodes": nodes, "seconds": round(seconds, 6),
+              "nodes_per_second": round(nodes / seconds) if seconds > 0 else None}
+    if divide_counts is not None:
+        result["divide"] = divide_counts
+    if worker_results is not None:
+        result["workers"] = worker_results
+    return result
+
+
+def run_suite(depth, engine=ENGINE_OBJECTS, divide=False, positions=None, workers=1):
+    """runs perft to depth on every test position and returns the report as a dictionary"""
+    if positions is None:
+        positions = PERFT_POSITIONS
+    results = []
+    total_nodes = 0
+    total_seconds = 0
+    for position in positions:
+        result = run_perft(load_position(position, engine), depth, divide, workers)
+        result["name"] = position["name"]
+        expected = position["expected"].get(depth)
+        result["expected"] = expected
+        result["passed"] = expected is None or expected == result["nodes"]
+        total_nodes += result["nodes"]
+        total_seconds += result["seconds"]
+        results.append(result)
+    return {"engine": engine, "depth": depth, "workers": workers, "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "total_nodes": total_nodes,
+            "total_seconds": round(total_seconds, 6),
+            "nodes_per_second": round(total_nodes / total_seconds) if total_seconds > 0 else None,
+            "passed": all(result["passed"] for result in results), "positions": results}
+
+
+def play_random_plies(game, plies, rng):
+    """plays up to plies random legal moves on a game, stopping early if the game ends, and returns the number
+    played"""
+    played = 0
+    while played < plies and game.get_game_state() == STATUS_UNFINISHED:
+        legal_moves = game.get_legal_moves(game.get_turn())
+        if len(legal_moves) == 0:
+            break
+        from_row, from_column, to_row, to_column = rng.choice(legal_moves)
+        game.play_move(coord_to_string(from_row, from_column), coord_to_string(to_row, to_column))
+        played += 1
+    return played
+
+
+def run_memory(games, engine=ENGINE_OBJECTS, position=None, plies=DEFAULT_MEMORY_PLIES, seed=0):
+    """creates games at a test position, the starting position by default, and returns the memory each game
+    holds, measured with tracemalloc, and the time taken to create one as a dictionary. Every game is then played
+    for up to plies random moves and measured again, since a game in use holds its history and move cache as well"""
+    if position is None:
+        position = PERFT_POSITIONS[0]
+    # the first game pays for the module level tables and is left out of the measurement
+    load_position(position, engine)
+    gc.collect()
+    tracemalloc.start()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    held_games = [load_position(position, engine) for index in range(games)]
+    seconds = time.perf_counter() - start
+    fresh_bytes = tracemalloc.get_traced_memory()[0] - start_bytes
+    rng = random.Random(seed)
+    played_plies = 0
+    for game in held_games:
+        game.set_quiet(True)
+        played_plies += play_random_plies(game, plies, rng)
+    gc.collect()
+    played_bytes = tracemalloc.get_traced_memory()[0] - start_bytes
+    tracemalloc.stop()
+    units = [unit for row in held_games[0].get_board() for unit in row if unit != ""]
+    return {"engine": engine, "position": position["name"], "games": games,
+            "bytes_per_game": fresh_bytes // games, "plies": plies,
+            "plies_per_game": round(played_plies / games, 1), "played_bytes_per_game": played_bytes // games,
+            "bytes_per_unit": sys.getsizeof(units[0]), "units_per_game": len(units),
+            "seconds_per_game": round(seconds / games, 6), "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main():
+    """command line entry point, prints the JSON report or writes it to --output"""
+    parser = argparse.ArgumentParser(description="XiangQi perft benchmark")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--engine", choices=[ENGINE_OBJECTS, ENGINE_BITBOARD], default=ENGINE_OBJECTS)
+    parser.add_argument("--divide", action="store_true", help="split the node counts by root move")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes to split the root moves across")
+    parser.add_argument("--memory", type=int, metavar="GAMES", help="measure the memory of this many games instead")
+    parser.add_argument("--memory-plies", type=int, default=DEFAULT_MEMORY_PLIES, help="random plies played on "
+                                                                                      "every game measured")
+    parser.add_argument("--output", help="file to write the JSON report to")
+    arguments = parser.parse_args()
+
+    if arguments.memory:
+        report = run_memory(arguments.memory, arguments.engine, plies=arguments.memory_plies)
+        report["passed"] = True
+    else:
+        report = run_suite(arguments.depth, arguments.engine, arguments.divide, workers=arguments.workers)
+    report_text = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            output_file.write(report_text + "\n")
+    else:
+        print(report_text)
+    return 0 if report["passed"] else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
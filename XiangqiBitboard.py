@@ -0,0 +1,337 @@
+# Description: Bitboard move generation engine for the XiangQi game. A position is held as 90 bit Python int
+# bitboards per piece type and side, where square row * 9 + column is bit number row * 9 + column. Chariot and cannon
+# moves come from precomputed rank and file occupancy tables, the other pieces use the per square move tables of
+# XiangqiGame. Moves are ints encoded as from_square * 90 + to_square
+
+from XiangqiGame import FACTION_RED, FACTION_BLACK, PIECE_EMPTY, PIECE_GENERAL, PIECE_GUARD, PIECE_ELEPHANT, \
+    PIECE_HORSE, PIECE_CHARIOT, PIECE_CANNON, PIECE_PAWN, GENERAL_MOVES, GUARD_MOVES, ELEPHANT_MOVES, HORSE_MOVES, \
+    PAWN_MOVES
+
+SIDE_RED = 0
+SIDE_BLACK = 1
+FULL_BOARD = (1 << 90) - 1
+RANK_MASK = (1 << 9) - 1
+FILE_MASK = (1 << 10) - 1
+
+
+def side_index(faction):
+    """returns the bitboard side index for a faction"""
+    if faction == FACTION_RED:
+        return SIDE_RED
+    return SIDE_BLACK
+
+
+def build_line_tables(length):
+    """builds slide and cannon jump tables for a line of squares. For every position on the line and every
+    occupancy of the line, slides holds the squares a chariot reaches (up to and including the first blocker in each
+    direction) and jumps holds the square a cannon captures on (the first piece after the screen)"""
+    slides = []
+    jumps = []
+    for position in range(length):
+        position_slides = []
+        position_jumps = []
+        for occupancy in range(1 << length):
+            slide = 0
+            jump = 0
+            for step in (1, -1):
+                index = position + step
+                screened = False
+                while 0 <= index < length:
+                    if occupancy >> index & 1:
+                        if screened:
+                            jump |= 1 << index
+                            break
+                        slide |= 1 << index
+                        screened = True
+                    elif not screened:
+                        slide |= 1 << index
+                    index += step
+            position_slides.append(slide)
+            position_jumps.append(jump)
+        slides.append(position_slides)
+        jumps.append(position_jumps)
+    return slides, jumps
+
+
+def spread_file(line_masks):
+    """converts file line masks (bit n is row n) into bitboards for column 0 (bit n * 9 is row n)"""
+    spread = []
+    for line_mask in line_masks:
+        board_mask = 0
+        row = 0
+        while line_mask:
+            if line_mask & 1:
+                board_mask |= 1 << (row * 9)
+            line_mask >>= 1
+            row += 1
+        spread.append(board_mask)
+    return spread
+
+
+def build_occupancy_tables():
+    """builds the rank tables (indexed [column][rank occupancy], shifted by row * 9 when used) and the file tables
+    (indexed [row][file occupancy], shifted by column when used)"""
+    rank_slides, rank_jumps = build_line_tables(9)
+    file_slides, file_jumps = build_line_tables(10)
+    file_slides = [spread_file(masks) for masks in file_slides]
+    file_jumps = [spread_file(masks) for masks in file_jumps]
+    return rank_slides, rank_jumps, file_slides, file_jumps
+
+
+RANK_SLIDES, RANK_JUMPS, FILE_SLIDES, FILE_JUMPS = build_occupancy_tables()
+# bit of each square in the file major (rotated) occupancy, where square row * 9 + column is bit column * 10 + row
+FILE_BITS = [1 << (square % 9 * 10 + square // 9) for square in range(90)]
+
+
+def build_step_tables():
+    """converts the XiangqiGame move tables into bitboard form, both forwards (where a piece on a square can go) and
+    in reverse (which squares a piece attacks a square from), for every side"""
+    general_steps = ([], [])
+    guard_steps = ([], [])
+    pawn_steps = ([], [])
+    elephant_steps = ([], [])
+    horse_steps = []
+    general_attackers = ([0] * 90, [0] * 90)
+    guard_attackers = ([0] * 90, [0] * 90)
+    pawn_attackers = ([0] * 90, [0] * 90)
+    elephant_attackers = ([[] for square in range(90)], [[] for square in range(90)])
+    horse_attackers = [{} for square in range(90)]
+    for side, faction in ((SIDE_RED, FACTION_RED), (SIDE_BLACK, FACTION_BLACK)):
+        for square in range(90):
+            for table, steps, attackers in ((GENERAL_MOVES, general_steps, general_attackers),
+                                            (GUARD_MOVES, guard_steps, guard_attackers),
+                                            (PAWN_MOVES, pawn_steps, pawn_attackers)):
+                targets = 0
+                for row, column, block_row, block_column in table[faction][square]:
+                    targets |= 1 << (row * 9 + column)
+                    attackers[side][row * 9 + column] |= 1 << square
+                steps[side].append(targets)
+            moves = []
+            for row, column, block_row, block_column in ELEPHANT_MOVES[faction][square]:
+                moves.append((1 << (block_row * 9 + block_column), 1 << (row * 9 + column)))
+                elephant_attackers[side][row * 9 + column].append((1 << (block_row * 9 + block_column), 1 << square))
+            elephant_steps[side].append(tuple(moves))
+    for square in range(90):
+        # group the horse moves by leg, one leg serves two targets
+        legs = {}
+        for row, column, block_row, block_column in HORSE_MOVES[FACTION_RED][square]:
+            leg_bit = 1 << (block_row * 9 + block_column)
+            legs[leg_bit] = legs.get(leg_bit, 0) | 1 << (row * 9 + column)
+            attackers = horse_attackers[row * 9 + column]
+            attackers[leg_bit] = attackers.get(leg_bit, 0) | 1 << square
+        horse_steps.append(tuple(legs.items()))
+    horse_attackers = [tuple(attackers.items()) for attackers in horse_attackers]
+    elephant_attackers = tuple([tuple(attackers) for attackers in side] for side in elephant_attackers)
+    return general_steps, guard_steps, pawn_steps, elephant_steps, horse_steps, general_attackers, \
+        guard_attackers, pawn_attackers, elephant_attackers, horse_attackers
+
+
+GENERAL_STEPS, GUARD_STEPS, PAWN_STEPS, ELEPHANT_STEPS, HORSE_STEPS, GENERAL_ATTACKERS, GUARD_ATTACKERS, \
+    PAWN_ATTACKERS, ELEPHANT_ATTACKERS, HORSE_ATTACKERS = build_step_tables()
+
+
+class BitboardPosition:
+    """A position held as bitboards, with make/unmake and legal move generation matching the game piece classes"""
+
+    def __init__(self, compact_board=None):
+        """creates an empty position, or loads the pieces of a CompactBoard"""
+        self._codes = [PIECE_EMPTY] * 90
+        self._pieces = ([0] * 8, [0] * 8)
+        self._occupied = [0, 0]
+        self._occupancy = 0
+        self._file_occupancy = 0
+        if compact_board is not None:
+            for row in range(10):
+                for column in range(9):
+                    code = compact_board.get_code(row, column)
+                    if code != PIECE_EMPTY:
+                        self.put_piece(row * 9 + column, code)
+
+    def put_piece(self, square, code):
+        """places the piece code on an empty square"""
+        bit = 1 << square
+        if code > 0:
+            side = SIDE_RED
+        else:
+            side = SIDE_BLACK
+        self._codes[square] = code
+        self._pieces[side][abs(code)] |= bit
+        self._occupied[side] |= bit
+        self._occupancy |= bit
+        self._file_occupancy |= FILE_BITS[square]
+
+    def get_code(self, square):
+        """returns the piece code on a square"""
+        return self._codes[square]
+
+    def get_pieces(self, faction, piece_type):
+        """returns the bitboard of one piece type for a faction"""
+        return self._pieces[side_index(faction)][piece_type]
+
+    def get_occupancy(self):
+        """returns the bitboard of every occupied square"""
+        return self._occupancy
+
+    def make(self, move):
+        """plays a move on the bitboards without any rule checks and returns the captured piece code"""
+        from_square, to_square = divmod(move, 90)
+        codes = self._codes
+        code = codes[from_square]
+        captured = codes[to_square]
+        from_bit = 1 << from_square
+        to_bit = 1 << to_square
+        if code > 0:
+            side = SIDE_RED
+        else:
+            side = SIDE_BLACK
+        self._pieces[side][abs(code)] ^= from_bit | to_bit
+        self._occupied[side] ^= from_bit | to_bit
+        if captured:
+            self._pieces[1 - side][abs(captured)] ^= to_bit
+            self._occupied[1 - side] ^= to_bit
+            self._occupancy ^= from_bit
+            self._file_occupancy ^= FILE_BITS[from_square]
+        else:
+            self._occupancy ^= from_bit | to_bit
+            self._file_occupancy ^= FILE_BITS[from_square] | FILE_BITS[to_square]
+        codes[to_square] = code
+        codes[from_square] = PIECE_EMPTY
+        return captured
+
+    def unmake(self, move, captured):
+        """reverts a make call, restoring the captured piece code"""
+        from_square, to_square = divmod(move, 90)
+        codes = self._codes
+        code = codes[to_square]
+        from_bit = 1 << from_square
+        to_bit = 1 << to_square
+        if code > 0:
+            side = SIDE_RED
+        else:
+            side = SIDE_BLACK
+        self._pieces[side][abs(code)] ^= from_bit | to_bit
+        self._occupied[side] ^= from_bit | to_bit
+        if captured:
+            self._pieces[1 - side][abs(captured)] ^= to_bit
+            self._occupied[1 - side] ^= to_bit
+            self._occupancy ^= from_bit
+            self._file_occupancy ^= FILE_BITS[from_square]
+        else:
+            self._occupancy ^= from_bit | to_bit
+            self._file_occupancy ^= FILE_BITS[from_square] | FILE_BITS[to_square]
+        codes[from_square] = code
+        codes[to_square] = captured
+
+    def line_tables(self, square):
+        """returns the (rank slides, file slides, rank jumps, file jumps) bitboards seen from a square"""
+        row, column = divmod(square, 9)
+        rank_occupancy = self._occupancy >> (row * 9) & RANK_MASK
+        file_occupancy = self._file_occupancy >> (column * 10) & FILE_MASK
+        return (RANK_SLIDES[column][rank_occupancy] << (row * 9), FILE_SLIDES[row][file_occupancy] << column,
+                RANK_JUMPS[column][rank_occupancy] << (row * 9), FILE_JUMPS[row][file_occupancy] << column)
+
+    def generate_moves(self, faction):
+        """returns the pseudo legal moves of a faction, the same moves get_potential_moves gives"""
+        side = side_index(faction)
+        pieces = self._pieces[side]
+        enemy_pieces = self._pieces[1 - side]
+        occupancy = self._occupancy
+        file_occupancy = self._file_occupancy
+        not_own = ~self._occupied[side] & FULL_BOARD
+        enemy = self._occupied[1 - side]
+        moves = []
+        for piece_type in (PIECE_GENERAL, PIECE_GUARD, PIECE_ELEPHANT, PIECE_HORSE, PIECE_CHARIOT, PIECE_CANNON,
+                           PIECE_PAWN):
+            sources = pieces[piece_type]
+            while sources:
+                low_bit = sources & -sources
+                sources ^= low_bit
+                square = low_bit.bit_length() - 1
+                if piece_type == PIECE_CHARIOT or piece_type == PIECE_CANNON or piece_type == PIECE_GENERAL:
+                    row, column = divmod(square, 9)
+                    rank_occupancy = occupancy >> (row * 9) & RANK_MASK
+                    file_occupancy_line = file_occupancy >> (column * 10) & FILE_MASK
+                    file_slides = FILE_SLIDES[row][file_occupancy_line] << column
+                    if piece_type == PIECE_CHARIOT:
+                        targets = ((RANK_SLIDES[column][rank_occupancy] << (row * 9)) | file_slides) & not_own
+                    elif piece_type == PIECE_CANNON:
+                        targets = (((RANK_SLIDES[column][rank_occupancy] << (row * 9)) | file_slides) & ~occupancy
+                                   | ((RANK_JUMPS[column][rank_occupancy] << (row * 9))
+                                      | (FILE_JUMPS[row][file_occupancy_line] << column)) & enemy)
+                    else:
+                        # steps inside the palace, plus the flying general capture down an open file
+                        targets = GENERAL_STEPS[side][square] & not_own | file_slides & enemy_pieces[PIECE_GENERAL]
+                elif piece_type == PIECE_HORSE:
+                    targets = 0
+                    for leg_bit, leg_targets in HORSE_STEPS[square]:
+                        if not occupancy & leg_bit:
+                            targets |= leg_targets
+                    targets &= not_own
+                elif piece_type == PIECE_ELEPHANT:
+                    targets = 0
+                    for eye_bit, target_bit in ELEPHANT_STEPS[side][square]:
+                        if not occupancy & eye_bit:
+                            targets |= target_bit
+                    targets &= not_own
+                elif piece_type == PIECE_GUARD:
+                    targets = GUARD_STEPS[side][square] & not_own
+                else:
+                    targets = PAWN_STEPS[side][square] & not_own
+                base = square * 90
+                while targets:
+                    low_bit = targets & -targets
+                    targets ^= low_bit
+                    moves.append(base + low_bit.bit_length() - 1)
+        return moves
+
+    def is_square_attacked(self, square, faction):
+        """returns true if a piece of faction can move to the square, probing outward from the square. The
+        flying general only counts when the square holds the other general"""
+        side = side_index(faction)
+        pieces = self._pieces[side]
+        occupancy = self._occupancy
+        rank_slides, file_slides, rank_jumps, file_jumps = self.line_tables(square)
+        if (rank_slides | file_slides) & pieces[PIECE_CHARIOT]:
+            return True
+        if (rank_jumps | file_jumps) & pieces[PIECE_CANNON]:
+            return True
+        if PAWN_ATTACKERS[side][square] & pieces[PIECE_PAWN]:
+            return True
+        if pieces[PIECE_HORSE]:
+            for leg_bit, sources in HORSE_ATTACKERS[square]:
+                if sources & pieces[PIECE_HORSE] and not occupancy & leg_bit:
+                    return True
+        if GENERAL_ATTACKERS[side][square] & pieces[PIECE_GENERAL]:
+            return True
+        if abs(self._codes[square]) == PIECE_GENERAL and file_slides & pieces[PIECE_GENERAL]:
+            return True
+        if GUARD_ATTACKERS[side][square] & pieces[PIECE_GUARD]:
+            return True
+        for eye_bit, source_bit in ELEPHANT_ATTACKERS[side][square]:
+            if source_bit & pieces[PIECE_ELEPHANT] and not occupancy & eye_bit:
+                return True
+        return False
+
+    def in_check(self, faction):
+        """returns true if the general of faction is attacked"""
+        general = self._pieces[side_index(faction)][PIECE_GENERAL]
+        if not general:
+            return False
+        if faction == FACTION_RED:
+            enemy_faction = FACTION_BLACK
+        else:
+            enemy_faction = FACTION_RED
+        return self.is_square_attacked(general.bit_length() - 1, enemy_faction)
+
+    def generate_legal_moves(self, faction, captures_only=False):
+        """returns the moves of a faction that do not leave its general attacked, or only the captures"""
+        legal_moves = []
+        codes = self._codes
+        for move in self.generate_moves(faction):
+            if captures_only and codes[move % 90] == PIECE_EMPTY:
+                continue
+            captured = self.make(move)
+            if not self.in_check(faction):
+                legal_moves.append(move)
+            self.unmake(move, captured)
+        return legal_moves
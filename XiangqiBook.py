@@ -0,0 +1,224 @@
+# Description: Opening book for the XiangQi game. The builder replays a game archive, counting how often each move
+# was played from each position and how those games ended, and writes the counts as fixed width entries sorted by
+# the position's Zobrist key. Lookups memory map the book and binary search it, so the book never lives on the Python
+# heap. Build with: python XiangqiBook.py build games.xqr opening.book --plies 20
+
+import argparse
+import bisect
+import itertools
+import json
+import mmap
+import random
+import struct
+
+from XiangqiGame import XiangqiGame, ENGINE_BITBOARD, FACTION_RED, STATUS_RED_WINS, STATUS_UNFINISHED, \
+    STATUS_DRAW, START_FEN
+from XiangqiRecord import RecordReader, RECORD_MAGIC, RESULT_STATES, RESULT_UNFINISHED, encode_move, decode_move
+from XiangqiReplay import read_records
+
+BOOK_MAGIC = b"XQB1"
+# magic number then the number of entries
+BOOK_HEADER = struct.Struct("<4sI")
+# Zobrist key, 16 bit move code, times played, wins and draws for the side that played it
+BOOK_ENTRY = struct.Struct("<QHIII")
+BOOK_KEY = struct.Struct("<Q")
+DEFAULT_PLIES = 20
+
+
+def read_book_records(path, plies):
+    """yields (list of moves, start FEN, game state) for every game of a text or binary archive. The game state is
+    the result a binary record stores, and then only the first plies moves are read, or None when it has to be found
+    by replaying the whole game, for text archives and records stored as unfinished"""
+    with open(path, "rb") as record_file:
+        binary = record_file.read(len(RECORD_MAGIC)) == RECORD_MAGIC
+    if not binary:
+        for number, moves, fen in read_records(path):
+            yield moves, fen, None
+        return
+    with RecordReader(path) as reader:
+        for record in reader:
+            fen = record.get_fen()
+            if fen == START_FEN:
+                fen = None
+            game_state = None
+            if record.get_result() != RESULT_UNFINISHED:
+                game_state = RESULT_STATES.get(record.get_result())
+            moves = record.get_moves()
+            # the moves are copied out of the map, so the view is released before the reader closes
+            if game_state is None:
+                move_list = list(moves)
+            else:
+                move_list = list(itertools.islice(moves, plies))
+            del moves
+            yield move_list, fen, game_state
+
+
+def book_moves(moves, fen, plies, game_state=None):
+    """replays a game and returns its (Zobrist key, move code, faction to move) tuples for the first plies moves
+    and its final game state. Replay stops at the first illegal move, and after plies moves when the final game
+    state is already known"""
+    if fen is None:
+        game = XiangqiGame(engine=ENGINE_BITBOARD, quiet=True)
+    else:
+        game = XiangqiGame.from_fen(fen, ENGINE_BITBOARD, True)
+    positions = []
+    for move in moves:
+        if game_state is not None and len(positions) >= plies:
+            break
+        if isinstance(move, int):
+            code = move
+            squares = decode_move(move)
+        else:
+            squares = move.split("-")
+            if len(squares) != 2:
+                break
+            try:
+                code = encode_move(squares[0], squares[1])
+            except ValueError:
+                break
+        key = game.get_zobrist_key()
+        turn = game.get_turn()
+        if not game.play_move(squares[0], squares[1]).is_ok():
+            break
+        if len(positions) < plies:
+            positions.append((key, code, turn))
+    if game_state is None:
+        game_state = game.get_game_state()
+    return positions, game_state
+
+
+def build_book(archive_path, book_path, plies=DEFAULT_PLIES, min_count=1):
+    """builds a book from a text or binary game archive, counting the first plies moves of every game, and writes
+    the moves played at least min_count times. Returns the number of games read and entries written"""
+    counts = {}
+    games = 0
+    for moves, fen, stored_state in read_book_records(archive_path, plies):
+        games += 1
+        positions, game_state = book_moves(moves, fen, plies, stored_state)
+        for key, code, turn in positions:
+            entry = counts.get((key, code))
+            if entry is None:
+                entry = counts[(key, code)] = [0, 0, 0]
+            entry[0] += 1
+            if game_state == STATUS_UNFINISHED or game_state == STATUS_DRAW:
+                # unfinished games are scored as draws
+                entry[2] += 1
+            elif (game_state == STATUS_RED_WINS) == (turn == FACTION_RED):
+                entry[1] += 1
+
+    entries = sorted((key, code) for (key, code), entry in counts.items() if entry[0] >= min_count)
+    with open(book_path, "wb") as book_file:
+        book_file.write(BOOK_HEADER.pack(BOOK_MAGIC, len(entries)))
+        for key, code in entries:
+            played, wins, draws = counts[(key, code)]
+            book_file.write(BOOK_ENTRY.pack(key, code, played, wins, draws))
+    return {"games": games, "entries": len(entries)}
+
+
+class OpeningBook:
+    """A book file opened for lookups through a read only memory map"""
+
+    def __init__(self, path):
+        """opens and maps a book file, raising ValueError if it is not one"""
+        self._file = open(path, "rb")
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(path + " is not an opening book")
+        if len(self._buffer) < BOOK_HEADER.size or self._buffer[:len(BOOK_MAGIC)] != BOOK_MAGIC:
+            self.close()
+            raise ValueError(path + " is not an opening book")
+        self._entries = BOOK_HEADER.unpack_from(self._buffer)[1]
+        if BOOK_HEADER.size + self._entries * BOOK_ENTRY.size > len(self._buffer):
+            self.close()
+            raise ValueError(path + " is truncated")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._entries
+
+    def __getitem__(self, index):
+        """returns the Zobrist key of an entry, which lets bisect search the map directly"""
+        return BOOK_KEY.unpack_from(self._buffer, BOOK_HEADER.size + index * BOOK_ENTRY.size)[0]
+
+    def lookup(self, key):
+        """returns the (move code, times played, wins, draws) entries of a Zobrist key"""
+        index = bisect.bisect_left(self, key)
+        entries = []
+        while index < self._entries:
+            entry_key, code, played, wins, draws = BOOK_ENTRY.unpack_from(
+                self._buffer, BOOK_HEADER.size + index * BOOK_ENTRY.size)
+            if entry_key != key:
+                break
+            entries.append((code, played, wins, draws))
+            index += 1
+        return entries
+
+    def get_moves(self, game):
+        """returns the book moves of a game's position as dictionaries holding the (from, to) coordinate strings,
+        the times played, wins, draws and a weight, the share of the book games it was played in, most played
+        first. Moves that are not legal in the position, from a key collision, are left out"""
+        entries = self.lookup(game.get_zobrist_key())
+        if len(entries) == 0:
+            return []
+        legal_moves = set()
+        for from_row, from_column, to_row, to_column in game.get_legal_moves(game.get_turn()):
+            legal_moves.add((from_row * 9 + from_column) * 90 + to_row * 9 + to_column)
+        entries = [entry for entry in entries if entry[0] in legal_moves]
+        total = sum(entry[1] for entry in entries)
+        moves = []
+        for code, played, wins, draws in entries:
+            moves.append({"move": decode_move(code), "played": played, "wins": wins, "draws": draws,
+                          "weight": played / total})
+        moves.sort(key=lambda move: move["played"], reverse=True)
+        return moves
+
+    def choose_move(self, game, rng=random):
+        """returns a book move for a game as a (from, to) pair of coordinate strings ready for make_move, picked at
+        random weighted by how often it was played, or None if the position is not in the book"""
+        moves = self.get_moves(game)
+        if len(moves) == 0:
+            return None
+        return rng.choices([move["move"] for move in moves], [move["played"] for move in moves])[0]
+
+    def close(self):
+        """unmaps and closes the book file"""
+        self._buffer.close()
+        self._file.close()
+
+
+def main():
+    """command line entry point, builds a book or prints the book moves of a position"""
+    parser = argparse.ArgumentParser(description="XiangQi opening book")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="build a book from a text or binary game archive")
+    build_parser.add_argument("archive_path")
+    build_parser.add_argument("book_path")
+    build_parser.add_argument("--plies", type=int, default=DEFAULT_PLIES, help="moves of each game to count")
+    build_parser.add_argument("--min-count", type=int, default=1, help="times a move must be played to be kept")
+    probe_parser = commands.add_parser("probe", help="print the book moves of a position")
+    probe_parser.add_argument("book_path")
+    probe_parser.add_argument("--fen", help="position to look up, the starting position by default")
+    arguments = parser.parse_args()
+
+    if arguments.command == "build":
+        print(json.dumps(build_book(arguments.archive_path, arguments.book_path, arguments.plies,
+                                    arguments.min_count)))
+    else:
+        if arguments.fen:
+            game = XiangqiGame.from_fen(arguments.fen, ENGINE_BITBOARD, True)
+        else:
+            game = XiangqiGame(engine=ENGINE_BITBOARD, quiet=True)
+        with OpeningBook(arguments.book_path) as book:
+            print(json.dumps(book.get_moves(game), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,251 @@
+# Description: Streaming training data export for the XiangQi game. Archived games are replayed through XiangqiGame
+# and every position is written as fixed layout feature planes: one 10 x 9 plane per piece type and side, a side to
+# move plane and planes holding the halfmove clock and move number, labelled with the move played as a XiangqiBatch
+# vocabulary index and the game's final result. Each array is a .npy file appended a chunk at a time whose header is
+# reserved up front and rewritten after every chunk, so datasets larger than memory are written and memory mapped
+# without ever being loaded. Games are encoded across worker processes and written in archive order, so the output
+# is the same for any number of workers. Needs NumPy. Run with: python XiangqiDataset.py export games.xqr dataset
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+from XiangqiGame import XiangqiGame, ENGINE_OBJECTS, ENGINE_BITBOARD, FACTION_RED, STATUS_RED_WINS, \
+    STATUS_BLACK_WINS, PIECE_GENERAL, PIECE_PAWN
+from XiangqiRecord import encode_move, decode_move
+from XiangqiReplay import read_records
+from XiangqiBatch import MOVE_INDEX, board_array
+
+# red general to pawn, black general to pawn, then the side to move (all ones for red), the halfmove clock and the
+# move number, both capped at 255
+PIECE_PLANES = 14
+PLANE_SIDE = 14
+PLANE_HALFMOVE = 15
+PLANE_FULLMOVE = 16
+PLANE_COUNT = 17
+PLANE_CODES = np.array(list(range(PIECE_GENERAL, PIECE_PAWN + 1)) + list(range(-PIECE_GENERAL, -PIECE_PAWN - 1, -1)),
+                       dtype=np.int8)
+RESULT_WIN = 1
+RESULT_DRAW = 0
+RESULT_LOSS = -1
+# array name, dtype and shape of one item of every file in a dataset
+DATASET_ARRAYS = (("features", np.uint8, (PLANE_COUNT, 10, 9)), ("moves", np.int16, ()), ("results", np.int8, ()),
+                  ("games", np.int32, ()))
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+# bytes reserved for the magic number, header length and header dictionary, room for any row count
+NPY_HEADER_SIZE = 128
+DEFAULT_CHUNK_GAMES = 64
+# chunks in flight per worker
+WINDOW_PER_WORKER = 4
+
+
+def npy_header(dtype, shape):
+    """returns the NPY_HEADER_SIZE byte version 1.0 .npy header of a C order array"""
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False,
+                   "shape": tuple(shape)})
+    length = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    if len(header) + 1 > length:
+        raise ValueError("shape " + str(shape) + " does not fit the reserved .npy header")
+    return NPY_MAGIC + length.to_bytes(2, "little") + (header.ljust(length - 1) + "\n").encode("latin1")
+
+
+class NpyWriter:
+    """Appends rows to a .npy file. The header is rewritten after every append, so the file is always a valid array
+    of the rows written so far"""
+
+    def __init__(self, path, dtype, item_shape):
+        """creates or truncates the file at path for rows of dtype and item_shape"""
+        self._file = open(path, "wb")
+        self._dtype = np.dtype(dtype)
+        self._item_shape = tuple(item_shape)
+        self._rows = 0
+        self._file.write(npy_header(self._dtype, (0,) + self._item_shape))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def get_rows(self):
+        """returns the number of rows written"""
+        return self._rows
+
+    def append(self, rows):
+        """appends an array of rows, raising ValueError if their shape does not match"""
+        rows = np.ascontiguousarray(rows, dtype=self._dtype)
+        if rows.shape[1:] != self._item_shape:
+            raise ValueError("rows of shape " + str(rows.shape[1:]) + " do not match " + str(self._item_shape))
+        self._file.write(rows.tobytes())
+        self._rows += len(rows)
+        self._file.seek(0)
+        self._file.write(npy_header(self._dtype, (self._rows,) + self._item_shape))
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """closes the file"""
+        self._file.close()
+
+
+def encode_game(number, moves, fen, engine=ENGINE_BITBOARD):
+    """replays one game and returns its positions as a dictionary of the dataset arrays. Replay stops at the first
+    illegal move, and the result label is the game's final state from the side to move's point of view"""
+    if fen is None:
+        game = XiangqiGame(engine=engine, quiet=True)
+    else:
+        game = XiangqiGame.from_fen(fen, engine, True)
+    boards = []
+    counters = []
+    move_indices = []
+    red_to_move = []
+    for move in moves:
+        if isinstance(move, int):
+            code = move
+            squares = decode_move(move)
+        else:
+            squares = move.split("-")
+            if len(squares) != 2:
+                break
+            try:
+                code = encode_move(squares[0], squares[1])
+            except ValueError:
+                break
+        board = board_array(game.get_compact_board())
+        counter = (game.get_halfmove_clock(), game.get_fullmove_number())
+        turn = game.get_turn()
+        if not game.play_move(squares[0], squares[1]).is_ok():
+            break
+        boards.append(board)
+        counters.append(counter)
+        move_indices.append(MOVE_INDEX[code])
+        red_to_move.append(turn == FACTION_RED)
+
+    positions = len(boards)
+    features = np.zeros((positions, PLANE_COUNT, 10, 9), dtype=np.uint8)
+    if positions > 0:
+        boards = np.stack(boards)
+        features[:, :PIECE_PLANES] = boards[:, None] == PLANE_CODES[None, :, None, None]
+        counters = np.minimum(np.array(counters), 255)
+        red_to_move = np.array(red_to_move)
+        features[:, PLANE_SIDE] = red_to_move[:, None, None]
+        features[:, PLANE_HALFMOVE] = counters[:, 0, None, None]
+        features[:, PLANE_FULLMOVE] = counters[:, 1, None, None]
+    results = np.full(positions, RESULT_DRAW, dtype=np.int8)
+    if game.get_game_state() in (STATUS_RED_WINS, STATUS_BLACK_WINS):
+        red_won = game.get_game_state() == STATUS_RED_WINS
+        results[:] = np.where(np.array(red_to_move, dtype=bool) == red_won, RESULT_WIN, RESULT_LOSS)
+    return {"features": features, "moves": np.array(move_indices, dtype=np.int16), "results": results,
+            "games": np.full(positions, number, dtype=np.int32)}
+
+
+def encode_chunk(task):
+    """worker entry point, encodes a (records, engine) chunk of games and returns the number of games and the
+    dataset arrays of all of their positions joined in order"""
+    records, engine = task
+    encoded = [encode_game(number, moves, fen, engine) for number, moves, fen in records]
+    return len(records), dict((name, np.concatenate([game[name] for game in encoded]))
+                              for name, dtype, shape in DATASET_ARRAYS)
+
+
+def read_chunks(records, chunk_games, engine):
+    """groups records into encode_chunk tasks of chunk_games games. Games are numbered by their order in the archive
+    from 0, rather than by the line number or index the archive reader gives them, so a game has the same number
+    whether it was read from a text or a binary archive"""
+    chunk = []
+    for number, (record_number, moves, fen) in enumerate(records):
+        chunk.append((number, moves, fen))
+        if len(chunk) >= chunk_games:
+            yield chunk, engine
+            chunk = []
+    if chunk:
+        yield chunk, engine
+
+
+def encode_chunks(tasks, workers):
+    """yields the encoded chunks in task order, encoded on a pool of workers with a bounded window in flight, or in
+    this process for a single worker"""
+    if workers <= 1:
+        for task in tasks:
+            yield encode_chunk(task)
+        return
+    window = workers * WINDOW_PER_WORKER
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(encode_chunk, (task,)))
+            # waiting on the oldest chunk first keeps the output in archive order
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def dataset_path(directory, name):
+    """returns the path of one array of a dataset"""
+    return os.path.join(directory, name + ".npy")
+
+
+def export_dataset(archive_path, directory, workers=None, engine=ENGINE_BITBOARD, chunk_games=DEFAULT_CHUNK_GAMES):
+    """replays a text or binary game archive into the .npy files of a dataset directory and returns the number of
+    games, positions and bytes written"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    games = 0
+    writers = [NpyWriter(dataset_path(directory, name), dtype, shape) for name, dtype, shape in DATASET_ARRAYS]
+    try:
+        tasks = read_chunks(read_records(archive_path), chunk_games, engine)
+        for encoded_games, chunk in encode_chunks(tasks, workers):
+            games += encoded_games
+            for writer, (name, dtype, shape) in zip(writers, DATASET_ARRAYS):
+                writer.append(chunk[name])
+    finally:
+        for writer in writers:
+            writer.close()
+    seconds = time.perf_counter() - start
+    positions = writers[0].get_rows()
+    total_bytes = sum(os.path.getsize(dataset_path(directory, name)) for name, dtype, shape in DATASET_ARRAYS)
+    return {"games": games, "positions": positions, "bytes": total_bytes, "seconds": round(seconds, 6),
+            "positions_per_second": round(positions / seconds, 1) if seconds > 0 else None}
+
+
+def open_dataset(directory):
+    """returns the arrays of a dataset directory as a dictionary of read only memory maps"""
+    return dict((name, np.load(dataset_path(directory, name), mmap_mode="r")) for name, dtype, shape in DATASET_ARRAYS)
+
+
+def main():
+    """command line entry point, exports a dataset or prints a summary of one"""
+    parser = argparse.ArgumentParser(description="XiangQi training data export")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="replay a text or binary game archive into a dataset")
+    export_parser.add_argument("archive_path")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the core "
+                                                                         "count")
+    export_parser.add_argument("--engine", choices=[ENGINE_OBJECTS, ENGINE_BITBOARD], default=ENGINE_BITBOARD)
+    export_parser.add_argument("--chunk-games", type=int, default=DEFAULT_CHUNK_GAMES, help="games per worker task")
+    info_parser = commands.add_parser("info", help="print the shapes and result counts of a dataset")
+    info_parser.add_argument("directory")
+    arguments = parser.parse_args()
+
+    if arguments.command == "export":
+        print(json.dumps(export_dataset(arguments.archive_path, arguments.directory, arguments.workers,
+                                        arguments.engine, arguments.chunk_games)))
+    else:
+        dataset = open_dataset(arguments.directory)
+        results = dataset["results"]
+        print(json.dumps({"shapes": dict((name, array.shape) for name, array in dataset.items()),
+                          "wins": int((results == RESULT_WIN).sum()), "draws": int((results == RESULT_DRAW).sum()),
+                          "losses": int((results == RESULT_LOSS).sum())}))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
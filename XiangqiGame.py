@@ -2,18 +2,96 @@
 # Date: 03/11/2020
 # Description: XiangQi game portfolio project
 
+import random
+import re
+from array import array
 
 # class wide contract variables using all caps nomenclature to denote that this variable does not change
 # this method reduces the possibility of typos in programs, especially when accessing databases or in long programs
 STATUS_UNFINISHED = 'UNFINISHED'
 STATUS_RED_WINS = 'RED_WON'
 STATUS_BLACK_WINS = 'BLACK_WON'
+STATUS_DRAW = 'DRAW'
 FACTION_RED = 'RED'
 FACTION_BLACK = 'BLACK'
+ENGINE_OBJECTS = 'OBJECTS'
+ENGINE_BITBOARD = 'BITBOARD'
+
+# events passed to subscribers, and the error codes of a rejected MoveResult
+EVENT_MOVE = 'MOVE'
+EVENT_CHECK = 'CHECK'
+EVENT_CHECKMATE = 'CHECKMATE'
+EVENT_STALEMATE = 'STALEMATE'
+EVENT_TURN = 'TURN'
+EVENT_UNDO = 'UNDO'
+EVENT_REPETITION = 'REPETITION'
+EVENT_PERPETUAL_CHECK = 'PERPETUAL_CHECK'
+EVENT_PERPETUAL_CHASE = 'PERPETUAL_CHASE'
+EVENT_ERROR = 'ERROR'
+ERROR_INVALID_COORDINATE = 'INVALID_COORDINATE'
+ERROR_NO_UNIT = 'NO_UNIT'
+ERROR_WRONG_TURN = 'WRONG_TURN'
+ERROR_GAME_OVER = 'GAME_OVER'
+ERROR_ILLEGAL_MOVE = 'ILLEGAL_MOVE'
+# a position seen this many times ends the game, drawn unless one side forced the repetition by perpetual check or
+# chase
+REPETITION_LIMIT = 3
+
+# piece codes for the compact board, red pieces are stored positive and black pieces negative.
+# OFF_BOARD pads the mailbox so horse and elephant offsets never need a bounds check
+PIECE_EMPTY = 0
+PIECE_GENERAL = 1
+PIECE_GUARD = 2
+PIECE_ELEPHANT = 3
+PIECE_HORSE = 4
+PIECE_CHARIOT = 5
+PIECE_CANNON = 6
+PIECE_PAWN = 7
+PIECE_OFF_BOARD = 8
+TITLE_CODES = {"Gen": PIECE_GENERAL, "Grd": PIECE_GUARD, "Ele": PIECE_ELEPHANT, "Hrs": PIECE_HORSE,
+               "Chr": PIECE_CHARIOT, "Can": PIECE_CANNON, "Paw": PIECE_PAWN}
+
+# the 10 x 9 board sits inside a mailbox with 2 squares of padding on every side
+MAILBOX_PADDING = 2
+MAILBOX_WIDTH = 9 + 2 * MAILBOX_PADDING
+MAILBOX_HEIGHT = 10 + 2 * MAILBOX_PADDING
+MAILBOX_SIZE = MAILBOX_WIDTH * MAILBOX_HEIGHT
+
+# Xiangqi FEN letters, red pieces are upper case and black pieces lower case. Horses and elephants are also read
+# from the alternative H and E letters
+FEN_LETTERS = {PIECE_GENERAL: "k", PIECE_GUARD: "a", PIECE_ELEPHANT: "b", PIECE_HORSE: "n", PIECE_CHARIOT: "r",
+               PIECE_CANNON: "c", PIECE_PAWN: "p"}
+FEN_CODES = {"k": PIECE_GENERAL, "a": PIECE_GUARD, "b": PIECE_ELEPHANT, "e": PIECE_ELEPHANT, "n": PIECE_HORSE,
+             "h": PIECE_HORSE, "r": PIECE_CHARIOT, "c": PIECE_CANNON, "p": PIECE_PAWN}
+START_FEN = "rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w - - 0 1"
+# a coordinate string like 'h3', the column letter then the row number 1 to 10 in ASCII digits
+COORD_PATTERN = re.compile(r"([a-i])(10|[1-9])")
+
+
+def build_zobrist_keys():
+    """builds the random 64 bit Zobrist keys, indexed [piece code][row * 9 + column] (negative codes index from the
+    end of the list). The generator is seeded so keys agree between processes and runs, which opening books and
+    other stored hashes depend on"""
+    generator = random.Random(20200311)
+    piece_keys = [None] * 15
+    for code in range(-PIECE_PAWN, PIECE_PAWN + 1):
+        if code != PIECE_EMPTY:
+            piece_keys[code] = [generator.getrandbits(64) for square in range(90)]
+    return piece_keys, generator.getrandbits(64)
+
+
+ZOBRIST_PIECES, ZOBRIST_BLACK_TO_MOVE = build_zobrist_keys()
+
+# (position, faction) entries held by each game's screened move cache, enough for both sides of the current and
+# previous position. Searches that revisit positions can opt in to more with set_move_cache_size
+MOVE_CACHE_SIZE = 4
 
 
 class GamePiece:
-    """Defines the basic functionality of a game piece"""
+    """Defines the basic functionality of a game piece. Pieces keep only their position, faction, board and screened
+    moves, the title and move geometry are shared by every piece of a type as class attributes and move tables"""
+    __slots__ = ("_row", "_column", "_faction", "_game_board", "_screened_moves")
+    _title = None
 
     def __init__(self, row, column, faction, game_board, ):
         self._row = row
@@ -35,38 +113,10 @@ class GamePiece:
         """returns the pieces' faction"""
         return self._faction
 
-    def update_position(self, row, column):
-        """updates the positional tracking of the piece"""
-        game_piece = self._game_board[self._row][self._column]
-        self._game_board[self._row][self._column] = ""
+    def set_position(self, row, column):
+        """updates the row and column of the piece without touching the board, used by XiangqiGame.move_unit"""
         self._row = row
         self._column = column
-        self._game_board[self._row][self._column] = game_piece
-
-    def move_out_of_bounds(self, row, column):
-        """checks to see if a proposed move is out of bounds"""
-        if row > 9 or row < 0 or column > 8 or column < 0:
-            return True
-        else:
-            return False
-
-    def position_contains_ally(self, row, column):
-        """checks to see if position is occupied by an ally piece"""
-        if self._game_board[row][column] == "":
-            return False
-        elif self._faction == self._game_board[row][column].get_faction():
-            return True
-        else:
-            return False
-
-    def position_contains_enemy(self, row, column):
-        """checks to see if position is occupied by an ally piece"""
-        if self._game_board[row][column] == "":
-            return False
-        elif self._faction != self._game_board[row][column].get_faction():
-            return True
-        else:
-            return False
 
     def get_title(self):
         """returns the title assigned to the child class"""
@@ -81,630 +131,387 @@ class GamePiece:
         self._screened_moves = moves_list
 
 
-# Note, for all game piece child classes, the method for finding moves is to provide a list of all spaces in the
-# objects range, then to delete illegal moves
+def in_palace(row, column, faction):
+    """returns true if the square is inside the palace of the faction"""
+    if column < 3 or column > 5:
+        return False
+    if faction == FACTION_RED:
+        return 0 <= row <= 2
+    return 7 <= row <= 9
+
+
+def on_own_side(row, faction):
+    """returns true if the row is on the faction's side of the river"""
+    if faction == FACTION_RED:
+        return row <= 4
+    return row >= 5
+
+
+def build_move_tables():
+    """builds the per square move tables for the pieces whose geometry never changes. Every table maps a faction
+    to a list indexed by row * 9 + column, holding (row, column, block_row, block_column) tuples where the block
+    square is the elephant eye or horse leg that must be empty, or None for pieces that cannot be blocked"""
+    general_table = {FACTION_RED: [], FACTION_BLACK: []}
+    guard_table = {FACTION_RED: [], FACTION_BLACK: []}
+    elephant_table = {FACTION_RED: [], FACTION_BLACK: []}
+    horse_table = {FACTION_RED: [], FACTION_BLACK: []}
+    pawn_table = {FACTION_RED: [], FACTION_BLACK: []}
+    for faction in (FACTION_RED, FACTION_BLACK):
+        if faction == FACTION_RED:
+            forward = 1
+        else:
+            forward = -1
+        for row in range(10):
+            for column in range(9):
+                general_moves = []
+                guard_moves = []
+                elephant_moves = []
+                horse_moves = []
+                pawn_moves = []
+                for row_step, column_step in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+                    if in_palace(row + row_step, column + column_step, faction):
+                        general_moves.append((row + row_step, column + column_step, None, None))
+                for row_step, column_step in ((1, 1), (-1, -1), (1, -1), (-1, 1)):
+                    if in_palace(row + row_step, column + column_step, faction):
+                        guard_moves.append((row + row_step, column + column_step, None, None))
+                    # elephants move two points diagonally, cannot cross the river and are blocked at the eye
+                    to_row = row + 2 * row_step
+                    to_column = column + 2 * column_step
+                    if 0 <= to_row <= 9 and 0 <= to_column <= 8 and on_own_side(to_row, faction):
+                        elephant_moves.append((to_row, to_column, row + row_step, column + column_step))
+                # horses are blocked by the point next to them in the direction of the longer step
+                for row_step, column_step in ((2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (-1, 2), (1, -2), (-1, -2)):
+                    to_row = row + row_step
+                    to_column = column + column_step
+                    if 0 <= to_row <= 9 and 0 <= to_column <= 8:
+                        horse_moves.append((to_row, to_column, row + int(row_step / 2), column + int(column_step / 2)))
+                # pawns only move forward, and sideways once they have crossed the river
+                if 0 <= row + forward <= 9:
+                    pawn_moves.append((row + forward, column, None, None))
+                if not on_own_side(row, faction):
+                    for column_step in (1, -1):
+                        if 0 <= column + column_step <= 8:
+                            pawn_moves.append((row, column + column_step, None, None))
+                general_table[faction].append(tuple(general_moves))
+                guard_table[faction].append(tuple(guard_moves))
+                elephant_table[faction].append(tuple(elephant_moves))
+                horse_table[faction].append(tuple(horse_moves))
+                pawn_table[faction].append(tuple(pawn_moves))
+    return general_table, guard_table, elephant_table, horse_table, pawn_table
+
+
+# built once at import, the palace, river, elephant eye and horse leg geometry never changes
+GENERAL_MOVES, GUARD_MOVES, ELEPHANT_MOVES, HORSE_MOVES, PAWN_MOVES = build_move_tables()
+
+
+def build_attack_tables():
+    """reverses the move tables, mapping each faction and target square to the (row, column, block_row,
+    block_column) squares a piece can reach it from, so attacks can be probed outward from the target"""
+    attack_tables = []
+    for move_table in (GENERAL_MOVES, GUARD_MOVES, ELEPHANT_MOVES, HORSE_MOVES, PAWN_MOVES):
+        attack_table = {}
+        for faction in (FACTION_RED, FACTION_BLACK):
+            attacks = [[] for square in range(90)]
+            for square in range(90):
+                for row, column, block_row, block_column in move_table[faction][square]:
+                    attacks[row * 9 + column].append((square // 9, square % 9, block_row, block_column))
+            attack_table[faction] = [tuple(square_attacks) for square_attacks in attacks]
+        attack_tables.append(attack_table)
+    return attack_tables
+
+
+GENERAL_ATTACKS, GUARD_ATTACKS, ELEPHANT_ATTACKS, HORSE_ATTACKS, PAWN_ATTACKS = build_attack_tables()
+
+
+# Note, the General, Guard, Elephant, Horse and Pawn walk their move table, checking each target (and block square)
+# once. The Chariot and Cannon walk the four rays along their rank and file
 class General(GamePiece):
     """Class General extended from game piece which defines specific moves for this piece"""
-
-    def __init__(self, row, column, faction, game_board):
-        """Overrides the init method for special moves for the piece"""
-        super().__init__(row, column, faction, game_board)
-        self._potential_moves = [[self.get_row() + 1, self.get_column() + 0],
-                                 [self.get_row() - 1, self.get_column() + 0],
-                                 [self.get_row() + 0, self.get_column() + 1],
-                                 [self.get_row() + 0, self.get_column() - 1]]
-        self._title = "Gen"
-
-    def update_position(self, row, column):
-        """runs the parent update method and updates the unique move list for the piece"""
-        super().update_position(row, column)
-        self._potential_moves = [[self.get_row() + 1, self.get_column() + 0],
-                                 [self.get_row() - 1, self.get_column() + 0],
-                                 [self.get_row() + 0, self.get_column() + 1],
-                                 [self.get_row() + 0, self.get_column() - 1]]
+    __slots__ = ()
+    _title = "Gen"
 
     def get_potential_moves(self):
-        """Returns a list of potential moves, removing items what will not be valid"""
-        # Save to separate list object, so we don't modify our moves list
-        potential_moves = list(self._potential_moves)
-        moves_to_remove = []
-        index = 0
-        move_adder = []
-
-        while index < len(potential_moves):
-            move = potential_moves[index]
-            if self.move_out_of_bounds(move[0], move[1]):
-                moves_to_remove.append(move)
-            elif self.position_contains_ally(move[0], move[1]):
-                moves_to_remove.append(move)
-            # cannot leave palace
-            elif self.get_faction() == FACTION_RED:
-                if move[0] > 2 or move[1] > 5 or move[1] < 3:
-                    moves_to_remove.append(move)
-
-            elif self.get_faction() == FACTION_BLACK:
-                if move[0] < 7 or move[1] > 5 or move[1] < 3:
-                    moves_to_remove.append(move)
-
-            index += 1
+        """Returns a list of potential moves from the move table"""
+        game_board = self._game_board
+        potential_moves = []
+        for row, column, block_row, block_column in GENERAL_MOVES[self._faction][self._row * 9 + self._column]:
+            target = game_board[row][column]
+            if target == "" or target.get_faction() != self._faction:
+                potential_moves.append([row, column])
 
         # add rules for flying general, if a general can see another he/she can capture that opposing general
-        unit_count = 0
-        enemy_gen_in_column = False
-        enemy_gen_position = []
-        for row in self._game_board:
-            for unit in row:
-                if unit != "" and self.get_column() == unit.get_column() and unit != self:
-                    unit_count += 1
-                    if unit.get_title().lower() == "gen" and self.get_faction() != unit.get_faction():
-                        enemy_gen_in_column = True
-                        enemy_gen_position = [unit.get_row(), unit.get_column()]
-        if enemy_gen_in_column and unit_count == 1:
-            move_adder.append(enemy_gen_position)
-
-        for move in moves_to_remove:
-            potential_moves.remove(move)
-        for move in move_adder:
-            potential_moves.append(move)
+        if self._faction == FACTION_RED:
+            step = 1
+        else:
+            step = -1
+        row = self._row + step
+        while 0 <= row <= 9:
+            unit = game_board[row][self._column]
+            if unit != "":
+                if unit.get_title() == "Gen":
+                    potential_moves.append([row, self._column])
+                break
+            row += step
         return potential_moves
 
 
 class Guard(GamePiece):
     """Class Guard extended from game piece which defines specific moves for this piece"""
-
-    def __init__(self, row, column, faction, game_board):
-        """Overrides the init method for special moves for the piece"""
-        super().__init__(row, column, faction, game_board)
-        self._potential_moves = [[self.get_row() + 1, self.get_column() + 1],
-                                 [self.get_row() - 1, self.get_column() - 1],
-                                 [self.get_row() + 1, self.get_column() - 1],
-                                 [self.get_row() - 1, self.get_column() + 1]]
-        self._title = "Grd"
-
-    def update_position(self, row, column):
-        """runs the parent update method and updates the unique move list for the piece"""
-        super().update_position(row, column)
-        self._potential_moves = [[self.get_row() + 1, self.get_column() + 1],
-                                 [self.get_row() - 1, self.get_column() - 1],
-                                 [self.get_row() + 1, self.get_column() - 1],
-                                 [self.get_row() - 1, self.get_column() + 1]]
+    __slots__ = ()
+    _title = "Grd"
 
     def get_potential_moves(self):
-        """Returns a list of potential moves, removing items what will not be valid"""
-        # Save to separate list object, so we don't modify our moves list
-        potential_moves = list(self._potential_moves)
-        moves_to_remove = []
-        index = 0
-        while index < len(potential_moves):
-            move = potential_moves[index]
-            if self.move_out_of_bounds(move[0], move[1]):
-                moves_to_remove.append(move)
-            elif self.position_contains_ally(move[0], move[1]):
-                moves_to_remove.append(move)
-            # cannot leave palace
-            elif self.get_faction() == FACTION_RED:
-                if move[0] > 2 or move[1] > 5 or move[1] < 3:
-                    moves_to_remove.append(move)
-            elif self.get_faction() == FACTION_BLACK:
-                if move[0] < 7 or move[1] > 5 or move[1] < 3:
-                    moves_to_remove.append(move)
-            index += 1
-
-        for move in moves_to_remove:
-            potential_moves.remove(move)
+        """Returns a list of potential moves from the move table"""
+        game_board = self._game_board
+        potential_moves = []
+        for row, column, block_row, block_column in GUARD_MOVES[self._faction][self._row * 9 + self._column]:
+            target = game_board[row][column]
+            if target == "" or target.get_faction() != self._faction:
+                potential_moves.append([row, column])
         return potential_moves
 
 
 class Elephant(GamePiece):
     """Class Elephant extended from game piece which defines specific moves for this piece"""
-
-    def __init__(self, row, column, faction, game_board):
-        """Overrides the init method for special moves for the piece"""
-        super().__init__(row, column, faction, game_board)
-        self._potential_moves = [[self.get_row() + 2, self.get_column() + 2],
-                                 [self.get_row() - 2, self.get_column() - 2],
-                                 [self.get_row() + 2, self.get_column() - 2],
-                                 [self.get_row() - 2, self.get_column() + 2]]
-        # check zone is a list of position coordinates that an opponent can currently attack
-        self._title = "Ele"
-
-    def update_position(self, row, column):
-        """runs the parent update method and updates the unique move list for the piece"""
-        super().update_position(row, column)
-        self._potential_moves = [[self.get_row() + 2, self.get_column() + 2],
-                                 [self.get_row() - 2, self.get_column() - 2],
-                                 [self.get_row() + 2, self.get_column() - 2],
-                                 [self.get_row() - 2, self.get_column() + 2]]
+    __slots__ = ()
+    _title = "Ele"
 
     def get_potential_moves(self):
-        """Returns a list of potential moves, removing items what will not be valid"""
-        # Save to separate list object, so we don't modify our moves list
-        potential_moves = list(self._potential_moves)
-        moves_to_remove = []
-        index = 0
-        while index < len(potential_moves):
-            move = potential_moves[index]
-            if self.move_out_of_bounds(move[0], move[1]):
-                moves_to_remove.append(move)
-            elif self.position_contains_ally(move[0], move[1]):
-                moves_to_remove.append(move)
-            # Cannot cross the river
-            elif self.get_faction() == FACTION_RED:
-                if move[0] > 4:
-                    moves_to_remove.append(move)
-                else:
-                    # check to see if the path is blocked
-                    if index == 0:
-                        if self._game_board[move[0] - 1][move[1] - 1] != "":
-                            moves_to_remove.append(move)
-                    elif index == 1:
-                        if self._game_board[move[0] + 1][move[1] + 1] != "":
-                            moves_to_remove.append(move)
-                    elif index == 2:
-                        if self._game_board[move[0] - 1][move[1] + 1] != "":
-                            moves_to_remove.append(move)
-                    elif index == 3:
-                        if self._game_board[move[0] + 1][move[1] - 1] != "":
-                            moves_to_remove.append(move)
-            elif self.get_faction() == FACTION_BLACK:
-                if move[0] < 5:
-                    moves_to_remove.append(move)
-                else:
-                    # check to see if the path is blocked
-                    if index == 0:
-                        if self._game_board[move[0] - 1][move[1] - 1] != "":
-                            moves_to_remove.append(move)
-                    elif index == 1:
-                        if self._game_board[move[0] + 1][move[1] + 1] != "":
-                            moves_to_remove.append(move)
-                    elif index == 2:
-                        if self._game_board[move[0] - 1][move[1] + 1] != "":
-                            moves_to_remove.append(move)
-                    elif index == 3:
-                        if self._game_board[move[0] + 1][move[1] - 1] != "":
-                            moves_to_remove.append(move)
-            index += 1
-
-        for move in moves_to_remove:
-            potential_moves.remove(move)
+        """Returns a list of potential moves from the move table, skipping moves with a blocked eye"""
+        game_board = self._game_board
+        potential_moves = []
+        for row, column, block_row, block_column in ELEPHANT_MOVES[self._faction][self._row * 9 + self._column]:
+            if game_board[block_row][block_column] == "":
+                target = game_board[row][column]
+                if target == "" or target.get_faction() != self._faction:
+                    potential_moves.append([row, column])
         return potential_moves
 
 
 class Horse(GamePiece):
     """Class Horse extended from game piece which defines specific moves for this piece"""
-
-    def __init__(self, row, column, faction, game_board):
-        """Overrides the init method for special moves for the piece"""
-        super().__init__(row, column, faction, game_board)
-        self._potential_moves = [[self.get_row() + 2, self.get_column() + 1],
-                                 [self.get_row() + 2, self.get_column() - 1],
-                                 [self.get_row() - 2, self.get_column() + 1],
-                                 [self.get_row() - 2, self.get_column() - 1],
-                                 [self.get_row() + 1, self.get_column() + 2],
-                                 [self.get_row() - 1, self.get_column() + 2],
-                                 [self.get_row() + 1, self.get_column() - 2],
-                                 [self.get_row() - 1, self.get_column() - 2]]
-        self._title = "Hrs"
-
-    def update_position(self, row, column):
-        """runs the parent update method and updates the unique move list for the piece"""
-        super().update_position(row, column)
-        self._potential_moves = [[self.get_row() + 2, self.get_column() + 1],
-                                 [self.get_row() + 2, self.get_column() - 1],
-                                 [self.get_row() - 2, self.get_column() + 1],
-                                 [self.get_row() - 2, self.get_column() - 1],
-                                 [self.get_row() + 1, self.get_column() + 2],
-                                 [self.get_row() - 1, self.get_column() + 2],
-                                 [self.get_row() + 1, self.get_column() - 2],
-                                 [self.get_row() - 1, self.get_column() - 2]]
+    __slots__ = ()
+    _title = "Hrs"
 
     def get_potential_moves(self):
-        """Returns a list of potential moves, removing items what will not be valid"""
-        # Save to separate list object, so we don't modify our moves list
-        potential_moves = list(self._potential_moves)
-        moves_to_remove = []
-        index = 0
-        while index < len(potential_moves):
-            move = potential_moves[index]
-            if self.move_out_of_bounds(move[0], move[1]):
-                moves_to_remove.append(move)
-            elif self.position_contains_ally(move[0], move[1]):
-                moves_to_remove.append(move)
-            # Can be blocked by other units
-            else:
-                # check to see if the path is blocked
-                if (index == 0 or index == 1) and move[0] < 9:
-                    if self._game_board[self.get_row() + 1][self.get_column()] != "":
-                        moves_to_remove.append(move)
-                elif (index == 2 or index == 3) and move[0] > 0:
-                    if self._game_board[self.get_row() - 1][self.get_column()] != "":
-                        moves_to_remove.append(move)
-                elif (index == 4 or index == 5) and move[1] > 0:
-                    if self._game_board[self.get_row()][self.get_column() + 1] != "":
-                        moves_to_remove.append(move)
-                elif (index == 6 or index == 7) and move[1] < 8:
-                    if self._game_board[self.get_row()][self.get_column() - 1] != "":
-                        moves_to_remove.append(move)
-            index += 1
-
-        for move in moves_to_remove:
-            potential_moves.remove(move)
+        """Returns a list of potential moves from the move table, skipping moves with a blocked leg"""
+        game_board = self._game_board
+        potential_moves = []
+        for row, column, block_row, block_column in HORSE_MOVES[self._faction][self._row * 9 + self._column]:
+            if game_board[block_row][block_column] == "":
+                target = game_board[row][column]
+                if target == "" or target.get_faction() != self._faction:
+                    potential_moves.append([row, column])
         return potential_moves
 
 
 class Chariot(GamePiece):
     """Class Chariot extended from game piece which defines specific moves for this piece"""
-
-    def __init__(self, row, column, faction, game_board):
-        """Overrides the init method for special moves for the piece"""
-        super().__init__(row, column, faction, game_board)
-        self._potential_moves = []
-        # for simplicity, fill moves with a loop since there are many possible
-        row_num = 1
-        while row_num <= len(self._game_board):
-            self._potential_moves.append([self.get_row() + row_num, self.get_column()])
-            row_num += 1
-        row_num = 1
-        while row_num <= len(self._game_board):
-            self._potential_moves.append([self.get_row() - row_num, self.get_column()])
-            row_num += 1
-        column_num = 1
-        while column_num <= len(self._game_board[0]):
-            self._potential_moves.append([self.get_row(), self.get_column() + column_num])
-            column_num += 1
-        column_num = 1
-        while column_num <= len(self._game_board[0]):
-            self._potential_moves.append([self.get_row(), self.get_column() - column_num])
-            column_num += 1
-
-        self._title = "Chr"
-
-    def update_position(self, row, column):
-        """runs the parent update method and updates the unique move list for the piece"""
-        super().update_position(row, column)
-        self._potential_moves.clear()
-        # for simplicity, fill moves with a loop since there are many possible
-        row_num = 1
-        while row_num <= len(self._game_board):
-            self._potential_moves.append([self.get_row() + row_num, self.get_column()])
-            row_num += 1
-        row_num = 1
-        while row_num <= len(self._game_board):
-            self._potential_moves.append([self.get_row() - row_num, self.get_column()])
-            row_num += 1
-        column_num = 1
-        while column_num <= len(self._game_board[0]):
-            self._potential_moves.append([self.get_row(), self.get_column() + column_num])
-            column_num += 1
-        column_num = 1
-        while column_num <= len(self._game_board[0]):
-            self._potential_moves.append([self.get_row(), self.get_column() - column_num])
-            column_num += 1
+    __slots__ = ()
+    _title = "Chr"
 
     def get_potential_moves(self):
-        """Returns a list of potential moves, removing items what will not be valid"""
-        # Save to separate list object, so we don't modify our moves list
-        potential_moves = list(self._potential_moves)
-        moves_to_remove = []
-        index = 0
-        current_column = self.get_column()
-        current_row = self.get_row()
-        while index < len(potential_moves):
-            move = potential_moves[index]
-            if self.move_out_of_bounds(move[0], move[1]):
-                moves_to_remove.append(move)
-
-            # if position contains ally, delete all moves behind that position
-            elif self.position_contains_ally(move[0], move[1]):
-                if current_row < move[0]:
-                    row_num = move[0]
-                    while row_num <= len(self._game_board):
-                        next_move = [row_num, current_column]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        row_num += 1
-
-                elif current_row > move[0]:
-                    row_num = move[0]
-                    while abs(row_num) <= len(self._game_board):
-                        next_move = [row_num, current_column]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        row_num -= 1
-
-                elif current_column < move[1]:
-                    column_num = move[1]
-                    while column_num <= len(self._game_board[1]):
-                        next_move = [current_row, column_num]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        column_num += 1
-
-                elif current_column > move[1]:
-                    column_num = move[1]
-                    while abs(column_num) <= len(self._game_board[1]):
-                        next_move = [current_row, column_num]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        column_num -= 1
-
-            elif self.position_contains_enemy(move[0], move[1]):
-                # same as before but plus one because it can capture the opponent, just not move past the opponent
-                if current_row < move[0]:
-                    row_num = move[0] + 1
-                    while row_num <= len(self._game_board):
-                        next_move = [row_num, current_column]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        row_num += 1
-
-                elif current_row > move[0]:
-                    row_num = move[0] - 1
-                    while abs(row_num) <= len(self._game_board):
-                        next_move = [row_num, current_column]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        row_num -= 1
-
-                elif current_column < move[1]:
-                    column_num = move[1] + 1
-                    while column_num <= len(self._game_board[1]):
-                        next_move = [current_row, column_num]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        column_num += 1
-
-                elif current_column > move[1]:
-                    column_num = move[1] - 1
-                    while abs(column_num) <= len(self._game_board[1]):
-                        next_move = [current_row, column_num]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        column_num -= 1
-
-            index += 1
-        for move in moves_to_remove:
-            if move in potential_moves:
-                potential_moves.remove(move)
+        """Returns a list of potential moves, every empty square along the rank and file up to and including the
+        first enemy unit"""
+        game_board = self._game_board
+        potential_moves = []
+        for row_step, column_step in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            row = self._row + row_step
+            column = self._column + column_step
+            while 0 <= row <= 9 and 0 <= column <= 8:
+                target = game_board[row][column]
+                if target == "":
+                    potential_moves.append([row, column])
+                else:
+                    if target.get_faction() != self._faction:
+                        potential_moves.append([row, column])
+                    break
+                row += row_step
+                column += column_step
         return potential_moves
 
 
 class Cannon(GamePiece):
     """Class Cannon extended from game piece which defines specific moves for this piece"""
-
-    def __init__(self, row, column, faction, game_board):
-        """Overrides the init method for special moves for the piece"""
-        super().__init__(row, column, faction, game_board)
-        self._potential_moves = []
-        # for simplicity, fill moves with a loop since there are many possible
-        row_num = 1
-        while row_num <= len(self._game_board):
-            self._potential_moves.append([self.get_row() + row_num, self.get_column()])
-            row_num += 1
-        row_num = 1
-        while row_num <= len(self._game_board):
-            self._potential_moves.append([self.get_row() - row_num, self.get_column()])
-            row_num += 1
-        column_num = 1
-        while column_num <= len(self._game_board[0]):
-            self._potential_moves.append([self.get_row(), self.get_column() + column_num])
-            column_num += 1
-        column_num = 1
-        while column_num <= len(self._game_board[0]):
-            self._potential_moves.append([self.get_row(), self.get_column() - column_num])
-            column_num += 1
-
-        self._title = "Can"
-
-    def update_position(self, row, column):
-        """runs the parent update method and updates the unique move list for the piece"""
-        super().update_position(row, column)
-        self._potential_moves.clear()
-        # for simplicity, fill moves with a loop since there are many possible
-        row_num = 1
-        while row_num <= len(self._game_board):
-            self._potential_moves.append([self.get_row() + row_num, self.get_column()])
-            row_num += 1
-        row_num = 1
-        while row_num <= len(self._game_board):
-            self._potential_moves.append([self.get_row() - row_num, self.get_column()])
-            row_num += 1
-        column_num = 1
-        while column_num <= len(self._game_board[0]):
-            self._potential_moves.append([self.get_row(), self.get_column() + column_num])
-            column_num += 1
-        column_num = 1
-        while column_num <= len(self._game_board[0]):
-            self._potential_moves.append([self.get_row(), self.get_column() - column_num])
-            column_num += 1
+    __slots__ = ()
+    _title = "Can"
 
     def get_potential_moves(self):
-        """Returns a list of potential moves, removing items what will not be valid"""
-        # Save to separate list object, so we don't modify our moves list
-        potential_moves = list(self._potential_moves)
-        moves_to_remove = []
-        # for enemies that have one unit between them and the cannon,
-        # grant that move back for a capture, otherwise behave as the Chariot
-        moves_to_grant = []
-        index = 0
-        current_column = self.get_column()
-        current_row = self.get_row()
-        while index < len(potential_moves):
-            move = potential_moves[index]
-            if self.move_out_of_bounds(move[0], move[1]):
-                moves_to_remove.append(move)
-
-            elif self.position_contains_ally(move[0], move[1]):
-                if current_row < move[0]:
-                    row_num = move[0]
-                    while row_num <= len(self._game_board):
-                        next_move = [row_num, current_column]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        row_num += 1
-
-                elif current_row > move[0]:
-                    row_num = move[0]
-                    while abs(row_num) <= len(self._game_board):
-                        next_move = [row_num, current_column]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        row_num -= 1
-
-                elif current_column < move[1]:
-                    column_num = move[1]
-                    while column_num <= len(self._game_board[1]):
-                        next_move = [current_row, column_num]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        column_num += 1
-
-                elif current_column > move[1]:
-                    column_num = move[1]
-                    while abs(column_num) <= len(self._game_board[1]):
-                        next_move = [current_row, column_num]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        column_num -= 1
-
-            elif self.position_contains_enemy(move[0], move[1]):
-                # Cannot capture like the rook, so no plus one. Instead capture move is added back if conditions are met
-                if current_row < move[0]:
-                    row_index = move[0] - 1
-                    unit_count = 0
-                    while row_index > current_row:
-                        if self._game_board[row_index][current_column] != "":
-                            unit_count += 1
-                        row_index -= 1
-                    if unit_count == 1:
-                        moves_to_grant.append(move)
-
-                    row_num = move[0]
-                    while row_num <= len(self._game_board):
-                        next_move = [row_num, current_column]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        row_num += 1
-
-                # if move contains enemy and the player's unit is in a greater number column than the enemy,
-                # scan the spaces between to count how many units there are. If only one, add that move back to
-                # possible move list
-                elif current_row > move[0]:
-                    row_index = move[0] + 1
-                    unit_count = 0
-                    while row_index < current_row:
-                        if self._game_board[row_index][current_column] != "":
-                            unit_count += 1
-                        row_index += 1
-                    if unit_count == 1:
-                        moves_to_grant.append(move)
-                    # scan like normal, removing all moves that lay behind the occupied space
-                    row_num = move[0]
-                    while abs(row_num) <= len(self._game_board):
-                        next_move = [row_num, current_column]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        row_num -= 1
-
-                elif current_column < move[1]:
-                    column_index = move[1] - 1
-                    unit_count = 0
-                    while column_index > current_column:
-                        if self._game_board[current_row][column_index] != "":
-                            unit_count += 1
-                        column_index -= 1
-                    if unit_count == 1:
-                        moves_to_grant.append(move)
-
-                    column_num = move[1]
-                    while column_num <= len(self._game_board[1]):
-                        next_move = [current_row, column_num]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        column_num += 1
-
-                elif current_column > move[1]:
-                    column_index = move[1] + 1
-                    unit_count = 0
-                    while column_index < current_column:
-                        if self._game_board[current_row][column_index] != "":
-                            unit_count += 1
-                        column_index += 1
-                    if unit_count == 1:
-                        moves_to_grant.append(move)
-
-                    column_num = move[1]
-                    while abs(column_num) <= len(self._game_board[1]):
-                        next_move = [current_row, column_num]
-                        if next_move not in moves_to_remove:
-                            moves_to_remove.append(next_move)
-                        column_num -= 1
-
-            index += 1
-        for move in moves_to_remove:
-            if move in potential_moves:
-                potential_moves.remove(move)
-        for move in moves_to_grant:
-            potential_moves.append(move)
+        """Returns a list of potential moves, every empty square along the rank and file up to the first unit, and
+        the first unit behind that screen if it is an enemy"""
+        game_board = self._game_board
+        potential_moves = []
+        for row_step, column_step in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            row = self._row + row_step
+            column = self._column + column_step
+            screened = False
+            while 0 <= row <= 9 and 0 <= column <= 8:
+                target = game_board[row][column]
+                if not screened:
+                    if target == "":
+                        potential_moves.append([row, column])
+                    else:
+                        screened = True
+                elif target != "":
+                    # cannons capture by jumping exactly one unit
+                    if target.get_faction() != self._faction:
+                        potential_moves.append([row, column])
+                    break
+                row += row_step
+                column += column_step
         return potential_moves
 
 
 class Pawn(GamePiece):
     """Class Pawn extended from game piece which defines specific moves for this piece"""
-
-    def __init__(self, row, column, faction, game_board):
-        """Overrides the init method for special moves for the piece"""
-        super().__init__(row, column, faction, game_board)
-        self._potential_moves = [[self.get_row() + 1, self.get_column() + 0],
-                                 [self.get_row() - 1, self.get_column() + 0],
-                                 [self.get_row() + 0, self.get_column() + 1],
-                                 [self.get_row() + 0, self.get_column() - 1]]
-        # check zone is a list of position coordinates that an opponent can currently attack
-        self._title = "Paw"
-
-    def update_position(self, row, column):
-        """runs the parent update method and updates the unique move list for the piece"""
-        super().update_position(row, column)
-        self._potential_moves = [[self.get_row() + 1, self.get_column() + 0],
-                                 [self.get_row() - 1, self.get_column() + 0],
-                                 [self.get_row() + 0, self.get_column() + 1],
-                                 [self.get_row() + 0, self.get_column() - 1]]
+    __slots__ = ()
+    _title = "Paw"
 
     def get_potential_moves(self):
-        """Returns a list of potential moves, removing items what will not be valid"""
-        # Save to separate list object, so we don't modify our moves list
-        potential_moves = list(self._potential_moves)
-        moves_to_remove = []
-        index = 0
-        while index < len(potential_moves):
-            move = potential_moves[index]
-            if self.move_out_of_bounds(move[0], move[1]):
-                moves_to_remove.append(move)
-            elif self.position_contains_ally(move[0], move[1]):
-                moves_to_remove.append(move)
-            # cannot go backwards and can only move sideways if across the river
-            elif self.get_faction() == FACTION_RED:
-                if move[0] < self.get_row():
-                    moves_to_remove.append(move)
-                    # can only move sideways if across the river
-                if self.get_row() < 5 and self.get_column() < move[1] or move[1] < self.get_column():
-                    moves_to_remove.append(move)
-            elif self.get_faction() == FACTION_BLACK:
-                if move[0] > self.get_row():
-                    moves_to_remove.append(move)
-                if self.get_row() >= 5 and self.get_column() < move[1] or move[1] < self.get_column():
-                    moves_to_remove.append(move)
-            index += 1
-        for move in moves_to_remove:
-            potential_moves.remove(move)
+        """Returns a list of potential moves from the move table"""
+        game_board = self._game_board
+        potential_moves = []
+        for row, column, block_row, block_column in PAWN_MOVES[self._faction][self._row * 9 + self._column]:
+            target = game_board[row][column]
+            if target == "" or target.get_faction() != self._faction:
+                potential_moves.append([row, column])
         return potential_moves
 
 
+CODE_CLASSES = {PIECE_GENERAL: General, PIECE_GUARD: Guard, PIECE_ELEPHANT: Elephant, PIECE_HORSE: Horse,
+                PIECE_CHARIOT: Chariot, PIECE_CANNON: Cannon, PIECE_PAWN: Pawn}
+
+
+def mailbox_index(row, column):
+    """returns the index of a board square inside the padded mailbox"""
+    return (row + MAILBOX_PADDING) * MAILBOX_WIDTH + column + MAILBOX_PADDING
+
+
+def piece_code(unit):
+    """returns the signed compact code for a game piece, or PIECE_EMPTY for an empty square"""
+    if unit == "":
+        return PIECE_EMPTY
+    code = TITLE_CODES[unit.get_title()]
+    if unit.get_faction() == FACTION_BLACK:
+        return -code
+    return code
+
+
+class CompactBoard:
+    """Compact board core, a padded mailbox of signed piece codes held in a single array('b') buffer.
+    Red codes are positive, black codes negative, and squares outside the board hold PIECE_OFF_BOARD"""
+    __slots__ = ("_squares",)
+
+    def __init__(self, squares=None):
+        """creates an empty board, or wraps an existing mailbox buffer"""
+        if squares is None:
+            squares = array('b', [PIECE_OFF_BOARD]) * MAILBOX_SIZE
+            for row in range(10):
+                for column in range(9):
+                    squares[mailbox_index(row, column)] = PIECE_EMPTY
+        self._squares = squares
+
+    def __eq__(self, other):
+        return isinstance(other, CompactBoard) and self._squares == other.get_squares()
+
+    def __hash__(self):
+        return hash(self._squares.tobytes())
+
+    def get_squares(self):
+        """returns the underlying mailbox buffer"""
+        return self._squares
+
+    def get_code(self, row, column):
+        """returns the piece code on a board square"""
+        return self._squares[mailbox_index(row, column)]
+
+    def set_code(self, row, column, code):
+        """sets the piece code on a board square"""
+        self._squares[mailbox_index(row, column)] = code
+
+    def copy(self):
+        """returns an independent copy of the board, a single buffer copy"""
+        return CompactBoard(self._squares[:])
+
+    def load_board(self, game_board):
+        """fills the compact board from a 10 x 9 board of game pieces"""
+        for row in range(10):
+            for column in range(9):
+                self.set_code(row, column, piece_code(game_board[row][column]))
+
+    def place_units(self, game_board):
+        """creates a game piece on the 10 x 9 board for every piece code, the adapter back to the object board"""
+        for row in range(10):
+            for column in range(9):
+                code = self.get_code(row, column)
+                if code > 0:
+                    CODE_CLASSES[code](row, column, FACTION_RED, game_board)
+                elif code < 0:
+                    CODE_CLASSES[-code](row, column, FACTION_BLACK, game_board)
+
+
+class MoveResult:
+    """Structured outcome of a move, returned by XiangqiGame.play_move. A result is truthy only when the move was
+    made, so it can stand in for the boolean make_move has always returned"""
+    __slots__ = ("_ok", "_error", "_captured", "_check", "_checkmate", "_stalemate", "_game_state", "_turn")
+
+    def __init__(self, ok, error, captured, check, checkmate, stalemate, game_state, turn):
+        self._ok = ok
+        self._error = error
+        self._captured = captured
+        self._check = check
+        self._checkmate = checkmate
+        self._stalemate = stalemate
+        self._game_state = game_state
+        self._turn = turn
+
+    def __bool__(self):
+        return self._ok
+
+    def __repr__(self):
+        return "MoveResult(ok=" + str(self._ok) + ", error=" + str(self._error) + ", game_state=" + \
+               self._game_state + ", turn=" + self._turn + ")"
+
+    def is_ok(self):
+        """returns true if the move was made"""
+        return self._ok
+
+    def get_error(self):
+        """returns the ERROR_ code of a rejected move, or None"""
+        return self._error
+
+    def get_captured(self):
+        """returns the captured game piece, or None"""
+        return self._captured
+
+    def is_check(self):
+        """returns true if the move put the other general in check"""
+        return self._check
+
+    def is_checkmate(self):
+        """returns true if the move ended the game by checkmate"""
+        return self._checkmate
+
+    def is_stalemate(self):
+        """returns true if the move ended the game by leaving the other side without a move"""
+        return self._stalemate
+
+    def get_game_state(self):
+        """returns the game state after the move"""
+        return self._game_state
+
+    def get_turn(self):
+        """returns the faction to move after the move"""
+        return self._turn
+
+
 class XiangqiGame:
     """Xiangqui game class"""
 
-    def __init__(self):
-        """Initializes the game board"""
+    def __init__(self, compact_board=None, turn=FACTION_RED, engine=ENGINE_OBJECTS, quiet=False):
+        """Initializes the game board, either with the starting setup or from a CompactBoard position. The engine
+        selects how legal moves are screened, ENGINE_OBJECTS uses the game pieces and ENGINE_BITBOARD the
+        XiangqiBitboard engine. A quiet game reports events only to subscribers, never to the console"""
         # 10 rows by 9 columns
         self._game_board = [["", "", "", "", "", "", "", "", ""], ["", "", "", "", "", "", "", "", ""],
                             ["", "", "", "", "", "", "", "", ""], ["", "", "", "", "", "", "", "", ""],
@@ -713,8 +520,163 @@ class XiangqiGame:
                             ["", "", "", "", "", "", "", "", ""], ["", "", "", "", "", "", "", "", ""]]
 
         self._game_state = STATUS_UNFINISHED
-        self._turn = FACTION_RED
-
+        self._turn = turn
+        # plies since the last capture, and the move number which goes up after every black move
+        self._halfmove_clock = 0
+        self._fullmove_number = 1
+        self._quiet = quiet
+        self._subscribers = []
+        # one (from_row, from_column, to_row, to_column, captured, game state, turn, halfmove clock, fullmove
+        # number) record per move played, the state and counters being those from before the move
+        self._history = []
+        # whether each move in the history gave check, and how often each Zobrist key has been reached
+        self._check_history = []
+        self._position_counts = {}
+        self._position_keys = []
+
+        if compact_board is not None:
+            # adapter from the compact core, play continues on ordinary game pieces built from the codes
+            compact_board.place_units(self._game_board)
+            self._compact_board = compact_board.copy()
+        else:
+            self.setup_units()
+            self._compact_board = CompactBoard()
+            self._compact_board.load_board(self._game_board)
+
+        self._engine = engine
+        # screened moves by (Zobrist key, faction) packed as move codes, see screen_moves
+        self._move_cache = {}
+        self._move_cache_size = MOVE_CACHE_SIZE
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self.index_position()
+        self.reset_repetitions()
+
+    def index_position(self):
+        """rebuilds the bitboards, Zobrist key and general lookup from the compact board and units"""
+        self._bitboards = None
+        if self._engine == ENGINE_BITBOARD:
+            # imported here since the bitboard engine builds on the tables of this module
+            from XiangqiBitboard import BitboardPosition
+            self._bitboards = BitboardPosition(self._compact_board)
+
+        self._zobrist_key = self.compute_zobrist_key()
+        self._generals = {}
+        for row in self._game_board:
+            for unit in row:
+                if unit != "" and unit.get_title() == "Gen":
+                    self._generals[unit.get_faction()] = unit
+
+    @classmethod
+    def from_fen(cls, fen, engine=ENGINE_OBJECTS, quiet=False):
+        """returns a game set up from a Xiangqi FEN string, raising ValueError if the string is not valid FEN"""
+        fields = fen.split()
+        if len(fields) == 0:
+            raise ValueError("empty FEN string")
+        ranks = fields[0].split("/")
+        if len(ranks) != 10:
+            raise ValueError("FEN " + fen + " does not have 10 ranks")
+        compact_board = CompactBoard()
+        # the first rank in FEN is black's back rank, row 9
+        row = 9
+        for rank in ranks:
+            column = 0
+            for letter in rank:
+                if letter.isdigit():
+                    column += int(letter)
+                elif letter.lower() in FEN_CODES and column < 9:
+                    code = FEN_CODES[letter.lower()]
+                    if letter.islower():
+                        code = -code
+                    compact_board.set_code(row, column, code)
+                    column += 1
+                else:
+                    raise ValueError("FEN " + fen + " has an invalid rank " + rank)
+            if column != 9:
+                raise ValueError("FEN " + fen + " has an invalid rank " + rank)
+            row -= 1
+
+        turn = FACTION_RED
+        if len(fields) > 1:
+            if fields[1] == "b":
+                turn = FACTION_BLACK
+            elif fields[1] not in ("w", "r"):
+                raise ValueError("FEN " + fen + " has an invalid side to move " + fields[1])
+        game = cls(compact_board, turn, engine, quiet)
+        try:
+            if len(fields) > 4:
+                game._halfmove_clock = int(fields[4])
+            if len(fields) > 5:
+                game._fullmove_number = int(fields[5])
+        except ValueError:
+            raise ValueError("FEN " + fen + " has invalid move counters")
+        return game
+
+    def to_fen(self):
+        """returns the position as a Xiangqi FEN string"""
+        ranks = []
+        row = 9
+        while row >= 0:
+            rank = ""
+            empty = 0
+            for column in range(9):
+                code = self._compact_board.get_code(row, column)
+                if code == PIECE_EMPTY:
+                    empty += 1
+                else:
+                    if empty > 0:
+                        rank += str(empty)
+                        empty = 0
+                    if code > 0:
+                        rank += FEN_LETTERS[code].upper()
+                    else:
+                        rank += FEN_LETTERS[-code]
+            if empty > 0:
+                rank += str(empty)
+            ranks.append(rank)
+            row -= 1
+        if self._turn == FACTION_RED:
+            side = "w"
+        else:
+            side = "b"
+        return "/".join(ranks) + " " + side + " - - " + str(self._halfmove_clock) + " " + str(self._fullmove_number)
+
+    def snapshot(self):
+        """returns the position, turn, game state and move counters as a small tuple that restore can return the
+        game to. The position is the compact board buffer as bytes"""
+        return (self._compact_board.get_squares().tobytes(), self._turn, self._game_state, self._halfmove_clock,
+                self._fullmove_number)
+
+    def restore(self, snapshot):
+        """returns the game to a snapshot. The units are rebuilt from the piece codes, so the move history is
+        cleared and moves played before the snapshot can no longer be undone"""
+        board_bytes, turn, game_state, halfmove_clock, fullmove_number = snapshot
+        squares = array('b')
+        squares.frombytes(board_bytes)
+        # the rows are emptied in place, since the units and callers hold on to the board
+        for row in self._game_board:
+            for column in range(9):
+                row[column] = ""
+        self._compact_board = CompactBoard(squares)
+        self._compact_board.place_units(self._game_board)
+        self._turn = turn
+        self._game_state = game_state
+        self._halfmove_clock = halfmove_clock
+        self._fullmove_number = fullmove_number
+        self._history = []
+        self.index_position()
+        self.reset_repetitions()
+
+    def clone(self):
+        """returns an independent copy of the game built from its compact board, with no subscribers or history"""
+        game = XiangqiGame(self._compact_board, self._turn, self._engine, self._quiet)
+        game._game_state = self._game_state
+        game._halfmove_clock = self._halfmove_clock
+        game._fullmove_number = self._fullmove_number
+        return game
+
+    def setup_units(self):
+        """places every unit on its starting square"""
         # We dont need to save these to a variable, but it helps visualize what we are creating
         red_general = General(0, 4, FACTION_RED, self._game_board)
         black_general = General(9, 4, FACTION_BLACK, self._game_board)
@@ -757,50 +719,102 @@ class XiangqiGame:
         """Returns the current game state"""
         return self._game_state
 
+    def get_turn(self):
+        """Returns the faction to move"""
+        return self._turn
+
+    def get_halfmove_clock(self):
+        """returns the number of moves since the last capture, as in FEN"""
+        return self._halfmove_clock
+
+    def get_fullmove_number(self):
+        """returns the move number, which goes up after every black move, as in FEN"""
+        return self._fullmove_number
+
+    def get_engine(self):
+        """returns the engine screening the moves, ENGINE_OBJECTS or ENGINE_BITBOARD"""
+        return self._engine
+
+    def get_zobrist_key(self):
+        """Returns the 64 bit Zobrist key of the position, including the side to move"""
+        return self._zobrist_key
+
+    def compute_zobrist_key(self):
+        """computes the Zobrist key of the position from scratch, the key is otherwise kept up to date by
+        move_unit and unmove_unit"""
+        zobrist_key = 0
+        for row in range(10):
+            for column in range(9):
+                code = self._compact_board.get_code(row, column)
+                if code != PIECE_EMPTY:
+                    zobrist_key ^= ZOBRIST_PIECES[code][row * 9 + column]
+        if self._turn == FACTION_BLACK:
+            zobrist_key ^= ZOBRIST_BLACK_TO_MOVE
+        return zobrist_key
+
+    def get_compact_board(self):
+        """Returns a copy of the current position as a CompactBoard"""
+        return self._compact_board.copy()
+
     def is_in_check(self, faction):
         """returns true for input 'red' or input 'black' if either faction's general is in check"""
-        general_position = []
         if faction == 'black':
-
-            # find black general's position
-            black_units = self.get_faction_units(FACTION_BLACK)
-            for unit in black_units:
-                if unit.get_title().lower() == "gen":
-                    general_position.append(unit.get_row())
-                    general_position.append(unit.get_column())
-
-            # update screened moves list for red
-            self.screen_moves(self._game_board, FACTION_RED)
-
-            # search screened moves for valid moves that can take the opponent's general
-            red_units = self.get_faction_units(FACTION_RED)
-            for unit in red_units:
-                potential_moves = unit.get_screened_moves()
-                if general_position in potential_moves:
-                    return True
-            return False
-
+            checked_faction = FACTION_BLACK
         elif faction == 'red':
-
-            # find red general's position
-            red_units = self.get_faction_units(FACTION_RED)
-            for unit in red_units:
-                if unit.get_title().lower() == "gen":
-                    general_position.append(unit.get_row())
-                    general_position.append(unit.get_column())
-
-            # update screened moves list for black
-            self.screen_moves(self._game_board, FACTION_BLACK)
-
-            # search screened moves for valid moves that can take the opponent's general
-            black_units = self.get_faction_units(FACTION_BLACK)
-            for unit in black_units:
-                potential_moves = unit.get_screened_moves()
-                if general_position in potential_moves:
-                    return True
-            return False
+            checked_faction = FACTION_RED
         else:
-            print("Invalid input: please enter 'red' or 'black'")
+            self.report(EVENT_ERROR, "Invalid input: please enter 'red' or 'black'")
+            return None
+        if self._bitboards is not None:
+            return self._bitboards.in_check(checked_faction)
+        general = self._generals.get(checked_faction)
+        if general is None:
+            return False
+        return self.is_square_attacked(general.get_row(), general.get_column(), opposing_faction(checked_faction))
+
+    def get_general(self, faction):
+        """returns the general of a faction, or None if the position has none"""
+        return self._generals.get(faction)
+
+    def is_square_attacked(self, row, column, faction):
+        """returns true if a unit of faction could capture on the square. Rather than generating the moves of every
+        unit, this probes outward from the square: the rank and file rays for chariots, cannon screens and the
+        flying general, then the reverse horse, pawn, elephant, guard and general steps"""
+        game_board = self._game_board
+        target = game_board[row][column]
+        targets_general = target != "" and target.get_title() == "Gen"
+        for row_step, column_step in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            probe_row = row + row_step
+            probe_column = column + column_step
+            screened = False
+            while 0 <= probe_row <= 9 and 0 <= probe_column <= 8:
+                unit = game_board[probe_row][probe_column]
+                if unit != "":
+                    if not screened:
+                        if unit.get_faction() == faction:
+                            title = unit.get_title()
+                            if title == "Chr":
+                                return True
+                            # generals only face each other down a file
+                            if title == "Gen" and column_step == 0 and targets_general:
+                                return True
+                        screened = True
+                    else:
+                        if unit.get_faction() == faction and unit.get_title() == "Can":
+                            return True
+                        break
+                probe_row += row_step
+                probe_column += column_step
+
+        square = row * 9 + column
+        for attack_table, title in ((HORSE_ATTACKS, "Hrs"), (PAWN_ATTACKS, "Paw"), (ELEPHANT_ATTACKS, "Ele"),
+                                    (GUARD_ATTACKS, "Grd"), (GENERAL_ATTACKS, "Gen")):
+            for from_row, from_column, block_row, block_column in attack_table[faction][square]:
+                unit = game_board[from_row][from_column]
+                if unit != "" and unit.get_title() == title and unit.get_faction() == faction:
+                    if block_row is None or game_board[block_row][block_column] == "":
+                        return True
+        return False
 
     def get_faction_units(self, faction):
         """returns a list of the units based on faction"""
@@ -830,171 +844,253 @@ class XiangqiGame:
 
     def translate_coord(self, coord):
         """translates a coordinate from algebraic notation to usable list coord format"""
-        letter_key = ["a", "b", "c", "d", "e", "f", "g", "h", "i"]
         coord = coord.strip()
-        if len(coord) > 3 or len(coord) < 2:
-            print("Coordinate " + coord + " invalid. Please try again")
-            return None
-        elif len(coord) == 3 and int(coord[1:3]) > 10 or int(coord[1]) < 1:
-            print("Coordinate " + coord + " invalid. Please try again")
-            return None
-        elif len(coord) == 2 and int(coord[1]) < 1:
-            print("Coordinate " + coord + " invalid. Please try again")
+        match = COORD_PATTERN.fullmatch(coord.lower())
+        if match is None:
+            self.report(EVENT_ERROR, "Coordinate " + coord + " invalid. Please try again")
             return None
         else:
-            column_string = str(coord[0]).lower()
-            try:
-                row_string = ""
-                if len(coord) == 3:
-                    row_string = coord[1:3]
-                else:
-                    row_string = coord[1]
-                row_val = int(row_string) - 1
-            except ValueError:
-                print("Coordinate " + coord + " invalid. Please try again")
-                return None
-            if column_string not in letter_key:
-                print("Coordinate " + coord + " invalid. Please try again")
-                return None
-            else:
-                column_val = letter_key.index(column_string)
-                move = [row_val, column_val]
-                return move
+            row_val = int(match.group(2)) - 1
+            column_val = ord(match.group(1)) - ord("a")
+            move = [row_val, column_val]
+            return move
+
+    def move_unit(self, unit, row, column):
+        """moves a unit on the board without any rule checks, returning the captured unit or "" if the
+        square was empty. Paired with unmove_unit this gives a cheap make/unmake for testing moves"""
+        captured = self._game_board[row][column]
+        from_row = unit.get_row()
+        from_column = unit.get_column()
+        squares = self._compact_board.get_squares()
+        from_index = mailbox_index(from_row, from_column)
+        to_index = mailbox_index(row, column)
+        code = squares[from_index]
+        captured_code = squares[to_index]
+        squares[to_index] = code
+        squares[from_index] = PIECE_EMPTY
+
+        # every move hands the turn over, so the side to move key is always toggled
+        from_square = from_row * 9 + from_column
+        to_square = row * 9 + column
+        zobrist_piece = ZOBRIST_PIECES[code]
+        self._zobrist_key ^= zobrist_piece[from_square] ^ zobrist_piece[to_square] ^ ZOBRIST_BLACK_TO_MOVE
+        if captured_code != PIECE_EMPTY:
+            self._zobrist_key ^= ZOBRIST_PIECES[captured_code][to_square]
+
+        if self._bitboards is not None:
+            self._bitboards.make(from_square * 90 + to_square)
+        self._game_board[from_row][from_column] = ""
+        self._game_board[row][column] = unit
+        unit.set_position(row, column)
+        return captured
+
+    def unmove_unit(self, unit, row, column, captured):
+        """reverts a move_unit call, returning the unit to row, column and restoring the captured unit"""
+        from_row = unit.get_row()
+        from_column = unit.get_column()
+        squares = self._compact_board.get_squares()
+        from_index = mailbox_index(from_row, from_column)
+        code = squares[from_index]
+        captured_code = piece_code(captured)
+        squares[mailbox_index(row, column)] = code
+        squares[from_index] = captured_code
+
+        from_square = from_row * 9 + from_column
+        to_square = row * 9 + column
+        zobrist_piece = ZOBRIST_PIECES[code]
+        self._zobrist_key ^= zobrist_piece[from_square] ^ zobrist_piece[to_square] ^ ZOBRIST_BLACK_TO_MOVE
+        if captured_code != PIECE_EMPTY:
+            self._zobrist_key ^= ZOBRIST_PIECES[captured_code][from_square]
+
+        if self._bitboards is not None:
+            self._bitboards.unmake(to_square * 90 + from_square, captured_code)
+        self._game_board[from_row][from_column] = captured
+        self._game_board[row][column] = unit
+        unit.set_position(row, column)
 
     def screen_moves(self, game_board, faction):
         """scans the game board for higher logic illegal moves for a specific faction,
          such as moves that will cause the player to be in check, or stay in check"""
-        test_board = list(game_board)
-        # create a test board for testing of possible moves without using the real board (for safety)
-        red_units = []
-        black_units = []
-
-        # Testing Red Pieces
-        if faction == FACTION_RED:
-            for row in test_board:
-                for unit in row:
-                    if unit != "":
-                        if unit.get_faction() == FACTION_RED:
-                            red_units.append(unit)
-            general_position = []
-            for unit in red_units:
-                if unit.get_title().lower() == "gen":
-                    general_position.append(unit.get_row())
-                    general_position.append(unit.get_column())
-            # test all possible moves for legality
-            for red_unit in red_units:
-                potential_moves = red_unit.get_potential_moves()
-                screened_moves = list(potential_moves)
-                original_position = [red_unit.get_row(), red_unit.get_column()]
-                for move in potential_moves:
-                    temp_black_piece = test_board[move[0]][move[1]]
-                    red_unit.update_position(move[0], move[1])
-                    if red_unit.get_title().lower() == "gen":
-                        general_position[0] = red_unit.get_row()
-                        general_position[1] = red_unit.get_column()
-                    for row in test_board:
-                        for black_unit in row:
-                            if black_unit != "":
-                                if black_unit.get_faction() == FACTION_BLACK:
-                                    black_units.append(black_unit)
-                    for game_piece in black_units:
-                        moves_list = game_piece.get_potential_moves()
-                        if general_position in moves_list and move in screened_moves:
-                            screened_moves.remove(move)
-                    # reset the board after the test
-                    red_unit.update_position(original_position[0], original_position[1])
-                    if red_unit.get_title().lower() == "gen":
-                        general_position[0] = red_unit.get_row()
-                        general_position[1] = red_unit.get_column()
-                    if temp_black_piece != "":
-                        test_board[move[0]][move[1]] = temp_black_piece
-                # sets the screened moves of each piece based on if that move would put, or leave the general in check
-                self._game_board[original_position[0]][original_position[1]].set_screened_moves(screened_moves)
-
-        # Testing Black Pieces
-        if faction == FACTION_BLACK:
-            for row in test_board:
-                for unit in row:
-                    if unit != "":
-                        if unit.get_faction() == FACTION_BLACK:
-                            black_units.append(unit)
-            general_position = []
-            for unit in black_units:
-                if unit.get_title().lower() == "gen":
-                    general_position.append(unit.get_row())
-                    general_position.append(unit.get_column())
-            # test all possible moves for legality
-            for black_unit in black_units:
-                potential_moves = black_unit.get_potential_moves()
-                screened_moves = list(potential_moves)
-                original_position = [black_unit.get_row(), black_unit.get_column()]
-                for move in potential_moves:
-                    temp_red_piece = test_board[move[0]][move[1]]
-                    black_unit.update_position(move[0], move[1])
-                    if black_unit.get_title().lower() == "gen":
-                        general_position[0] = black_unit.get_row()
-                        general_position[1] = black_unit.get_column()
-                    for row in test_board:
-                        for red_unit in row:
-                            if red_unit != "":
-                                if red_unit.get_faction() == FACTION_RED:
-                                    red_units.append(red_unit)
-                    for game_piece in red_units:
-                        moves_list = game_piece.get_potential_moves()
-                        if general_position in moves_list and move in screened_moves:
-                            screened_moves.remove(move)
-                    # reset the board after the test
-                    black_unit.update_position(original_position[0], original_position[1])
-                    if black_unit.get_title().lower() == "gen":
-                        general_position[0] = black_unit.get_row()
-                        general_position[1] = black_unit.get_column()
-                    if temp_red_piece != "":
-                        test_board[move[0]][move[1]] = temp_red_piece
-                # sets the screened moves of each piece based on if that move would put, or leave the general in check
-                self._game_board[original_position[0]][original_position[1]].set_screened_moves(screened_moves)
+        # game_board is kept for compatibility
+        screened_moves = self.get_screened_move_map(faction)
+        # sets the screened moves of each piece based on if that move would put, or leave the general in check
+        for unit in self.get_faction_units(faction):
+            unit.set_screened_moves(screened_moves.get(unit.get_row() * 9 + unit.get_column(), []))
+
+    def get_screened_move_map(self, faction):
+        """returns the legal moves of a faction keyed by the row * 9 + column square they start from. The map of a
+        position is cached by its Zobrist key, so a position is only screened again once the board has changed"""
+        cache_key = (self._zobrist_key, faction)
+        move_codes = self._move_cache.get(cache_key)
+        if move_codes is not None:
+            self._cache_hits += 1
+            return unpack_move_map(move_codes)
+        self._cache_misses += 1
+        if self._bitboards is not None:
+            screened_moves = self.screen_bitboard_moves(faction)
+        else:
+            screened_moves = self.screen_unit_moves(faction)
+        if self._move_cache_size > 0:
+            while len(self._move_cache) >= self._move_cache_size:
+                # dictionaries keep insertion order, so the oldest position is dropped first
+                del self._move_cache[next(iter(self._move_cache))]
+            self._move_cache[cache_key] = pack_move_map(screened_moves)
+        return screened_moves
+
+    def screen_unit_moves(self, faction):
+        """returns the legal moves of a faction by square, testing every potential move of its units with a
+        make/unmake on the real board"""
+        enemy_faction = opposing_faction(faction)
+        general = self._generals.get(faction)
+        screened_moves = {}
+        for unit in self.get_faction_units(faction):
+            original_row = unit.get_row()
+            original_column = unit.get_column()
+            unit_moves = []
+            for move in unit.get_potential_moves():
+                captured = self.move_unit(unit, move[0], move[1])
+                # only the general's own square needs probing after each trial move
+                if general is None or not self.is_square_attacked(general.get_row(), general.get_column(),
+                                                                  enemy_faction):
+                    unit_moves.append(move)
+                self.unmove_unit(unit, original_row, original_column, captured)
+            screened_moves[original_row * 9 + original_column] = unit_moves
+        return screened_moves
+
+    def get_move_cache_stats(self):
+        """returns the hits, misses and number of positions held by the screened move cache"""
+        return {"hits": self._cache_hits, "misses": self._cache_misses, "size": len(self._move_cache)}
+
+    def get_move_cache_size(self):
+        """returns the most (position, faction) entries the screened move cache holds"""
+        return self._move_cache_size
+
+    def set_move_cache_size(self, size):
+        """sets the most (position, faction) entries the screened move cache holds, dropping the oldest entries
+        over the new size. A size of 0 turns the cache off"""
+        if size < 0:
+            raise ValueError("the move cache size cannot be negative")
+        self._move_cache_size = size
+        while len(self._move_cache) > size:
+            del self._move_cache[next(iter(self._move_cache))]
+
+    def clear_move_cache(self):
+        """empties the screened move cache and resets its counters"""
+        self._move_cache = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    def get_legal_moves(self, faction, captures_only=False):
+        """returns the legal moves of a faction as (from_row, from_column, to_row, to_column) tuples, or only the
+        legal captures"""
+        legal_moves = []
+        if self._bitboards is not None:
+            for move in self._bitboards.generate_legal_moves(faction, captures_only):
+                from_square, to_square = divmod(move, 90)
+                legal_moves.append((from_square // 9, from_square % 9, to_square // 9, to_square % 9))
+            return legal_moves
+        for square, moves in self.get_screened_move_map(faction).items():
+            from_row = square // 9
+            from_column = square % 9
+            for move in moves:
+                if not captures_only or self._game_board[move[0]][move[1]] != "":
+                    legal_moves.append((from_row, from_column, move[0], move[1]))
+        return legal_moves
+
+    def perft(self, depth):
+        """returns the number of leaf nodes of the legal move tree depth plies below the current position,
+        the standard correctness and speed check for a move generator"""
+        return self.count_leaves(self._turn, depth)
+
+    def divide(self, depth):
+        """returns the perft leaf counts split by root move, keyed by move strings like 'h3-e3'"""
+        counts = {}
+        for from_row, from_column, to_row, to_column in self.get_legal_moves(self._turn):
+            unit = self._game_board[from_row][from_column]
+            captured = self.move_unit(unit, to_row, to_column)
+            move_string = coord_to_string(from_row, from_column) + "-" + coord_to_string(to_row, to_column)
+            counts[move_string] = self.count_leaves(opposing_faction(self._turn), depth - 1)
+            self.unmove_unit(unit, from_row, from_column, captured)
+        return counts
+
+    def count_leaves(self, faction, depth):
+        """counts the leaf nodes depth plies below the current position with faction to move"""
+        if depth == 0:
+            return 1
+        legal_moves = self.get_legal_moves(faction)
+        if depth == 1:
+            return len(legal_moves)
+        enemy_faction = opposing_faction(faction)
+        nodes = 0
+        for from_row, from_column, to_row, to_column in legal_moves:
+            unit = self._game_board[from_row][from_column]
+            captured = self.move_unit(unit, to_row, to_column)
+            nodes += self.count_leaves(enemy_faction, depth - 1)
+            self.unmove_unit(unit, from_row, from_column, captured)
+        return nodes
+
+    def screen_bitboard_moves(self, faction):
+        """returns the legal moves of a faction by square, screened with the bitboard engine"""
+        screened_moves = {}
+        for move in self._bitboards.generate_legal_moves(faction):
+            from_square, to_square = divmod(move, 90)
+            screened_moves.setdefault(from_square, []).append([to_square // 9, to_square % 9])
+        return screened_moves
 
     def make_move(self, starting_string, move_to_string):
         """Updates the gameplay and moves the game pieces by using 2 input strings as coordinates, the first string is
-         the starting position of the unit, the last string is the desired position"""
+         the starting position of the unit, the last string is the desired position. Returns True or False, callers
+         that need to know why a move was rejected use play_move"""
+        return self.play_move(starting_string, move_to_string).is_ok()
+
+    def play_move(self, starting_string, move_to_string):
+        """makes a move like make_move and returns a MoveResult describing the outcome"""
         starting_move = self.translate_coord(starting_string)
         finishing_move = self.translate_coord(move_to_string)
 
-        # screen moves to ensure potential moves don't cause a check, or to find out if the game is
-        # checkmate or a stalemate
-        self.screen_moves(self._game_board, FACTION_RED)
-        self.screen_moves(self._game_board, FACTION_BLACK)
-
         # check for invalid input
         if starting_move is None or finishing_move is None:
-            print("invalid starting or ending coordinate")
-            return False
+            return self.reject(ERROR_INVALID_COORDINATE, "invalid starting or ending coordinate")
         elif self._game_board[starting_move[0]][starting_move[1]] == "":
-            print("No unit detected")
-            return False
+            return self.reject(ERROR_NO_UNIT, "No unit detected")
         elif self._game_board[starting_move[0]][starting_move[1]].get_faction() != self._turn:
-            print("Error: it is not that player's turn, please select another unit")
-            return False
+            return self.reject(ERROR_WRONG_TURN, "Error: it is not that player's turn, please select another unit")
         elif self._game_state != STATUS_UNFINISHED:
-            print("Error: This game has been completed")
-            return False
+            return self.reject(ERROR_GAME_OVER, "Error: This game has been completed")
 
         # else, make sure that the move is achievable by that unit, and if so, update the position
         else:
+            # only the side to move is screened, so that potential moves don't cause a check. The screen after
+            # the move finds check, checkmate or stalemate for the other side and leaves its moves in the cache
+            self.screen_moves(self._game_board, self._turn)
             selected_unit = self._game_board[starting_move[0]][starting_move[1]]
             selected_faction = selected_unit.get_faction()
             if finishing_move not in selected_unit.get_screened_moves():
-                print("Error: that move is not valid, check your move and/or ensure your"
-                      " general is not in check after this move")
-                return False
+                return self.reject(ERROR_ILLEGAL_MOVE, "Error: that move is not valid, check your move and/or ensure "
+                                                       "your general is not in check after this move")
             else:
-                selected_unit.update_position(finishing_move[0], finishing_move[1])
-                self._game_board[starting_move[0]][starting_move[1]] = ""
+                captured = self.move_unit(selected_unit, finishing_move[0], finishing_move[1])
+                self._history.append((starting_move[0], starting_move[1], finishing_move[0], finishing_move[1],
+                                      captured, self._game_state, self._turn, self._halfmove_clock,
+                                      self._fullmove_number))
+                if captured == "":
+                    self._halfmove_clock += 1
+                else:
+                    self._halfmove_clock = 0
+                if selected_faction == FACTION_BLACK:
+                    self._fullmove_number += 1
+                self.notify(EVENT_MOVE, coord_to_string(starting_move[0], starting_move[1]) + "-" +
+                            coord_to_string(finishing_move[0], finishing_move[1]))
+                check = False
+                checkmate = False
+                stalemate = False
 
                 # Update the players turn & scan for check, checkmate, or stalemate conditions
                 if selected_faction == FACTION_RED:
                     self._turn = FACTION_BLACK
                     if self.is_in_check('black'):
-                        print("Black is in check")
+                        check = True
+                        self.report(EVENT_CHECK, "Black is in check")
                         self.screen_moves(self._game_board, FACTION_BLACK)
                         black_units = self.get_faction_units(FACTION_BLACK)
                         black_moves = self.get_screened_moves_list(black_units)
@@ -1003,10 +1099,11 @@ class XiangqiGame:
                             if len(item) > 0:
                                 available_moves += 1
                         if available_moves == 0:
-                            print("Checkmate! Red Wins")
+                            checkmate = True
+                            self.report(EVENT_CHECKMATE, "Checkmate! Red Wins")
                             self._game_state = STATUS_RED_WINS
                         else:
-                            print("Black's Turn!")
+                            self.report(EVENT_TURN, "Black's Turn!")
                     else:
                         self.screen_moves(self._game_board, FACTION_BLACK)
                         black_units = self.get_faction_units(FACTION_BLACK)
@@ -1016,15 +1113,17 @@ class XiangqiGame:
                             if len(item) > 0:
                                 available_moves += 1
                         if available_moves == 0:
-                            print("Stalemate! Red Wins")
+                            stalemate = True
+                            self.report(EVENT_STALEMATE, "Stalemate! Red Wins")
                             self._game_state = STATUS_RED_WINS
                         else:
-                            print("Black's Turn!")
+                            self.report(EVENT_TURN, "Black's Turn!")
 
                 else:
                     self._turn = FACTION_RED
                     if self.is_in_check('red'):
-                        print("red is in check")
+                        check = True
+                        self.report(EVENT_CHECK, "red is in check")
                         self.screen_moves(self._game_board, FACTION_RED)
                         red_units = self.get_faction_units(FACTION_RED)
                         red_moves = self.get_screened_moves_list(red_units)
@@ -1033,10 +1132,11 @@ class XiangqiGame:
                             if len(item) > 0:
                                 available_moves += 1
                         if available_moves == 0:
-                            print("Checkmate! Black Wins")
+                            checkmate = True
+                            self.report(EVENT_CHECKMATE, "Checkmate! Black Wins")
                             self._game_state = STATUS_BLACK_WINS
                         else:
-                            print("Red's Turn!")
+                            self.report(EVENT_TURN, "Red's Turn!")
                     else:
                         self.screen_moves(self._game_board, FACTION_RED)
                         red_units = self.get_faction_units(FACTION_RED)
@@ -1046,11 +1146,208 @@ class XiangqiGame:
                             if len(item) > 0:
                                 available_moves += 1
                         if available_moves == 0:
-                            print("Stalemate! Black Wins")
+                            stalemate = True
+                            self.report(EVENT_STALEMATE, "Stalemate! Black Wins")
                             self._game_state = STATUS_BLACK_WINS
                         else:
-                            print("Red's Turn!")
-                return True
+                            self.report(EVENT_TURN, "Red's Turn!")
+                self._check_history.append(check)
+                self.count_position()
+                if self._game_state == STATUS_UNFINISHED and \
+                        self._position_counts[self._zobrist_key] >= REPETITION_LIMIT:
+                    self.adjudicate_repetition()
+                if captured == "":
+                    captured = None
+                return MoveResult(True, None, captured, check, checkmate, stalemate, self._game_state, self._turn)
+
+    def undo_move(self):
+        """takes back the last move played, restoring the captured unit, turn, game state and move counters.
+        Returns false if no move has been played"""
+        if len(self._history) == 0:
+            return False
+        from_row, from_column, to_row, to_column, captured, game_state, turn, halfmove_clock, fullmove_number = \
+            self._history.pop()
+        self._check_history.pop()
+        self.uncount_position()
+        self.unmove_unit(self._game_board[to_row][to_column], from_row, from_column, captured)
+        self._game_state = game_state
+        self._turn = turn
+        self._halfmove_clock = halfmove_clock
+        self._fullmove_number = fullmove_number
+        self.notify(EVENT_UNDO, coord_to_string(from_row, from_column) + "-" + coord_to_string(to_row, to_column))
+        return True
+
+    def reset_repetitions(self):
+        """starts the repetition history afresh from the current position"""
+        self._check_history = [False] * len(self._history)
+        self._position_counts = {self._zobrist_key: 1}
+        self._position_keys = [self._zobrist_key]
+
+    def count_position(self):
+        """adds the current position to the repetition history"""
+        self._position_counts[self._zobrist_key] = self._position_counts.get(self._zobrist_key, 0) + 1
+        self._position_keys.append(self._zobrist_key)
+
+    def uncount_position(self):
+        """removes the current position from the repetition history, the reverse of count_position"""
+        zobrist_key = self._position_keys.pop()
+        if self._position_counts[zobrist_key] == 1:
+            del self._position_counts[zobrist_key]
+        else:
+            self._position_counts[zobrist_key] -= 1
+
+    def get_repetition_count(self):
+        """returns how many times the current position, with the same side to move, has been reached"""
+        return self._position_counts.get(self._zobrist_key, 0)
+
+    def adjudicate_repetition(self):
+        """ends the game when the current position has been repeated REPETITION_LIMIT times. Following the Asian
+        rules a side that gave check with every move since the position first appeared loses, unless both did.
+        Otherwise a side that chased with every move loses, unless both did, and anything else is a draw"""
+        first_ply = self._position_keys.index(self._zobrist_key)
+        plies = len(self._position_keys) - 1 - first_ply
+        # the last move was made by the side not to move now, its moves are every other ply counting back
+        last_mover = opposing_faction(self._turn)
+        checks = {last_mover: [], self._turn: []}
+        for ply in range(plies):
+            faction = last_mover if ply % 2 == 0 else self._turn
+            checks[faction].append(self._check_history[len(self._check_history) - 1 - ply])
+        perpetual_checks = dict((faction, len(flags) > 0 and all(flags)) for faction, flags in checks.items())
+        if perpetual_checks[FACTION_RED] != perpetual_checks[FACTION_BLACK]:
+            loser = FACTION_RED if perpetual_checks[FACTION_RED] else FACTION_BLACK
+            self.end_by_repetition(loser, EVENT_PERPETUAL_CHECK, "Perpetual check!")
+            return
+        if not perpetual_checks[FACTION_RED]:
+            chases = self.get_chases(plies)
+            perpetual_chases = dict((faction, len(flags) > 0 and all(flags)) for faction, flags in chases.items())
+            if perpetual_chases[FACTION_RED] != perpetual_chases[FACTION_BLACK]:
+                loser = FACTION_RED if perpetual_chases[FACTION_RED] else FACTION_BLACK
+                self.end_by_repetition(loser, EVENT_PERPETUAL_CHASE, "Perpetual chase!")
+                return
+        self._game_state = STATUS_DRAW
+        self.report(EVENT_REPETITION, "Repetition! The game is drawn")
+
+    def end_by_repetition(self, loser, event, message):
+        """ends the game as a loss for the side that forced a repetition"""
+        if loser == FACTION_RED:
+            self._game_state = STATUS_BLACK_WINS
+            self.report(event, message + " Black Wins")
+        else:
+            self._game_state = STATUS_RED_WINS
+            self.report(event, message + " Red Wins")
+
+    def get_chases(self, plies):
+        """returns a dictionary mapping each faction to whether each of its last moves, within the last plies
+        plies, was a chase. The moves are taken back with unmove_unit and made again to see the position before
+        each one"""
+        records = self._history[len(self._history) - plies:]
+        for from_row, from_column, to_row, to_column, captured, game_state, turn, halfmove, fullmove in \
+                reversed(records):
+            self.unmove_unit(self._game_board[to_row][to_column], from_row, from_column, captured)
+        chases = {FACTION_RED: [], FACTION_BLACK: []}
+        for from_row, from_column, to_row, to_column, captured, game_state, turn, halfmove, fullmove in records:
+            before = self.get_chased_units(turn)
+            self.move_unit(self._game_board[from_row][from_column], to_row, to_column)
+            after = self.get_chased_units(turn)
+            chases[turn].append(len(after - before) > 0)
+        return chases
+
+    def get_chased_units(self, faction):
+        """returns the set of enemy units the faction chases: units other than the general and pawns still on
+        their own side that a chariot, horse, cannon, elephant or guard of the faction can legally capture, and
+        that are unprotected or are a chariot attacked by a horse or cannon. Generals and pawns may chase freely"""
+        enemy_faction = opposing_faction(faction)
+        general = self._generals.get(faction)
+        chased = set()
+        for unit in self.get_faction_units(faction):
+            title = unit.get_title()
+            if title == "Gen" or title == "Paw":
+                continue
+            from_row = unit.get_row()
+            from_column = unit.get_column()
+            for row, column in unit.get_potential_moves():
+                target = self._game_board[row][column]
+                if target == "" or target in chased:
+                    continue
+                target_title = target.get_title()
+                if target_title == "Gen" or (target_title == "Paw" and on_own_side(row, enemy_faction)):
+                    continue
+                captured = self.move_unit(unit, row, column)
+                legal = general is None or not self.is_square_attacked(general.get_row(), general.get_column(),
+                                                                       enemy_faction)
+                # after the capture, the enemy recapturing on the square means the target was protected
+                protected = self.is_square_attacked(row, column, enemy_faction)
+                self.unmove_unit(unit, from_row, from_column, captured)
+                if legal and (not protected or (target_title == "Chr" and title in ("Hrs", "Can"))):
+                    chased.add(target)
+        return chased
+
+    def get_move_history(self):
+        """returns the moves played so far as strings like 'h3-e3'"""
+        return [coord_to_string(record[0], record[1]) + "-" + coord_to_string(record[2], record[3])
+                for record in self._history]
+
+    def reject(self, error, message):
+        """reports a rejected move and returns its MoveResult"""
+        self.report(EVENT_ERROR, message)
+        return MoveResult(False, error, None, False, False, False, self._game_state, self._turn)
+
+    def report(self, event, message):
+        """prints a message unless the game is quiet, and passes the event to every subscriber"""
+        if not self._quiet:
+            print(message)
+        self.notify(event, message)
+
+    def notify(self, event, message):
+        """passes an event to every subscriber without printing it"""
+        for callback in self._subscribers:
+            callback(event, message)
+
+    def subscribe(self, callback):
+        """registers callback(event, message) to be called for every game event, such as EVENT_MOVE or EVENT_CHECK"""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """removes a callback registered with subscribe"""
+        self._subscribers.remove(callback)
+
+    def set_quiet(self, quiet):
+        """turns console output on or off, a quiet game reports events only to subscribers"""
+        self._quiet = quiet
+
+    def is_quiet(self):
+        """Returns true if the game does not print to the console"""
+        return self._quiet
+
+
+def pack_move_map(screened_moves):
+    """returns a map of legal moves by square packed into an array of from * 90 + to move codes"""
+    move_codes = array("H")
+    for square, moves in screened_moves.items():
+        for move in moves:
+            move_codes.append(square * 90 + move[0] * 9 + move[1])
+    return move_codes
+
+
+def unpack_move_map(move_codes):
+    """returns the map of legal moves by square held in an array of packed move codes"""
+    screened_moves = {}
+    for code in move_codes:
+        from_square, to_square = divmod(code, 90)
+        screened_moves.setdefault(from_square, []).append([to_square // 9, to_square % 9])
+    return screened_moves
+
+
+def opposing_faction(faction):
+    """returns the other faction"""
+    if faction == FACTION_RED:
+        return FACTION_BLACK
+    return FACTION_RED
+
+
+def coord_to_string(row, column):
+    """translates a usable row, column coord back to algebraic notation, the reverse of translate_coord"""
+    return "abcdefghi"[column] + str(row + 1)
 
 
 def print_board(game_board):
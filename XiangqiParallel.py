@@ -0,0 +1,148 @@
+# Description: Root split perft and search for the XiangQi game across worker processes. The legal moves of the root
+# position are divided among a multiprocessing pool and every worker rebuilds the position from its FEN, a short
+# string, rather than unpickling a graph of game pieces. Subtree results are merged and reported together with the
+# time each worker process spent. Run with: python XiangqiParallel.py --depth 4 --workers 8
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+from XiangqiGame import XiangqiGame, ENGINE_OBJECTS, ENGINE_BITBOARD, START_FEN, opposing_faction, coord_to_string
+from XiangqiSearch import Searcher, DEFAULT_DEPTH
+
+
+def move_string(move):
+    """returns a (from_row, from_column, to_row, to_column) move as a string like 'h3-e3'"""
+    return coord_to_string(move[0], move[1]) + "-" + coord_to_string(move[2], move[3])
+
+
+def divide_task(task):
+    """worker entry point, counts the perft leaf nodes below one root move of a FEN position"""
+    fen, engine, move, depth = task
+    start = time.perf_counter()
+    game = XiangqiGame.from_fen(fen, engine, True)
+    from_row, from_column, to_row, to_column = move
+    unit = game.get_board()[from_row][from_column]
+    game.move_unit(unit, to_row, to_column)
+    nodes = game.count_leaves(opposing_faction(game.get_turn()), depth - 1)
+    return {"move": move_string(move), "nodes": nodes, "seconds": time.perf_counter() - start,
+            "worker": os.getpid()}
+
+
+def search_task(task):
+    """worker entry point, scores one root move of a FEN position against the best score already known"""
+    fen, engine, move, depth, alpha = task
+    start = time.perf_counter()
+    searcher = Searcher(XiangqiGame.from_fen(fen, engine, True))
+    score = searcher.score_move(move, depth, alpha)
+    return {"move": move_string(move), "score": score, "nodes": searcher.get_info()["nodes"],
+            "seconds": time.perf_counter() - start, "worker": os.getpid()}
+
+
+def run_tasks(function, tasks, workers):
+    """runs tasks through function on a pool of workers, in this process for a single worker, and returns the
+    results in task order"""
+    if workers <= 1:
+        return [function(task) for task in tasks]
+    with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+        # one task at a time, root subtrees vary too much in size for chunks to balance
+        return pool.map(function, tasks, 1)
+
+
+def worker_timings(results):
+    """returns the number of root moves and the seconds spent by each worker process"""
+    timings = {}
+    for result in results:
+        timing = timings.setdefault(result["worker"], {"worker": result["worker"], "moves": 0, "seconds": 0})
+        timing["moves"] += 1
+        timing["seconds"] += result["seconds"]
+    for timing in timings.values():
+        timing["seconds"] = round(timing["seconds"], 6)
+    return sorted(timings.values(), key=lambda timing: timing["worker"])
+
+
+def parallel_divide(game, depth, workers=None):
+    """returns the perft of a game split by root move across workers, as a dictionary with the total nodes, the
+    counts by move like divide and the per worker timings"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    start = time.perf_counter()
+    fen = game.to_fen()
+    tasks = [(fen, game.get_engine(), move, depth) for move in game.get_legal_moves(game.get_turn())]
+    if depth <= 0 or len(tasks) == 0:
+        nodes = 1 if depth <= 0 else 0
+        return {"depth": depth, "nodes": nodes, "divide": {}, "seconds": 0, "workers": []}
+    results = run_tasks(divide_task, tasks, workers)
+    return {"depth": depth, "nodes": sum(result["nodes"] for result in results),
+            "divide": dict((result["move"], result["nodes"]) for result in results),
+            "seconds": round(time.perf_counter() - start, 6), "workers": worker_timings(results)}
+
+
+def parallel_perft(game, depth, workers=None):
+    """returns the number of leaf nodes depth plies below a game position, counted across workers"""
+    return parallel_divide(game, depth, workers)["nodes"]
+
+
+def parallel_search(game, depth=DEFAULT_DEPTH, workers=None):
+    """searches a game to a fixed depth with the root moves split across workers and returns a dictionary with the
+    best move as a (from, to) pair of coordinate strings, its score, the nodes searched and per worker timings.
+    The best move of a search one ply shallower is searched here first to set a bound, then the rest are searched
+    in parallel against it so the workers still get alpha-beta cutoffs"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    start = time.perf_counter()
+    searcher = Searcher(game)
+    root_moves = searcher.order_moves(game.get_legal_moves(game.get_turn()), None)
+    if len(root_moves) == 0:
+        return {"depth": depth, "move": None, "score": None, "nodes": 0, "seconds": 0, "workers": []}
+    first_move = root_moves[0]
+    nodes = 0
+    if depth > 1:
+        # a shallower serial search picks the first move, a good first bound is what lets the workers cut off
+        first_strings = searcher.best_move(depth=depth - 1)
+        nodes += searcher.get_info()["nodes"]
+        for move in root_moves:
+            if searcher.move_strings(move) == first_strings:
+                first_move = move
+        root_moves.remove(first_move)
+        root_moves.insert(0, first_move)
+    alpha = searcher.score_move(first_move, depth)
+    nodes += searcher.get_info()["nodes"]
+    best_move = first_move
+
+    fen = game.to_fen()
+    tasks = [(fen, game.get_engine(), move, depth, alpha) for move in root_moves[1:]]
+    results = run_tasks(search_task, tasks, workers)
+    for move, result in zip(root_moves[1:], results):
+        nodes += result["nodes"]
+        # a score of alpha or less is only a bound, so ties keep the earlier move
+        if result["score"] > alpha:
+            alpha = result["score"]
+            best_move = move
+    return {"depth": depth, "move": searcher.move_strings(best_move), "score": alpha, "nodes": nodes,
+            "seconds": round(time.perf_counter() - start, 6), "workers": worker_timings(results)}
+
+
+def main():
+    """command line entry point, prints a JSON report of a parallel perft or search"""
+    parser = argparse.ArgumentParser(description="XiangQi root split perft and search")
+    parser.add_argument("--fen", default=START_FEN)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the core count")
+    parser.add_argument("--engine", choices=[ENGINE_OBJECTS, ENGINE_BITBOARD], default=ENGINE_BITBOARD)
+    parser.add_argument("--search", action="store_true", help="search for the best move instead of running perft")
+    arguments = parser.parse_args()
+
+    game = XiangqiGame.from_fen(arguments.fen, arguments.engine, True)
+    if arguments.search:
+        report = parallel_search(game, arguments.depth, arguments.workers)
+    else:
+        report = parallel_divide(game, arguments.depth, arguments.workers)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
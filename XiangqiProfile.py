@@ -0,0 +1,245 @@
+# Description: Opt-in hot path instrumentation for the XiangQi game. Enabling it swaps timing wrappers onto the classes
+# for get_potential_moves of every piece class, the legal move screens, is_in_check and moves made, and disabling it
+# puts the original functions back, so a game that is not being profiled runs exactly the code it always has. The
+# counters hold calls, total and longest wall time and, where a call has them, the candidate moves generated and the
+# legal moves kept, read with stats() or dumped as JSON lines every few seconds. Run with:
+# python XiangqiProfile.py --games 10 --engine OBJECTS
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+from XiangqiGame import XiangqiGame, ENGINE_OBJECTS, ENGINE_BITBOARD, CODE_CLASSES
+from XiangqiSelfPlay import play_game, POLICY_RANDOM
+
+DEFAULT_DUMP_INTERVAL = 10.0
+
+
+class Profiler:
+    """Call counters for the move generation hot paths, collected only while enabled"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = {}
+        # (class, attribute name, original function) of every wrapped method while enabled
+        self._originals = []
+        self._dump_thread = None
+        self._dump_stop = None
+
+    def is_enabled(self):
+        """returns true while the wrappers are installed"""
+        return len(self._originals) > 0
+
+    def enable(self):
+        """installs the wrappers, they count calls made on every game and piece from now on"""
+        if self.is_enabled():
+            return
+        for piece_class in CODE_CLASSES.values():
+            self.wrap(piece_class, "get_potential_moves", "get_potential_moves." + piece_class.__name__,
+                      self.count_potential_moves)
+        self.wrap(XiangqiGame, "screen_moves", None, self.count_screen_moves)
+        # get_legal_moves, perft and the search ask for the screened moves directly, screen_moves is only used by
+        # moves made. The screens below are the cache misses of get_screened_move_map
+        self.wrap(XiangqiGame, "get_screened_move_map", None, self.count_cached_move_map)
+        self.wrap(XiangqiGame, "screen_unit_moves", None, self.count_move_map)
+        self.wrap(XiangqiGame, "screen_bitboard_moves", None, self.count_move_map)
+        self.wrap(XiangqiGame, "is_in_check", "is_in_check", None)
+        # make_move goes through play_move, so wrapping play_move counts moves made either way
+        self.wrap(XiangqiGame, "play_move", "make_move", self.count_move)
+
+    def disable(self):
+        """puts the original functions back, the counters are kept until reset"""
+        for owner, name, function in reversed(self._originals):
+            setattr(owner, name, function)
+        self._originals = []
+
+    def reset(self):
+        """clears the counters"""
+        with self._lock:
+            self._counters = {}
+
+    def wrap(self, owner, name, key, counter):
+        """replaces owner.name with a timing wrapper recording under key. A key of None names the record after the
+        faction argument, and counter(result, args, candidates) returns the (generated, kept) moves of a call,
+        either of which is None when the call has no such count"""
+        function = owner.__dict__[name]
+        profiler = self
+        local = self._local
+
+        def wrapper(*args):
+            candidates = getattr(local, "candidates", 0)
+            start = time.perf_counter()
+            result = function(*args)
+            seconds = time.perf_counter() - start
+            generated = kept = None
+            if counter is not None:
+                generated, kept = counter(result, args, getattr(local, "candidates", 0) - candidates)
+            profiler.record(key if key is not None else name + "." + str(args[-1]), seconds, generated, kept)
+            return result
+
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        self._originals.append((owner, name, function))
+        setattr(owner, name, wrapper)
+
+    def count_potential_moves(self, result, args, candidates):
+        """counts the moves of a piece as generated, and as candidates for the screen that asked for them. Pieces
+        do not screen their own moves, so nothing is counted as kept"""
+        self._local.candidates = getattr(self._local, "candidates", 0) + len(result)
+        return len(result), None
+
+    def count_screen_moves(self, result, args, candidates):
+        """returns the candidates generated during a screen and the moves the screen handed to the faction's
+        units. A screen answered from the move cache, or by the bitboard engine, generates no piece moves and is
+        only timed"""
+        if candidates == 0:
+            return None, None
+        game, game_board, faction = args
+        kept = 0
+        for unit in game.get_faction_units(faction):
+            kept += len(unit.get_screened_moves())
+        return candidates, kept
+
+    def count_move_map(self, result, args, candidates):
+        """returns the candidates generated for a map of legal moves by square and the legal moves in it. The
+        bitboard engine generates no piece moves, so its screens only count the moves kept"""
+        kept = 0
+        for moves in result.values():
+            kept += len(moves)
+        return candidates if candidates > 0 else None, kept
+
+    def count_cached_move_map(self, result, args, candidates):
+        """counts a map of legal moves like count_move_map when it was screened from piece moves. A map answered from
+        the move cache, or by the bitboard engine, is only timed"""
+        if candidates == 0:
+            return None, None
+        return self.count_move_map(result, args, candidates)
+
+    def count_move(self, result, args, candidates):
+        """counts a move made as kept, a rejected one only as generated"""
+        return 1, 1 if result.is_ok() else 0
+
+    def record(self, key, seconds, generated, kept):
+        """adds one call to the counters of key"""
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = [0, 0.0, 0.0, None, None]
+            counter[0] += 1
+            counter[1] += seconds
+            if seconds > counter[2]:
+                counter[2] = seconds
+            if generated is not None:
+                counter[3] = (counter[3] or 0) + generated
+            if kept is not None:
+                counter[4] = (counter[4] or 0) + kept
+
+    def stats(self):
+        """returns the counters as a dictionary keyed by call path, the most time consuming first, each with its
+        calls, total, mean and max seconds and the moves generated and kept by the calls that count them"""
+        with self._lock:
+            counters = sorted(self._counters.items(), key=lambda item: item[1][1], reverse=True)
+        report = {}
+        for key, (calls, seconds, max_seconds, generated, kept) in counters:
+            report[key] = {"calls": calls, "seconds": round(seconds, 6),
+                           "mean_us": round(1000000 * seconds / calls, 3), "max_us": round(1000000 * max_seconds, 3)}
+            if generated is not None:
+                report[key]["generated"] = generated
+            if kept is not None:
+                report[key]["kept"] = kept
+        return report
+
+    def start_dump(self, path=None, interval=DEFAULT_DUMP_INTERVAL):
+        """starts a daemon thread appending the stats as a JSON line every interval seconds to the file at path, or
+        to standard error"""
+        self.stop_dump()
+        self._dump_stop = threading.Event()
+        self._dump_thread = threading.Thread(target=self.dump_loop, args=(path, interval, self._dump_stop),
+                                             name="xiangqi-profile", daemon=True)
+        self._dump_thread.start()
+
+    def stop_dump(self):
+        """stops the dump thread, writing one last dump"""
+        if self._dump_thread is not None:
+            self._dump_stop.set()
+            self._dump_thread.join()
+            self._dump_thread = None
+
+    def dump_loop(self, path, interval, stop):
+        """dump thread body, runs until stop is set"""
+        while True:
+            stopping = stop.wait(interval)
+            line = json.dumps({"time": round(time.time(), 3), "stats": self.stats()})
+            if path is None:
+                print(line, file=sys.stderr, flush=True)
+            else:
+                with open(path, "a") as dump_file:
+                    dump_file.write(line + "\n")
+            if stopping:
+                return
+
+
+PROFILER = Profiler()
+
+
+def enable():
+    """installs the wrappers of the shared profiler"""
+    PROFILER.enable()
+
+
+def disable():
+    """removes the wrappers of the shared profiler"""
+    PROFILER.disable()
+
+
+def is_enabled():
+    """returns true while the shared profiler is installed"""
+    return PROFILER.is_enabled()
+
+
+def reset():
+    """clears the counters of the shared profiler"""
+    PROFILER.reset()
+
+
+def stats():
+    """returns the counters of the shared profiler"""
+    return PROFILER.stats()
+
+
+def start_dump(path=None, interval=DEFAULT_DUMP_INTERVAL):
+    """dumps the shared profiler's counters every interval seconds"""
+    PROFILER.start_dump(path, interval)
+
+
+def stop_dump():
+    """stops the periodic dump of the shared profiler"""
+    PROFILER.stop_dump()
+
+
+def main():
+    """command line entry point, profiles self-play games and prints the counters"""
+    parser = argparse.ArgumentParser(description="XiangQi hot path profile")
+    parser.add_argument("--games", type=int, default=5)
+    parser.add_argument("--policy", default=POLICY_RANDOM, help="policy of both players: random, greedy or "
+                                                                "search:depth")
+    parser.add_argument("--max-moves", type=int, default=100)
+    parser.add_argument("--engine", choices=[ENGINE_OBJECTS, ENGINE_BITBOARD], default=ENGINE_OBJECTS)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    enable()
+    start = time.perf_counter()
+    for index in range(arguments.games):
+        play_game(arguments.policy, arguments.policy, arguments.seed + index, arguments.max_moves, arguments.engine)
+    seconds = time.perf_counter() - start
+    disable()
+    print(json.dumps({"games": arguments.games, "seconds": round(seconds, 6), "stats": stats()}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
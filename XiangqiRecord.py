@@ -0,0 +1,262 @@
+# Description: Compact binary game records for the XiangQi game. A record file starts with a 4 byte magic number and
+# holds games back to back, each a fixed header (result, optional start FEN length and move count), the FEN and then
+# one little endian 16 bit integer per move, from square * 90 + to square with squares numbered row * 9 + column.
+# The reader memory maps the file and hands out moves as views of it, so scanning an archive parses nothing.
+# Convert a text archive with: python XiangqiRecord.py encode games.txt games.xqr
+
+import argparse
+import json
+import mmap
+import struct
+import sys
+
+from XiangqiGame import XiangqiGame, ENGINE_BITBOARD, START_FEN, STATUS_UNFINISHED, STATUS_RED_WINS, \
+    STATUS_BLACK_WINS, STATUS_DRAW, COORD_PATTERN, coord_to_string
+
+RECORD_MAGIC = b"XQR1"
+RESULT_UNFINISHED = 0
+RESULT_RED_WINS = 1
+RESULT_BLACK_WINS = 2
+RESULT_DRAW = 3
+RESULT_STATES = {RESULT_UNFINISHED: STATUS_UNFINISHED, RESULT_RED_WINS: STATUS_RED_WINS,
+                 RESULT_BLACK_WINS: STATUS_BLACK_WINS, RESULT_DRAW: STATUS_DRAW}
+# result byte, padding byte, FEN length and move count. The FEN is padded to an even length so the moves that follow
+# stay 2 byte aligned
+GAME_HEADER = struct.Struct("<BxHI")
+MOVE_FORMAT = "<H"
+
+
+def encode_move(starting_string, move_to_string):
+    """returns the 16 bit code of a move between two coordinate strings like 'h3' and 'e3', raising ValueError for
+    coordinates off the board"""
+    return square_index(starting_string) * 90 + square_index(move_to_string)
+
+
+def square_index(coord):
+    """returns the row * 9 + column square of a coordinate string like 'h3'"""
+    coord = coord.strip().lower()
+    match = COORD_PATTERN.fullmatch(coord)
+    if match is None:
+        raise ValueError("invalid coordinate " + coord)
+    return (int(match.group(2)) - 1) * 9 + ord(match.group(1)) - ord("a")
+
+
+def decode_move(code):
+    """returns the (from, to) coordinate strings of a 16 bit move code"""
+    from_square, to_square = divmod(code, 90)
+    return coord_to_string(from_square // 9, from_square % 9), coord_to_string(to_square // 9, to_square % 9)
+
+
+def state_result(game_state):
+    """returns the result code of a game state, unfinished games are recorded as unfinished"""
+    if game_state == STATUS_RED_WINS:
+        return RESULT_RED_WINS
+    elif game_state == STATUS_BLACK_WINS:
+        return RESULT_BLACK_WINS
+    elif game_state == STATUS_DRAW:
+        return RESULT_DRAW
+    return RESULT_UNFINISHED
+
+
+class RecordWriter:
+    """Appends games to a binary record file"""
+
+    def __init__(self, path):
+        """creates or truncates the record file at path and writes the magic number"""
+        self._file = open(path, "wb")
+        self._file.write(RECORD_MAGIC)
+        self._games = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def get_games(self):
+        """returns the number of games written"""
+        return self._games
+
+    def write_game(self, moves, result=RESULT_UNFINISHED, fen=None):
+        """writes a game of 16 bit move codes with its result code and the FEN it started from, None for the
+        starting position"""
+        if fen is None or fen == START_FEN:
+            fen_bytes = b""
+        else:
+            fen_bytes = fen.encode("ascii")
+            if len(fen_bytes) % 2 == 1:
+                fen_bytes += b" "
+        move_bytes = struct.pack("<%dH" % len(moves), *moves)
+        self._file.write(GAME_HEADER.pack(result, len(fen_bytes), len(moves)))
+        self._file.write(fen_bytes)
+        self._file.write(move_bytes)
+        self._games += 1
+
+    def write_strings(self, move_strings, result=RESULT_UNFINISHED, fen=None):
+        """writes a game of move strings like 'h3-e3'"""
+        moves = []
+        for move_string in move_strings:
+            squares = move_string.split("-")
+            if len(squares) != 2:
+                raise ValueError("invalid move " + move_string)
+            moves.append(encode_move(squares[0], squares[1]))
+        self.write_game(moves, result, fen)
+
+    def close(self):
+        """closes the record file"""
+        self._file.close()
+
+
+class GameRecord:
+    """One game of a memory mapped record file, its moves are read straight from the map when asked for"""
+    __slots__ = ("_buffer", "_index", "_result", "_fen", "_moves_offset", "_length")
+
+    def __init__(self, buffer, index, result, fen, moves_offset, length):
+        self._buffer = buffer
+        self._index = index
+        self._result = result
+        self._fen = fen
+        self._moves_offset = moves_offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def get_index(self):
+        """returns the position of the game in its file, counting from 0"""
+        return self._index
+
+    def get_result(self):
+        """returns the result code of the game"""
+        return self._result
+
+    def get_fen(self):
+        """returns the FEN the game started from"""
+        return self._fen
+
+    def get_moves(self):
+        """returns the 16 bit move codes as a read only view of the file, no list is built"""
+        view = memoryview(self._buffer)[self._moves_offset:self._moves_offset + 2 * self._length]
+        if sys.byteorder == "little":
+            return view.cast("H")
+        # big endian machines unpack the moves one at a time instead
+        return (move for move, in struct.iter_unpack(MOVE_FORMAT, view))
+
+    def iter_move_strings(self):
+        """yields the moves as strings like 'h3-e3'"""
+        for move in self.get_moves():
+            from_string, to_string = decode_move(move)
+            yield from_string + "-" + to_string
+
+
+class RecordReader:
+    """Iterates the games of a binary record file through a read only memory map"""
+
+    def __init__(self, path):
+        """opens and maps a record file, raising ValueError if it is not one"""
+        self._file = open(path, "rb")
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped
+            self._file.close()
+            raise ValueError(path + " is not a game record file")
+        if self._buffer[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+            self.close()
+            raise ValueError(path + " is not a game record file")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def __iter__(self):
+        """yields a GameRecord for every game in the file"""
+        buffer = self._buffer
+        offset = len(RECORD_MAGIC)
+        index = 0
+        while offset < len(buffer):
+            if offset + GAME_HEADER.size > len(buffer):
+                raise ValueError("truncated game header at byte " + str(offset))
+            result, fen_length, length = GAME_HEADER.unpack_from(buffer, offset)
+            offset += GAME_HEADER.size
+            fen = START_FEN
+            if fen_length > 0:
+                fen = buffer[offset:offset + fen_length].decode("ascii").strip()
+            moves_offset = offset + fen_length
+            offset = moves_offset + 2 * length
+            if offset > len(buffer):
+                raise ValueError("truncated moves in game " + str(index))
+            yield GameRecord(buffer, index, result, fen, moves_offset, length)
+            index += 1
+
+    def close(self):
+        """unmaps and closes the file, every view returned by GameRecord.get_moves must have been released"""
+        self._buffer.close()
+        self._file.close()
+
+
+def encode_text(text_path, record_path):
+    """converts a text archive, one game of whitespace separated 'h3-e3' moves per line, to a record file. Each
+    game is replayed to find its result, and games with a malformed or illegal move are cut off before it. Returns
+    the number of games written, how many of them were cut off and the line number of the first one as a
+    dictionary"""
+    truncated = 0
+    first_truncated_line = None
+    with open(text_path) as text_file, RecordWriter(record_path) as writer:
+        for line_number, line in enumerate(text_file, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            game = XiangqiGame(engine=ENGINE_BITBOARD, quiet=True)
+            move_strings = line.split()
+            moves = []
+            for move_string in move_strings:
+                squares = move_string.split("-")
+                if len(squares) != 2 or not game.play_move(squares[0], squares[1]).is_ok():
+                    break
+                moves.append(encode_move(squares[0], squares[1]))
+            if len(moves) < len(move_strings):
+                truncated += 1
+                if first_truncated_line is None:
+                    first_truncated_line = line_number
+            writer.write_game(moves, state_result(game.get_game_state()))
+        return {"games": writer.get_games(), "truncated": truncated, "first_truncated_line": first_truncated_line}
+
+
+def record_stats(record_path):
+    """returns the number of games, moves and results of a record file as a dictionary"""
+    games = 0
+    moves = 0
+    results = {RESULT_UNFINISHED: 0, RESULT_RED_WINS: 0, RESULT_BLACK_WINS: 0, RESULT_DRAW: 0}
+    with RecordReader(record_path) as reader:
+        for record in reader:
+            games += 1
+            moves += len(record)
+            results[record.get_result()] = results.get(record.get_result(), 0) + 1
+    return {"games": games, "moves": moves, "unfinished": results[RESULT_UNFINISHED],
+            "red_wins": results[RESULT_RED_WINS], "black_wins": results[RESULT_BLACK_WINS],
+            "draws": results[RESULT_DRAW]}
+
+
+def main():
+    """command line entry point, converts a text archive or prints the statistics of a record file"""
+    parser = argparse.ArgumentParser(description="XiangQi binary game records")
+    commands = parser.add_subparsers(dest="command", required=True)
+    encode_parser = commands.add_parser("encode", help="convert a text archive to a record file")
+    encode_parser.add_argument("text_path")
+    encode_parser.add_argument("record_path")
+    stats_parser = commands.add_parser("stats", help="count the games, moves and results of a record file")
+    stats_parser.add_argument("record_path")
+    arguments = parser.parse_args()
+
+    if arguments.command == "encode":
+        print(json.dumps(encode_text(arguments.text_path, arguments.record_path)))
+    else:
+        print(json.dumps(record_stats(arguments.record_path)))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
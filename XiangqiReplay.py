@@ -0,0 +1,157 @@
+# Description: Bulk replay of archived XiangQi games. Game records are streamed from a text file, one game per line
+# as whitespace separated moves like 'h3-e3', or from a XiangqiRecord binary file, and fanned out across a
+# multiprocessing pool where each worker replays the moves through a quiet XiangqiGame. Results come back in input
+# order while only a bounded window of games is ever in flight.
+# Run with: python XiangqiReplay.py games.txt --workers 8 --output results.jsonl
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from collections import deque
+
+from XiangqiGame import XiangqiGame, ENGINE_OBJECTS, ENGINE_BITBOARD, START_FEN
+from XiangqiRecord import RecordReader, RECORD_MAGIC, decode_move
+
+# games in flight per worker, enough to keep every worker busy without reading the whole file ahead
+WINDOW_PER_WORKER = 16
+
+
+def read_records(path):
+    """yields (line number, list of move strings, None) for every game record in a text file, skipping blank lines
+    and lines starting with #. Binary record files are read with read_binary_records instead"""
+    with open(path, "rb") as record_file:
+        binary = record_file.read(len(RECORD_MAGIC)) == RECORD_MAGIC
+    if binary:
+        yield from read_binary_records(path)
+        return
+    with open(path) as record_file:
+        for line_number, line in enumerate(record_file, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            yield line_number, line.split(), None
+
+
+def read_binary_records(path):
+    """yields (game number, list of 16 bit move codes, start FEN) for every game in a binary record file, games
+    numbered from 1 and the FEN None for the starting position"""
+    with RecordReader(path) as reader:
+        for record in reader:
+            fen = record.get_fen()
+            if fen == START_FEN:
+                fen = None
+            moves = record.get_moves()
+            # the moves are copied out of the map, since they travel to another process
+            move_list = list(moves)
+            del moves
+            yield record.get_index() + 1, move_list, fen
+
+
+def replay_game(moves, engine=ENGINE_BITBOARD, fen=None):
+    """replays a list of move strings or 16 bit move codes from a FEN, the starting position by default, and returns
+    a dictionary with the final game state, the index of the first illegal move or None, the error it raised and the
+    FEN of the final position"""
+    if fen is None:
+        game = XiangqiGame(engine=engine, quiet=True)
+    else:
+        game = XiangqiGame.from_fen(fen, engine, True)
+    illegal_move = None
+    error = None
+    for index, move in enumerate(moves):
+        if isinstance(move, int):
+            squares = decode_move(move)
+        else:
+            squares = move.split("-")
+        if len(squares) != 2:
+            illegal_move = index
+            error = "BAD_MOVE_STRING"
+            break
+        result = game.play_move(squares[0], squares[1])
+        if not result.is_ok():
+            illegal_move = index
+            error = result.get_error()
+            break
+    if illegal_move is None:
+        played = len(moves)
+    else:
+        played = illegal_move
+    return {"state": game.get_game_state(), "moves": played, "illegal_move": illegal_move, "error": error,
+            "fen": game.to_fen()}
+
+
+def replay_record(record, engine=ENGINE_BITBOARD):
+    """worker entry point, replays a (line number, moves, start FEN) record and tags the result with the line
+    number"""
+    line_number, moves, fen = record
+    result = replay_game(moves, engine, fen)
+    result["line"] = line_number
+    return result
+
+
+def replay_records(records, workers=None, engine=ENGINE_BITBOARD, window=None):
+    """yields the replay result of every record in input order. Records are handed to a pool of workers, one per
+    core by default, and at most window games are queued or running at once so memory stays flat however long
+    the input is. With a single worker the games are replayed in this process"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for record in records:
+            yield replay_record(record, engine)
+        return
+    if window is None:
+        window = workers * WINDOW_PER_WORKER
+
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for record in records:
+            pending.append(pool.apply_async(replay_record, (record, engine)))
+            # the oldest game is waited on first, which both keeps the output in order and bounds the window
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def replay_file(path, workers=None, engine=ENGINE_BITBOARD, window=None):
+    """yields the replay result of every game record in a file in input order"""
+    return replay_records(read_records(path), workers, engine, window)
+
+
+def main():
+    """command line entry point, writes one JSON result per game and a summary to stderr"""
+    parser = argparse.ArgumentParser(description="XiangQi bulk game replay")
+    parser.add_argument("path", help="binary record file, or text file of one game of whitespace separated moves "
+                                     "per line")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the core count")
+    parser.add_argument("--window", type=int, default=None, help="games in flight at once")
+    parser.add_argument("--engine", choices=[ENGINE_OBJECTS, ENGINE_BITBOARD], default=ENGINE_BITBOARD)
+    parser.add_argument("--output", help="file to write the JSON lines results to")
+    arguments = parser.parse_args()
+
+    if arguments.output:
+        output_file = open(arguments.output, "w")
+    else:
+        output_file = sys.stdout
+    start = time.perf_counter()
+    games = 0
+    illegal_games = 0
+    try:
+        for result in replay_file(arguments.path, arguments.workers, arguments.engine, arguments.window):
+            games += 1
+            if result["illegal_move"] is not None:
+                illegal_games += 1
+            output_file.write(json.dumps(result) + "\n")
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+    seconds = time.perf_counter() - start
+    summary = {"games": games, "illegal_games": illegal_games, "seconds": round(seconds, 6),
+               "games_per_second": round(games / seconds, 2) if seconds > 0 else None}
+    sys.stderr.write(json.dumps(summary) + "\n")
+    return 0 if illegal_games == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
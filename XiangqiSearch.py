@@ -0,0 +1,314 @@
+# Description: Alpha-beta search for the XiangQi game. Negamax with iterative deepening, a bounded transposition
+# table keyed by the game's Zobrist key, capture quiescence and a material plus piece square evaluation. The search
+# plays and takes back moves on the game itself through move_unit/unmove_unit, so no positions are ever copied
+
+import time
+
+from XiangqiGame import FACTION_RED, PIECE_EMPTY, PIECE_GENERAL, PIECE_GUARD, PIECE_ELEPHANT, PIECE_HORSE, \
+    PIECE_CHARIOT, PIECE_CANNON, PIECE_PAWN, opposing_faction, coord_to_string, piece_code
+
+MATE_SCORE = 100000
+# scores beyond this are mates, their distance from MATE_SCORE is the number of plies to the mate
+MATE_THRESHOLD = MATE_SCORE - 1000
+INFINITE_SCORE = MATE_SCORE + 1
+DEFAULT_DEPTH = 4
+# screened move cache entries a game keeps while it is being searched, iterative deepening revisits the upper plies
+# of the tree on every iteration
+SEARCH_MOVE_CACHE_SIZE = 4096
+
+TABLE_EXACT = 0
+TABLE_LOWER = 1
+TABLE_UPPER = 2
+
+PIECE_VALUES = {PIECE_GENERAL: 0, PIECE_GUARD: 200, PIECE_ELEPHANT: 200, PIECE_HORSE: 400, PIECE_CHARIOT: 900,
+                PIECE_CANNON: 450, PIECE_PAWN: 100}
+
+
+def piece_square_value(piece_type, row, column):
+    """returns the value of a red piece on a square, material plus a small positional bonus"""
+    value = PIECE_VALUES[piece_type]
+    if piece_type == PIECE_PAWN and row >= 5:
+        # pawns gain sideways moves over the river and are worth more the closer they get to the palace
+        value += 80 + 10 * (row - 5)
+        if 3 <= column <= 5:
+            value += 20
+    elif piece_type == PIECE_HORSE:
+        value += 20 - 5 * abs(column - 4) + 5 * min(row, 6)
+    elif piece_type == PIECE_CANNON and column == 4:
+        value += 15
+    elif piece_type == PIECE_CHARIOT:
+        value += 10 - 2 * abs(column - 4)
+    return value
+
+
+def build_piece_square_table():
+    """builds the evaluation table indexed [piece code][row * 9 + column], red values are positive and black values
+    negative, mirrored top to bottom"""
+    table = [None] * 15
+    for piece_type in PIECE_VALUES:
+        table[piece_type] = [piece_square_value(piece_type, square // 9, square % 9) for square in range(90)]
+        table[-piece_type] = [-piece_square_value(piece_type, 9 - square // 9, square % 9) for square in range(90)]
+    table[PIECE_EMPTY] = [0] * 90
+    return table
+
+
+PIECE_SQUARE = build_piece_square_table()
+
+
+def evaluate(game):
+    """returns the static evaluation of a game from red's point of view"""
+    compact_board = game.get_compact_board()
+    score = 0
+    for row in range(10):
+        for column in range(9):
+            score += PIECE_SQUARE[compact_board.get_code(row, column)][row * 9 + column]
+    return score
+
+
+class Searcher:
+    """Searches a XiangqiGame for the best move of the side to move"""
+
+    def __init__(self, game, table_bits=18):
+        """creates a searcher for a game with a transposition table of 2 ** table_bits entries"""
+        self._game = game
+        self._table_mask = (1 << table_bits) - 1
+        self._table = [None] * (1 << table_bits)
+        self._evaluation = 0
+        self._nodes = 0
+        self._deadline = None
+        self._stopped = False
+        self._info = {}
+
+    def get_info(self):
+        """returns details of the last search, the depth reached, score, nodes, time and principal move"""
+        return self._info
+
+    def clear_table(self):
+        """empties the transposition table"""
+        self._table = [None] * len(self._table)
+
+    def best_move(self, time_limit=None, depth=None):
+        """returns the best move for the side to move as a (from, to) pair of coordinate strings, ready for
+        make_move, or None if there is no legal move. The search deepens until depth is reached or time_limit
+        seconds have passed, whichever comes first, and searches to DEFAULT_DEPTH if neither is given"""
+        if time_limit is None and depth is None:
+            depth = DEFAULT_DEPTH
+        game = self._game
+        faction = game.get_turn()
+        start = time.perf_counter()
+        self._deadline = None
+        if time_limit is not None:
+            self._deadline = start + time_limit
+        self._stopped = False
+        self._nodes = 0
+        self._evaluation = evaluate(game)
+        cache_size = game.get_move_cache_size()
+        game.set_move_cache_size(max(cache_size, SEARCH_MOVE_CACHE_SIZE))
+        try:
+            return self.deepen(faction, start, depth)
+        finally:
+            # shrinking the cache back drops all but the latest positions of the search
+            game.set_move_cache_size(cache_size)
+
+    def deepen(self, faction, start, depth):
+        """runs the iterative deepening loop of best_move and returns its move"""
+        game = self._game
+        root_moves = game.get_legal_moves(faction)
+        if len(root_moves) == 0:
+            self._info = {"depth": 0, "score": -MATE_SCORE, "nodes": 0, "seconds": 0, "move": None}
+            return None
+        best_move = root_moves[0]
+        current_depth = 1
+        while depth is None or current_depth <= depth:
+            score, move = self.search_root(faction, current_depth, root_moves, best_move)
+            if self._stopped:
+                break
+            best_move = move
+            self._info = {"depth": current_depth, "score": score, "nodes": self._nodes,
+                          "seconds": round(time.perf_counter() - start, 6), "move": self.move_strings(best_move)}
+            if abs(score) > MATE_THRESHOLD:
+                break
+            if self._deadline is not None and time.perf_counter() >= self._deadline:
+                break
+            current_depth += 1
+        return self.move_strings(best_move)
+
+    def score_move(self, move, depth, alpha=-INFINITE_SCORE):
+        """returns the score of one root move for the side to move, searched depth plies deep including the move
+        itself. A score of alpha or less only bounds the move from above, so root moves can be searched
+        separately, in other processes, against the score of a move already searched"""
+        game = self._game
+        start = time.perf_counter()
+        self._deadline = None
+        self._stopped = False
+        self._nodes = 0
+        self._evaluation = evaluate(game)
+        captured = self.make(move)
+        score = -self.negamax(opposing_faction(game.get_turn()), depth - 1, -INFINITE_SCORE, -alpha, 1)
+        self.unmake(move, captured)
+        self._info = {"depth": depth, "score": score, "nodes": self._nodes,
+                      "seconds": round(time.perf_counter() - start, 6), "move": self.move_strings(move)}
+        return score
+
+    def move_strings(self, move):
+        """returns a (from, to) pair of coordinate strings for a search move"""
+        return coord_to_string(move[0], move[1]), coord_to_string(move[2], move[3])
+
+    def search_root(self, faction, depth, root_moves, first_move):
+        """searches every root move to depth, the previous best move first, and returns (score, best move)"""
+        ordered_moves = [first_move] + [move for move in root_moves if move != first_move]
+        alpha = -INFINITE_SCORE
+        best_move = first_move
+        for move in ordered_moves:
+            captured = self.make(move)
+            score = -self.negamax(opposing_faction(faction), depth - 1, -INFINITE_SCORE, -alpha, 1)
+            self.unmake(move, captured)
+            if self._stopped:
+                break
+            if score > alpha:
+                alpha = score
+                best_move = move
+        return alpha, best_move
+
+    def negamax(self, faction, depth, alpha, beta, ply):
+        """returns the score of the position for faction to move, searched depth plies deep"""
+        if self.out_of_time():
+            return 0
+        if depth <= 0:
+            return self.quiescence(faction, alpha, beta, ply)
+
+        game = self._game
+        key = game.get_zobrist_key()
+        index = key & self._table_mask
+        entry = self._table[index]
+        table_move = None
+        if entry is not None and entry[0] == key:
+            table_move = entry[4]
+            if entry[1] >= depth:
+                score = entry[3]
+                # mate scores are stored relative to the node, not the root
+                if score > MATE_THRESHOLD:
+                    score -= ply
+                elif score < -MATE_THRESHOLD:
+                    score += ply
+                if entry[2] == TABLE_EXACT:
+                    return score
+                elif entry[2] == TABLE_LOWER and score >= beta:
+                    return score
+                elif entry[2] == TABLE_UPPER and score <= alpha:
+                    return score
+
+        moves = game.get_legal_moves(faction)
+        if len(moves) == 0:
+            # checkmate and stalemate both lose in XiangQi
+            return -MATE_SCORE + ply
+        moves = self.order_moves(moves, table_move)
+
+        original_alpha = alpha
+        best_score = -INFINITE_SCORE
+        best_move = None
+        enemy_faction = opposing_faction(faction)
+        for move in moves:
+            captured = self.make(move)
+            score = -self.negamax(enemy_faction, depth - 1, -beta, -alpha, ply + 1)
+            self.unmake(move, captured)
+            if self._stopped:
+                return 0
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if best_score <= original_alpha:
+            flag = TABLE_UPPER
+        elif best_score >= beta:
+            flag = TABLE_LOWER
+        else:
+            flag = TABLE_EXACT
+        stored_score = best_score
+        if stored_score > MATE_THRESHOLD:
+            stored_score += ply
+        elif stored_score < -MATE_THRESHOLD:
+            stored_score -= ply
+        self._table[index] = (key, depth, flag, stored_score, best_move)
+        return best_score
+
+    def quiescence(self, faction, alpha, beta, ply):
+        """searches captures only until the position is quiet, so the evaluation is not taken mid exchange"""
+        if self.out_of_time():
+            return 0
+        stand_pat = self._evaluation
+        if faction != FACTION_RED:
+            stand_pat = -stand_pat
+        if stand_pat >= beta:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+        enemy_faction = opposing_faction(faction)
+        for move in self.order_moves(self._game.get_legal_moves(faction, True), None):
+            captured = self.make(move)
+            score = -self.quiescence(enemy_faction, -beta, -alpha, ply + 1)
+            self.unmake(move, captured)
+            if self._stopped:
+                return 0
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def out_of_time(self):
+        """counts a node and returns true once the search has been stopped by the clock"""
+        self._nodes += 1
+        if self._deadline is not None and not self._stopped and time.perf_counter() >= self._deadline:
+            self._stopped = True
+        return self._stopped
+
+    def order_moves(self, moves, table_move):
+        """orders moves with the transposition table move first, then captures of the most valuable victim by the
+        least valuable attacker"""
+        game_board = self._game.get_board()
+        scored_moves = []
+        for move in moves:
+            if move == table_move:
+                order = 1000000
+            else:
+                victim = game_board[move[2]][move[3]]
+                if victim == "":
+                    order = 0
+                else:
+                    attacker = game_board[move[0]][move[1]]
+                    order = 10 * PIECE_VALUES[abs(piece_code(victim))] - PIECE_VALUES[abs(piece_code(attacker))] \
+                        + 10000
+            scored_moves.append((order, move))
+        scored_moves.sort(key=lambda scored_move: scored_move[0], reverse=True)
+        return [move for order, move in scored_moves]
+
+    def make(self, move):
+        """plays a search move on the game and updates the evaluation, returning the captured unit"""
+        from_row, from_column, to_row, to_column = move
+        unit = self._game.get_board()[from_row][from_column]
+        code = piece_code(unit)
+        captured = self._game.move_unit(unit, to_row, to_column)
+        self._evaluation += PIECE_SQUARE[code][to_row * 9 + to_column] - PIECE_SQUARE[code][from_row * 9 + from_column]
+        if captured != "":
+            self._evaluation -= PIECE_SQUARE[piece_code(captured)][to_row * 9 + to_column]
+        return captured
+
+    def unmake(self, move, captured):
+        """takes back a search move and restores the evaluation"""
+        from_row, from_column, to_row, to_column = move
+        unit = self._game.get_board()[to_row][to_column]
+        code = piece_code(unit)
+        self._game.unmove_unit(unit, from_row, from_column, captured)
+        self._evaluation -= PIECE_SQUARE[code][to_row * 9 + to_column] - PIECE_SQUARE[code][from_row * 9 + from_column]
+        if captured != "":
+            self._evaluation += PIECE_SQUARE[piece_code(captured)][to_row * 9 + to_column]
+
+
+def best_move(game, time_limit=None, depth=None):
+    """returns the best move for the side to move in a game as a (from, to) pair of coordinate strings"""
+    return Searcher(game).best_move(time_limit, depth)
@@ -0,0 +1,212 @@
+# Description: Headless self-play for the XiangQi game. Plays a number of games between two move selection policies,
+# random legal moves, greedy captures or an alpha-beta search to a fixed depth, across worker processes. Every move
+# goes through make_move, so a run doubles as an end to end load test, and the report holds the win and draw counts,
+# games per second and move latencies. Run with: python XiangqiSelfPlay.py random search:2 --games 20 --workers 4
+
+import argparse
+import json
+import multiprocessing
+import random
+import time
+
+from XiangqiGame import XiangqiGame, ENGINE_OBJECTS, ENGINE_BITBOARD, FACTION_RED, FACTION_BLACK, \
+    STATUS_UNFINISHED, STATUS_RED_WINS, STATUS_BLACK_WINS, coord_to_string, piece_code
+from XiangqiSearch import Searcher, PIECE_VALUES
+
+POLICY_RANDOM = 'random'
+POLICY_GREEDY = 'greedy'
+POLICY_SEARCH = 'search'
+# games still running after this many plies are scored as draws
+DEFAULT_MAX_MOVES = 200
+
+
+def parse_policy(policy):
+    """returns (name, depth) for a policy string like 'random', 'greedy' or 'search:3'"""
+    name, separator, depth = policy.partition(":")
+    if name in (POLICY_RANDOM, POLICY_GREEDY) and separator == "":
+        return name, None
+    if name == POLICY_SEARCH:
+        if separator == "":
+            return name, 2
+        if depth.isdigit() and int(depth) > 0:
+            return name, int(depth)
+    raise ValueError("unknown policy: " + policy)
+
+
+class Player:
+    """Chooses the moves of one side of a game with a policy"""
+
+    def __init__(self, policy, game, rng):
+        """creates a player for a policy string, choosing moves in game with the random generator rng"""
+        self._name, self._depth = parse_policy(policy)
+        self._game = game
+        self._rng = rng
+        self._searcher = None
+        if self._name == POLICY_SEARCH:
+            # one searcher per player keeps its transposition table for the whole game
+            self._searcher = Searcher(game)
+
+    def choose_move(self):
+        """returns the chosen move as a (from, to) pair of coordinate strings, or None if there is no legal move"""
+        if self._searcher is not None:
+            return self._searcher.best_move(depth=self._depth)
+        game = self._game
+        moves = game.get_legal_moves(game.get_turn())
+        if len(moves) == 0:
+            return None
+        if self._name == POLICY_GREEDY:
+            game_board = game.get_board()
+            best_value = 0
+            best_moves = []
+            for move in moves:
+                victim = game_board[move[2]][move[3]]
+                value = 0
+                if victim != "":
+                    value = PIECE_VALUES[abs(piece_code(victim))]
+                if value > best_value:
+                    best_value = value
+                    best_moves = [move]
+                elif value == best_value and value > 0:
+                    best_moves.append(move)
+            if len(best_moves) > 0:
+                moves = best_moves
+        move = self._rng.choice(moves)
+        return coord_to_string(move[0], move[1]), coord_to_string(move[2], move[3])
+
+
+def play_game(red_policy, black_policy, seed, max_moves=DEFAULT_MAX_MOVES, engine=ENGINE_OBJECTS):
+    """plays one game between two policies and returns a dictionary with the final state, the winning faction or
+    None for a draw, the number of moves, whether the move cap ended it and the timings of every move"""
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    game = XiangqiGame(engine=engine, quiet=True)
+    players = {FACTION_RED: Player(red_policy, game, rng), FACTION_BLACK: Player(black_policy, game, rng)}
+    think_seconds = []
+    move_seconds = []
+    while game.get_game_state() == STATUS_UNFINISHED and len(move_seconds) < max_moves:
+        think_start = time.perf_counter()
+        move = players[game.get_turn()].choose_move()
+        move_start = time.perf_counter()
+        if move is None:
+            break
+        result = game.play_move(move[0], move[1])
+        move_seconds.append(time.perf_counter() - move_start)
+        think_seconds.append(move_start - think_start)
+        if not result.is_ok():
+            raise RuntimeError("policy chose a rejected move " + "-".join(move) + ": " + result.get_error())
+
+    winner = None
+    if game.get_game_state() == STATUS_RED_WINS:
+        winner = FACTION_RED
+    elif game.get_game_state() == STATUS_BLACK_WINS:
+        winner = FACTION_BLACK
+    return {"red": red_policy, "black": black_policy, "seed": seed, "state": game.get_game_state(),
+            "winner": winner, "moves": len(move_seconds), "capped": game.get_game_state() == STATUS_UNFINISHED,
+            "seconds": time.perf_counter() - start, "move_seconds": move_seconds, "think_seconds": think_seconds}
+
+
+def play_task(task):
+    """worker entry point, plays a game from a (red policy, black policy, seed, max moves, engine) task"""
+    return play_game(*task)
+
+
+def latency_summary(seconds):
+    """returns the count, mean, median, 99th percentile and maximum of a list of timings, in milliseconds"""
+    if len(seconds) == 0:
+        return {"count": 0, "mean_ms": None, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    ordered = sorted(seconds)
+    return {"count": len(ordered), "mean_ms": round(1000 * sum(ordered) / len(ordered), 3),
+            "p50_ms": round(1000 * ordered[len(ordered) // 2], 3),
+            "p99_ms": round(1000 * ordered[min(len(ordered) - 1, len(ordered) * 99 // 100)], 3),
+            "max_ms": round(1000 * ordered[-1], 3)}
+
+
+def run_match(first_policy, second_policy, games, workers=None, max_moves=DEFAULT_MAX_MOVES, engine=ENGINE_OBJECTS,
+              seed=0):
+    """plays games between two policies, swapping colors every game, and returns the match report as a
+    dictionary. Game i is seeded with seed + i so a match can be replayed exactly"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    tasks = []
+    for index in range(games):
+        if index % 2 == 0:
+            tasks.append((first_policy, second_policy, seed + index, max_moves, engine))
+        else:
+            tasks.append((second_policy, first_policy, seed + index, max_moves, engine))
+
+    start = time.perf_counter()
+    if workers <= 1 or games <= 1:
+        results = [play_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(min(workers, games)) as pool:
+            results = pool.map(play_task, tasks, 1)
+    seconds = time.perf_counter() - start
+
+    first_wins = 0
+    second_wins = 0
+    draws = 0
+    red_wins = 0
+    black_wins = 0
+    move_seconds = []
+    think_seconds = []
+    game_reports = []
+    for index, result in enumerate(results):
+        if result["winner"] is None:
+            draws += 1
+        else:
+            if result["winner"] == FACTION_RED:
+                red_wins += 1
+            else:
+                black_wins += 1
+            # the first policy plays red in the even games
+            if (result["winner"] == FACTION_RED) == (index % 2 == 0):
+                first_wins += 1
+            else:
+                second_wins += 1
+        move_seconds.extend(result["move_seconds"])
+        think_seconds.extend(result["think_seconds"])
+        game_reports.append({"red": result["red"], "black": result["black"], "seed": result["seed"],
+                             "state": result["state"], "winner": result["winner"], "moves": result["moves"],
+                             "capped": result["capped"], "seconds": round(result["seconds"], 6)})
+
+    total_moves = len(move_seconds)
+    return {"first": first_policy, "second": second_policy, "games": games, "workers": workers, "engine": engine,
+            "max_moves": max_moves, "first_wins": first_wins, "second_wins": second_wins, "draws": draws,
+            "red_wins": red_wins, "black_wins": black_wins, "seconds": round(seconds, 6),
+            "games_per_second": round(games / seconds, 3) if seconds > 0 else None,
+            "moves_per_second": round(total_moves / seconds, 3) if seconds > 0 else None,
+            "make_move_latency": latency_summary(move_seconds), "think_latency": latency_summary(think_seconds),
+            "results": game_reports}
+
+
+def main():
+    """command line entry point, prints the JSON match report or writes it to --output"""
+    parser = argparse.ArgumentParser(description="XiangQi self-play match")
+    parser.add_argument("first", help="policy of the first player: random, greedy or search:depth")
+    parser.add_argument("second", help="policy of the second player: random, greedy or search:depth")
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the core count")
+    parser.add_argument("--max-moves", type=int, default=DEFAULT_MAX_MOVES, help="plies before a game is drawn")
+    parser.add_argument("--engine", choices=[ENGINE_OBJECTS, ENGINE_BITBOARD], default=ENGINE_OBJECTS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON report to")
+    arguments = parser.parse_args()
+    for policy in (arguments.first, arguments.second):
+        try:
+            parse_policy(policy)
+        except ValueError as error:
+            parser.error(str(error))
+
+    report = run_match(arguments.first, arguments.second, arguments.games, arguments.workers, arguments.max_moves,
+                       arguments.engine, arguments.seed)
+    report_text = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            output_file.write(report_text + "\n")
+    else:
+        print(report_text)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
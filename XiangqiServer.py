@@ -0,0 +1,384 @@
+# Description: Asyncio game server for the XiangQi game. One process hosts many XiangqiGame sessions over TCP with
+# a line based JSON protocol, one request object per line and one response line back. Every session has its own lock
+# so requests for one game are served in order while other games carry on, and the CPU heavy move screening runs on
+# an executor so a slow move never blocks the event loop. A load test client is bundled and reports the move latency
+# percentiles. Run with: python XiangqiServer.py serve --port 9009 or python XiangqiServer.py load --clients 500
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import json
+import random
+import time
+
+from XiangqiGame import XiangqiGame, ENGINE_OBJECTS, ENGINE_BITBOARD, STATUS_UNFINISHED, coord_to_string
+from XiangqiSelfPlay import latency_summary
+import XiangqiProfile
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9009
+DEFAULT_MAX_SESSIONS = 10000
+# move timings kept for the stats request
+LATENCY_WINDOW = 100000
+# longest request line a client may send, a longer one is answered with an error and the connection closed
+REQUEST_LIMIT = 65536
+# seconds the server keeps reading from a client it is disconnecting, see handle_connection
+LINGER_SECONDS = 5.0
+OP_NEW = 'new'
+OP_MOVE = 'move'
+OP_STATE = 'state'
+OP_LEGAL = 'legal'
+OP_CLOSE = 'close'
+OP_STATS = 'stats'
+ERROR_BAD_REQUEST = 'BAD_REQUEST'
+ERROR_NO_GAME = 'NO_GAME'
+ERROR_SERVER_FULL = 'SERVER_FULL'
+
+
+class Session:
+    """One hosted game and the lock that serializes the requests made to it"""
+    __slots__ = ("_game_id", "_game", "_lock", "_moves")
+
+    def __init__(self, game_id, game):
+        self._game_id = game_id
+        self._game = game
+        self._lock = asyncio.Lock()
+        self._moves = 0
+
+    def get_game_id(self):
+        """returns the id clients address the session by"""
+        return self._game_id
+
+    def get_game(self):
+        """returns the XiangqiGame of the session"""
+        return self._game
+
+    def get_lock(self):
+        """returns the asyncio lock held while a request uses the game"""
+        return self._lock
+
+    def get_moves(self):
+        """returns the number of moves made in the session"""
+        return self._moves
+
+    def count_move(self):
+        """counts a move made in the session"""
+        self._moves += 1
+
+    def describe(self):
+        """returns the state of the game as a dictionary"""
+        game = self._game
+        return {"game": self._game_id, "state": game.get_game_state(), "turn": game.get_turn(), "fen": game.to_fen(),
+                "moves": self._moves}
+
+
+def legal_move_strings(game):
+    """returns the legal moves of the side to move in a game as strings like 'h3-e3'"""
+    return [coord_to_string(move[0], move[1]) + "-" + coord_to_string(move[2], move[3])
+            for move in game.get_legal_moves(game.get_turn())]
+
+
+class GameServer:
+    """Hosts XiangqiGame sessions for the clients of an asyncio TCP server"""
+
+    def __init__(self, workers=4, max_sessions=DEFAULT_MAX_SESSIONS):
+        """creates a server whose moves run on a pool of workers threads, or on the event loop itself for 0
+        workers, and that hosts at most max_sessions games"""
+        self._executor = None
+        if workers > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers, "xiangqi-move")
+        self._workers = workers
+        self._max_sessions = max_sessions
+        self._sessions = {}
+        self._game_ids = itertools.count(1)
+        # the writer and handler task of every open connection
+        self._connections = {}
+        self._requests = 0
+        self._moves = 0
+        self._move_seconds = collections.deque(maxlen=LATENCY_WINDOW)
+        self._server = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """starts listening and returns the port, which is picked by the system when port is 0"""
+        self._server = await asyncio.start_server(self.handle_connection, host, port, limit=REQUEST_LIMIT)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        """serves clients until the task is cancelled"""
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        """stops listening, disconnects the clients and shuts the executor down"""
+        if self._server is not None:
+            self._server.close()
+            handlers = []
+            for writer, handler in list(self._connections.items()):
+                writer.close()
+                handlers.append(handler)
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await self._server.wait_closed()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    async def run_blocking(self, function, *args):
+        """runs a CPU heavy call on the executor, or inline when the server has no workers"""
+        if self._executor is None:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def get_stats(self):
+        """returns the session, request and move counts and the move latency summary as a dictionary"""
+        return {"sessions": len(self._sessions), "connections": len(self._connections), "requests": self._requests,
+                "moves": self._moves, "workers": self._workers,
+                "move_latency": latency_summary(list(self._move_seconds))}
+
+    async def handle_connection(self, reader, writer):
+        """serves the requests of one client connection until it disconnects, or sends a line over REQUEST_LIMIT
+        bytes"""
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # readline raises ValueError once a line overruns the stream limit, and the rest of the line
+                    # is still unread, so the connection cannot carry on
+                    self._requests += 1
+                    response = {"ok": False, "error": ERROR_BAD_REQUEST,
+                                "message": "request is longer than " + str(REQUEST_LIMIT) + " bytes"}
+                    writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                    await writer.drain()
+                    await self.linger(reader, writer)
+                    break
+                if not line:
+                    break
+                response = await self.handle_line(line)
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def linger(self, reader, writer):
+        """ends the server's side of a connection and reads whatever the client still sends until it closes too,
+        for up to LINGER_SECONDS. Closing with input left unread would reset the connection, and the client could
+        lose the last response"""
+        if writer.can_write_eof():
+            writer.write_eof()
+        try:
+            await asyncio.wait_for(self.discard(reader), LINGER_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    async def discard(self, reader):
+        """reads and drops the input of a connection until the client closes it"""
+        while await reader.read(REQUEST_LIMIT):
+            pass
+
+    async def handle_line(self, line):
+        """returns the response to one request line, echoing the request's id if it has one"""
+        self._requests += 1
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"ok": False, "error": ERROR_BAD_REQUEST, "message": "request is not JSON"}
+        if not isinstance(request, dict):
+            return {"ok": False, "error": ERROR_BAD_REQUEST, "message": "request is not an object"}
+        try:
+            response = await self.handle_request(request)
+        except (KeyError, TypeError, ValueError) as error:
+            response = {"ok": False, "error": ERROR_BAD_REQUEST, "message": str(error)}
+        if "id" in request:
+            response["id"] = request["id"]
+        return response
+
+    async def handle_request(self, request):
+        """returns the response to a request dictionary, raising KeyError, TypeError or ValueError for a malformed
+        one"""
+        op = request["op"]
+        if op == OP_NEW:
+            return self.new_session(request.get("engine", ENGINE_OBJECTS), request.get("fen"))
+        if op == OP_STATS:
+            response = self.get_stats()
+            response["ok"] = True
+            return response
+        if op not in (OP_MOVE, OP_STATE, OP_LEGAL, OP_CLOSE):
+            raise ValueError("unknown op " + str(op))
+
+        session = self._sessions.get(request["game"])
+        if session is None:
+            return {"ok": False, "error": ERROR_NO_GAME, "message": "no game " + str(request["game"])}
+        start = time.perf_counter()
+        async with session.get_lock():
+            game = session.get_game()
+            if op == OP_MOVE:
+                result = await self.run_blocking(game.play_move, str(request["from"]), str(request["to"]))
+                response = session.describe()
+                response.update({"ok": result.is_ok(), "error": result.get_error(), "check": result.is_check(),
+                                 "checkmate": result.is_checkmate(), "stalemate": result.is_stalemate(),
+                                 "captured": None})
+                if result.get_captured() is not None:
+                    response["captured"] = result.get_captured().get_title()
+                if result.is_ok():
+                    session.count_move()
+                    response["moves"] = session.get_moves()
+                    self._moves += 1
+                # the timing includes the wait for the session lock, which is what the client sees
+                self._move_seconds.append(time.perf_counter() - start)
+                return response
+            if op == OP_LEGAL:
+                response = session.describe()
+                response["ok"] = True
+                response["legal"] = await self.run_blocking(legal_move_strings, game)
+                return response
+            if op == OP_CLOSE:
+                del self._sessions[session.get_game_id()]
+            response = session.describe()
+            response["ok"] = True
+            return response
+
+    def new_session(self, engine, fen):
+        """creates a session for a new game from the starting position or a FEN and returns the response"""
+        if len(self._sessions) >= self._max_sessions:
+            return {"ok": False, "error": ERROR_SERVER_FULL, "message": "the server hosts " +
+                                                                       str(self._max_sessions) + " games"}
+        if engine not in (ENGINE_OBJECTS, ENGINE_BITBOARD):
+            raise ValueError("unknown engine " + str(engine))
+        if fen is None:
+            game = XiangqiGame(engine=engine, quiet=True)
+        else:
+            game = XiangqiGame.from_fen(str(fen), engine, True)
+        session = Session(next(self._game_ids), game)
+        self._sessions[session.get_game_id()] = session
+        response = session.describe()
+        response["ok"] = True
+        return response
+
+
+async def run_client(host, port, moves, engine, seed, move_seconds):
+    """load test client, plays one game of random legal moves over its own connection and appends the round trip
+    time of each move to move_seconds. Returns the number of moves made"""
+    reader, writer = await asyncio.open_connection(host, port)
+    rng = random.Random(seed)
+
+    async def request(message):
+        writer.write(json.dumps(message).encode("utf-8") + b"\n")
+        await writer.drain()
+        return json.loads(await reader.readline())
+
+    response = await request({"op": OP_NEW, "engine": engine})
+    if not response["ok"]:
+        raise RuntimeError("could not start a game: " + response["message"])
+    game_id = response["game"]
+    made = 0
+    while made < moves:
+        legal = (await request({"op": OP_LEGAL, "game": game_id}))["legal"]
+        if len(legal) == 0:
+            break
+        from_string, to_string = rng.choice(legal).split("-")
+        start = time.perf_counter()
+        response = await request({"op": OP_MOVE, "game": game_id, "from": from_string, "to": to_string})
+        move_seconds.append(time.perf_counter() - start)
+        if not response["ok"]:
+            raise RuntimeError("server rejected a legal move: " + str(response["error"]))
+        made += 1
+        if response["state"] != STATUS_UNFINISHED:
+            break
+    await request({"op": OP_CLOSE, "game": game_id})
+    writer.close()
+    await writer.wait_closed()
+    return made
+
+
+async def run_load_test(host, port, clients, moves, engine=ENGINE_OBJECTS, seed=0):
+    """runs clients concurrent load test clients of up to moves moves each against a server and returns the report
+    as a dictionary, with the client side move latency and the server's own stats"""
+    move_seconds = []
+    start = time.perf_counter()
+    made = await asyncio.gather(*[run_client(host, port, moves, engine, seed + index, move_seconds)
+                                  for index in range(clients)])
+    seconds = time.perf_counter() - start
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(json.dumps({"op": OP_STATS}).encode("utf-8") + b"\n")
+    await writer.drain()
+    server_stats = json.loads(await reader.readline())
+    writer.close()
+    await writer.wait_closed()
+    return {"clients": clients, "engine": engine, "moves": sum(made), "seconds": round(seconds, 6),
+            "moves_per_second": round(sum(made) / seconds, 3) if seconds > 0 else None,
+            "move_latency": latency_summary(move_seconds), "server": server_stats}
+
+
+async def load_test_local(clients, moves, engine, workers, seed):
+    """starts a server on a free local port, load tests it and returns the report"""
+    server = GameServer(workers, max(DEFAULT_MAX_SESSIONS, clients))
+    port = await server.start(DEFAULT_HOST, 0)
+    try:
+        return await run_load_test(DEFAULT_HOST, port, clients, moves, engine, seed)
+    finally:
+        await server.stop()
+
+
+async def serve(host, port, workers, max_sessions, profile_interval=None):
+    """runs a server until interrupted, dumping the hot path profile to standard error every profile_interval
+    seconds if one is given"""
+    if profile_interval is not None:
+        XiangqiProfile.enable()
+        XiangqiProfile.start_dump(None, profile_interval)
+    server = GameServer(workers, max_sessions)
+    port = await server.start(host, port)
+    print(json.dumps({"host": host, "port": port, "workers": workers}))
+    try:
+        await server.serve_forever()
+    finally:
+        await server.stop()
+        if profile_interval is not None:
+            XiangqiProfile.stop_dump()
+            XiangqiProfile.disable()
+
+
+def main():
+    """command line entry point, runs a server or a load test"""
+    parser = argparse.ArgumentParser(description="XiangQi asyncio game server")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="host games until interrupted")
+    serve_parser.add_argument("--host", default=DEFAULT_HOST)
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--workers", type=int, default=4, help="move threads, 0 runs moves on the event loop")
+    serve_parser.add_argument("--max-sessions", type=int, default=DEFAULT_MAX_SESSIONS)
+    serve_parser.add_argument("--profile", type=float, default=None, metavar="SECONDS",
+                              help="profile the move hot paths, dumping the counters every SECONDS")
+    load_parser = commands.add_parser("load", help="load test a server, one started here unless --port is given")
+    load_parser.add_argument("--host", default=DEFAULT_HOST)
+    load_parser.add_argument("--port", type=int, default=None)
+    load_parser.add_argument("--clients", type=int, default=100, help="concurrent clients, one game each")
+    load_parser.add_argument("--moves", type=int, default=40, help="moves each client plays")
+    load_parser.add_argument("--engine", choices=[ENGINE_OBJECTS, ENGINE_BITBOARD], default=ENGINE_OBJECTS)
+    load_parser.add_argument("--workers", type=int, default=4, help="move threads of the local server")
+    load_parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    if arguments.command == "serve":
+        try:
+            asyncio.run(serve(arguments.host, arguments.port, arguments.workers, arguments.max_sessions,
+                              arguments.profile))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    if arguments.port is None:
+        report = asyncio.run(load_test_local(arguments.clients, arguments.moves, arguments.engine,
+                                             arguments.workers, arguments.seed))
+    else:
+        report = asyncio.run(run_load_test(arguments.host, arguments.port, arguments.clients, arguments.moves,
+                                           arguments.engine, arguments.seed))
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,568 @@
+# Description: Retrograde endgame tablebases for the XiangQi game. A material set such as KRkaa (red general and
+# chariot against black general and two guards) is enumerated over every placement its pieces can reach, with the
+# move rules of the bitboard engine. Move generation runs on a process pool, then results are propagated backwards
+# from the mates into win, draw or loss and the distance to mate in plies. Subsets reached by a capture are solved
+# first. Tables are written as packed 2 bit results followed by a byte of distance per position, and probing one
+# is a single index computation. Run with: python XiangqiTablebase.py generate KRkaa --directory tables --workers 4
+
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import struct
+from array import array
+
+from XiangqiGame import XiangqiGame, FACTION_RED, FACTION_BLACK, PIECE_EMPTY, PIECE_GENERAL, PIECE_GUARD, \
+    PIECE_ELEPHANT, PIECE_PAWN, FEN_LETTERS, FEN_CODES, GENERAL_MOVES, GUARD_MOVES, ELEPHANT_MOVES, PAWN_MOVES, \
+    opposing_faction, coord_to_string
+from XiangqiBitboard import BitboardPosition
+
+TABLEBASE_MAGIC = b"XQT1"
+# magic number, material name padded with spaces and the number of positions
+TABLE_HEADER = struct.Struct("<4s16sI")
+TABLE_EXTENSION = ".xqt"
+RESULT_WIN = 'WIN'
+RESULT_DRAW = 'DRAW'
+RESULT_LOSS = 'LOSS'
+# the 2 bit result codes of the packed section
+RESULT_CODES = {0: RESULT_DRAW, 1: RESULT_WIN, 2: RESULT_LOSS}
+CODE_INVALID = 3
+# distance bytes hold plies to mate + 1, so 0 is a draw and 1 is the side to move mated. An odd distance is a loss for
+# the side to move and an even distance a win
+DISTANCE_DRAW = 0
+DISTANCE_INVALID = 255
+MAX_DISTANCE = 253
+# positions per worker task
+CHUNK_SIZE = 4096
+# pieces that can stand on any square, the others are confined to the squares their move table reaches
+MOVE_TABLES = {PIECE_GENERAL: GENERAL_MOVES, PIECE_GUARD: GUARD_MOVES, PIECE_ELEPHANT: ELEPHANT_MOVES,
+               PIECE_PAWN: PAWN_MOVES}
+
+
+def parse_material(material):
+    """returns the signed piece codes of a material string like 'KRkaa', red letters upper case and black lower
+    case, in canonical order: red general, red pieces by code, black general, black pieces by code. Raises
+    ValueError if the string is not a material set with one general a side"""
+    codes = []
+    for letter in material.replace("-", ""):
+        if letter.lower() not in FEN_CODES:
+            raise ValueError("invalid piece " + letter + " in material " + material)
+        code = FEN_CODES[letter.lower()]
+        if letter.islower():
+            code = -code
+        codes.append(code)
+    if codes.count(PIECE_GENERAL) != 1 or codes.count(-PIECE_GENERAL) != 1:
+        raise ValueError("material " + material + " needs exactly one general a side")
+    return tuple(sorted(codes, key=lambda code: (code < 0, abs(code))))
+
+
+def material_name(codes):
+    """returns the canonical material string of a tuple of piece codes"""
+    name = ""
+    for code in codes:
+        if code > 0:
+            name += FEN_LETTERS[code].upper()
+        else:
+            name += FEN_LETTERS[-code]
+    return name
+
+
+def board_material(compact_board):
+    """returns the canonical material string of the pieces on a CompactBoard"""
+    codes = []
+    for row in range(10):
+        for column in range(9):
+            code = compact_board.get_code(row, column)
+            if code != PIECE_EMPTY:
+                codes.append(code)
+    return material_name(sorted(codes, key=lambda code: (code < 0, abs(code))))
+
+
+def piece_domain(code):
+    """returns the sorted squares a piece can ever stand on, every square for horses, chariots and cannons and
+    otherwise the squares its move table reaches from its starting squares"""
+    piece_type = abs(code)
+    if piece_type not in MOVE_TABLES:
+        return tuple(range(90))
+    faction = FACTION_RED if code > 0 else FACTION_BLACK
+    compact_board = XiangqiGame(quiet=True).get_compact_board()
+    reached = set(square for square in range(90) if compact_board.get_code(square // 9, square % 9) == code)
+    frontier = list(reached)
+    while frontier:
+        square = frontier.pop()
+        for row, column, block_row, block_column in MOVE_TABLES[piece_type][faction][square]:
+            if row * 9 + column not in reached:
+                reached.add(row * 9 + column)
+                frontier.append(row * 9 + column)
+    return tuple(sorted(reached))
+
+
+class TableLayout:
+    """Numbers the positions of a material set, a mixed radix over each piece's domain with the side to move as
+    the lowest digit"""
+
+    def __init__(self, codes):
+        """creates the layout of a canonical tuple of piece codes"""
+        self._codes = codes
+        self._domains = [piece_domain(code) for code in codes]
+        self._domain_indices = [dict((square, index) for index, square in enumerate(domain))
+                                for domain in self._domains]
+        self._size = 2
+        for domain in self._domains:
+            self._size *= len(domain)
+
+    def get_codes(self):
+        """returns the piece codes, in the order of the squares of encode and decode"""
+        return self._codes
+
+    def get_size(self):
+        """returns the number of positions, legal or not"""
+        return self._size
+
+    def encode(self, squares, side):
+        """returns the index of the position with each piece on its square and side 0 (red) or 1 (black) to move,
+        or None if a piece is outside its domain"""
+        index = 0
+        for square, domain, domain_index in zip(squares, self._domains, self._domain_indices):
+            position = domain_index.get(square)
+            if position is None:
+                return None
+            index = index * len(domain) + position
+        return index * 2 + side
+
+    def decode(self, index):
+        """returns the (squares, side) of a position index"""
+        side = index % 2
+        index //= 2
+        squares = []
+        for domain in reversed(self._domains):
+            index, position = divmod(index, len(domain))
+            squares.append(domain[position])
+        squares.reverse()
+        return squares, side
+
+
+LAYOUTS = {}
+
+
+def get_layout(name):
+    """returns the TableLayout of a canonical material string, built once per process"""
+    layout = LAYOUTS.get(name)
+    if layout is None:
+        layout = LAYOUTS[name] = TableLayout(parse_material(name))
+    return layout
+
+
+def capture_names(name):
+    """returns the materials a capture can reach from a material set, without repeats. generate_chunk numbers them
+    by their position in the list"""
+    codes = get_layout(name).get_codes()
+    names = []
+    for slot, code in enumerate(codes):
+        if abs(code) != PIECE_GENERAL:
+            sub_name = material_name(codes[:slot] + codes[slot + 1:])
+            if sub_name not in names:
+                names.append(sub_name)
+    return names
+
+
+def generate_chunk(task):
+    """worker entry point, generates the legal moves of positions start to stop of a material set. Returns (start,
+    move counts, quiet counts, successors, capture indices, capture materials, capture targets) where the move count
+    is DISTANCE_INVALID for an illegal position and successors lists the positions reached by the quiet counts non
+    capture moves of each position in turn. Every capture is a position index, the capture_names number of the
+    material it reaches and the index it reaches there, all held in typed arrays"""
+    name, start, stop = task
+    layout = get_layout(name)
+    codes = layout.get_codes()
+    sub_numbers = dict((sub_name, number) for number, sub_name in enumerate(capture_names(name)))
+    move_counts = bytearray()
+    quiet_counts = bytearray()
+    successors = array('I')
+    capture_indices = array('I')
+    capture_materials = array('B')
+    capture_targets = array('I')
+    for index in range(start, stop):
+        squares, side = layout.decode(index)
+        move_count = DISTANCE_INVALID
+        quiet_count = 0
+        if len(set(squares)) == len(squares):
+            position = BitboardPosition()
+            for code, square in zip(codes, squares):
+                position.put_piece(square, code)
+            faction = FACTION_RED if side == 0 else FACTION_BLACK
+            # the side that just moved can never have left its general attacked
+            if not position.in_check(opposing_faction(faction)):
+                moves = position.generate_legal_moves(faction)
+                move_count = len(moves)
+                for move in moves:
+                    from_square, to_square = divmod(move, 90)
+                    new_squares = list(squares)
+                    new_squares[squares.index(from_square)] = to_square
+                    if to_square in squares:
+                        captured_slot = squares.index(to_square)
+                        del new_squares[captured_slot]
+                        sub_name = material_name(codes[:captured_slot] + codes[captured_slot + 1:])
+                        capture_indices.append(index)
+                        capture_materials.append(sub_numbers[sub_name])
+                        capture_targets.append(get_layout(sub_name).encode(new_squares, 1 - side))
+                    else:
+                        successors.append(layout.encode(new_squares, 1 - side))
+                        quiet_count += 1
+        move_counts.append(move_count)
+        quiet_counts.append(quiet_count)
+    return start, move_counts, quiet_counts, successors, capture_indices, capture_materials, capture_targets
+
+
+class TableSolver:
+    """Solves one material set from its generate_chunk results. Chunks are merged as they arrive, so the solver holds
+    the table's quiet moves and a few bytes per position but never every chunk at once, and captures are scored
+    against the solved subsets straight away"""
+
+    def __init__(self, name, solved):
+        """creates the solver of a material set. solved maps the material of every subset reached by a capture to
+        its distances"""
+        self._name = name
+        self._solved = solved
+        self._sub_names = capture_names(name)
+        size = get_layout(name).get_size()
+        self._size = size
+        self._distances = bytearray(size)
+        # moves not yet known to lose, and the longest loss among those that are
+        self._moves_left = bytearray(size)
+        self._loss_depths = bytearray(size)
+        self._quiet_counts = bytearray(size)
+        self._successors = array('I')
+        self._buckets = []
+
+    def queue(self, depth, index):
+        """adds a position to the bucket of the depth it would be decided at, so the first decision is the
+        shortest"""
+        if depth >= MAX_DISTANCE:
+            raise ValueError("distance to mate in " + self._name + " does not fit in a byte")
+        while len(self._buckets) <= depth:
+            self._buckets.append([])
+        self._buckets[depth].append(index)
+
+    def add_chunk(self, chunk):
+        """merges one generate_chunk result, chunks are added in order"""
+        start, move_counts, quiet_counts, successors, capture_indices, capture_materials, capture_targets = chunk
+        distances = self._distances
+        moves_left = self._moves_left
+        loss_depths = self._loss_depths
+        self._quiet_counts[start:start + len(quiet_counts)] = quiet_counts
+        self._successors.extend(successors)
+        for position, move_count in enumerate(move_counts):
+            if move_count == DISTANCE_INVALID:
+                distances[start + position] = DISTANCE_INVALID
+            else:
+                moves_left[start + position] = move_count
+        sub_distances = [self._solved[sub_name] for sub_name in self._sub_names]
+        for index, material, sub_index in zip(capture_indices, capture_materials, capture_targets):
+            distance = sub_distances[material][sub_index]
+            if distance == DISTANCE_DRAW:
+                continue
+            plies = distance - 1
+            if plies % 2 == 0:
+                # the capture leaves the opponent lost
+                self.queue(plies + 1, index)
+            else:
+                moves_left[index] -= 1
+                loss_depths[index] = max(loss_depths[index], plies + 1)
+
+    def solve(self):
+        """propagates the results backwards from the mates once every chunk is added and returns the distance of
+        every position as a bytearray"""
+        size = self._size
+        distances = self._distances
+        moves_left = self._moves_left
+        loss_depths = self._loss_depths
+        buckets = self._buckets
+
+        # the quiet moves form a graph inside the table, it is turned around so every position lists its
+        # predecessors
+        successors = self._successors
+        predecessor_starts = array('I', [0]) * (size + 1)
+        for successor in successors:
+            predecessor_starts[successor + 1] += 1
+        for index in range(size):
+            predecessor_starts[index + 1] += predecessor_starts[index]
+        fill = array('I', predecessor_starts[:size])
+        predecessors = array('I', [0]) * len(successors)
+        successor = 0
+        for index, quiet_count in enumerate(self._quiet_counts):
+            for move in range(quiet_count):
+                target = successors[successor]
+                predecessors[fill[target]] = index
+                fill[target] += 1
+                successor += 1
+        del fill, successors
+        self._successors = None
+        self._quiet_counts = None
+
+        for index in range(size):
+            if distances[index] != DISTANCE_INVALID and moves_left[index] == 0:
+                # no legal move, or every capture loses. Stalemate loses in XiangQi just as checkmate does
+                self.queue(loss_depths[index], index)
+
+        depth = 0
+        while depth < len(buckets):
+            for index in buckets[depth]:
+                if distances[index] != DISTANCE_DRAW:
+                    continue
+                distances[index] = depth + 1
+                for predecessor in predecessors[predecessor_starts[index]:predecessor_starts[index + 1]]:
+                    if distances[predecessor] != DISTANCE_DRAW:
+                        continue
+                    if depth % 2 == 0:
+                        self.queue(depth + 1, predecessor)
+                    else:
+                        moves_left[predecessor] -= 1
+                        if loss_depths[predecessor] < depth + 1:
+                            loss_depths[predecessor] = depth + 1
+                        if moves_left[predecessor] == 0:
+                            self.queue(loss_depths[predecessor], predecessor)
+            buckets[depth] = None
+            depth += 1
+        return distances
+
+
+def pack_results(distances):
+    """returns the 2 bit result codes of a table's distances, four positions to a byte"""
+    packed = bytearray((len(distances) + 3) // 4)
+    for index, distance in enumerate(distances):
+        if distance == DISTANCE_INVALID:
+            code = CODE_INVALID
+        elif distance == DISTANCE_DRAW:
+            code = 0
+        elif (distance - 1) % 2 == 1:
+            code = 1
+        else:
+            code = 2
+        packed[index >> 2] |= code << ((index & 3) * 2)
+    return packed
+
+
+def table_path(directory, name):
+    """returns the path of a material set's table file"""
+    return os.path.join(directory, name + TABLE_EXTENSION)
+
+
+def write_table(path, name, distances):
+    """writes a table file, the header, the packed results and then the distances"""
+    with open(path, "wb") as table_file:
+        table_file.write(TABLE_HEADER.pack(TABLEBASE_MAGIC, name.encode("ascii").ljust(16), len(distances)))
+        table_file.write(pack_results(distances))
+        table_file.write(distances)
+
+
+def read_distances(path):
+    """returns the distances section of a table file as a bytearray"""
+    with open(path, "rb") as table_file:
+        magic, name, size = TABLE_HEADER.unpack(table_file.read(TABLE_HEADER.size))
+        if magic != TABLEBASE_MAGIC:
+            raise ValueError(path + " is not a tablebase")
+        table_file.seek(TABLE_HEADER.size + (size + 3) // 4)
+        return bytearray(table_file.read(size))
+
+
+def generate(material, directory, workers=None, solved=None):
+    """generates the table of a material set and of every subset a capture can reach, writing each to directory
+    unless it is already there. Returns a dictionary mapping material names to their distances"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if solved is None:
+        solved = {}
+    codes = parse_material(material)
+    name = material_name(codes)
+    if name in solved:
+        return solved
+    path = table_path(directory, name)
+    if os.path.exists(path):
+        solved[name] = read_distances(path)
+        return solved
+    for slot, code in enumerate(codes):
+        if abs(code) != PIECE_GENERAL:
+            generate(material_name(codes[:slot] + codes[slot + 1:]), directory, workers, solved)
+
+    size = get_layout(name).get_size()
+    tasks = [(name, start, min(start + CHUNK_SIZE, size)) for start in range(0, size, CHUNK_SIZE)]
+    solver = TableSolver(name, solved)
+    if workers <= 1:
+        for task in tasks:
+            solver.add_chunk(generate_chunk(task))
+    else:
+        # chunks are merged as they come back, and the pool is shut down before the solve
+        with multiprocessing.Pool(workers) as pool:
+            for chunk in pool.imap(generate_chunk, tasks):
+                solver.add_chunk(chunk)
+    distances = solver.solve()
+    os.makedirs(directory, exist_ok=True)
+    write_table(path, name, distances)
+    solved[name] = distances
+    return solved
+
+
+class Tablebase:
+    """One table file opened for probing through a read only memory map"""
+
+    def __init__(self, path):
+        """opens and maps a table file, raising ValueError if it is not one"""
+        self._file = open(path, "rb")
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped
+            self._file.close()
+            raise ValueError(path + " is not a tablebase")
+        if len(self._buffer) < TABLE_HEADER.size:
+            self.close()
+            raise ValueError(path + " is not a tablebase")
+        magic, name, size = TABLE_HEADER.unpack_from(self._buffer)
+        if magic != TABLEBASE_MAGIC or len(self._buffer) != TABLE_HEADER.size + (size + 3) // 4 + size:
+            self.close()
+            raise ValueError(path + " is not a tablebase")
+        try:
+            self._name = name.decode("ascii").strip()
+            self._layout = get_layout(self._name)
+        except ValueError:
+            self.close()
+            raise ValueError(path + " is not a tablebase")
+        self._distances_offset = TABLE_HEADER.size + (size + 3) // 4
+
+    def get_material(self):
+        """returns the canonical material string of the table"""
+        return self._name
+
+    def position_index(self, compact_board, faction):
+        """returns the index of a position with faction to move, or None if it is not one of the table's"""
+        squares_by_code = {}
+        for row in range(10):
+            for column in range(9):
+                code = compact_board.get_code(row, column)
+                if code != PIECE_EMPTY:
+                    squares_by_code.setdefault(code, []).append(row * 9 + column)
+        squares = []
+        for code in self._layout.get_codes():
+            code_squares = squares_by_code.get(code)
+            if not code_squares:
+                return None
+            squares.append(code_squares.pop())
+        if any(squares_by_code.values()):
+            return None
+        return self._layout.encode(squares, 0 if faction == FACTION_RED else 1)
+
+    def probe_index(self, index):
+        """returns the (result, plies to mate) of a position index, plies being None for a draw, or None for an
+        illegal position"""
+        code = (self._buffer[TABLE_HEADER.size + (index >> 2)] >> ((index & 3) * 2)) & 3
+        if code == CODE_INVALID:
+            return None
+        if code == 0:
+            return RESULT_DRAW, None
+        return RESULT_CODES[code], self._buffer[self._distances_offset + index] - 1
+
+    def probe(self, game, faction=None):
+        """returns the (result, plies to mate) of a game for faction to move, the side to move by default, or None
+        if the position is not in the table"""
+        if faction is None:
+            faction = game.get_turn()
+        index = self.position_index(game.get_compact_board(), faction)
+        if index is None:
+            return None
+        return self.probe_index(index)
+
+    def close(self):
+        """unmaps and closes the table file"""
+        self._buffer.close()
+        self._file.close()
+
+
+class TablebaseSet:
+    """Every table file of a directory, probed by the material of the position"""
+
+    def __init__(self, directory):
+        """opens every table in directory"""
+        self._tables = {}
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(TABLE_EXTENSION):
+                table = Tablebase(os.path.join(directory, file_name))
+                self._tables[table.get_material()] = table
+
+    def get_materials(self):
+        """returns the material strings of the open tables"""
+        return sorted(self._tables)
+
+    def probe(self, game, faction=None):
+        """returns the (result, plies to mate) of a game for faction to move, the side to move by default, or None
+        if no table holds the position"""
+        table = self._tables.get(board_material(game.get_compact_board()))
+        if table is None:
+            return None
+        return table.probe(game, faction)
+
+    def best_move(self, game):
+        """returns the move of the side to move that keeps the best result as a (from, to) pair of coordinate
+        strings, the fastest mate when winning and the slowest when losing, or None if the position is not in the
+        tables or has no legal move"""
+        faction = game.get_turn()
+        if self.probe(game, faction) is None:
+            return None
+        best_move = None
+        best_order = None
+        game_board = game.get_board()
+        for from_row, from_column, to_row, to_column in game.get_legal_moves(faction):
+            unit = game_board[from_row][from_column]
+            captured = game.move_unit(unit, to_row, to_column)
+            result = self.probe(game, opposing_faction(faction))
+            game.unmove_unit(unit, from_row, from_column, captured)
+            if result is None:
+                continue
+            # the result is the opponent's, so their loss is best, the quickest first, and their win worst
+            if result[0] == RESULT_LOSS:
+                order = (2, -result[1])
+            elif result[0] == RESULT_DRAW:
+                order = (1, 0)
+            else:
+                order = (0, result[1])
+            if best_order is None or order > best_order:
+                best_order = order
+                best_move = (coord_to_string(from_row, from_column), coord_to_string(to_row, to_column))
+        return best_move
+
+    def close(self):
+        """closes every table"""
+        for table in self._tables.values():
+            table.close()
+
+
+def main():
+    """command line entry point, generates tables or probes a position"""
+    parser = argparse.ArgumentParser(description="XiangQi endgame tablebases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate_parser = commands.add_parser("generate", help="generate the table of a material set and its subsets")
+    generate_parser.add_argument("material", help="pieces like KRkaa, red upper case and black lower case")
+    generate_parser.add_argument("--directory", default="tables")
+    generate_parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the "
+                                                                           "core count")
+    probe_parser = commands.add_parser("probe", help="probe a position")
+    probe_parser.add_argument("fen")
+    probe_parser.add_argument("--directory", default="tables")
+    arguments = parser.parse_args()
+
+    if arguments.command == "generate":
+        solved = generate(arguments.material, arguments.directory, arguments.workers)
+        print(json.dumps(dict((name, len(distances)) for name, distances in sorted(solved.items()))))
+    else:
+        tablebases = TablebaseSet(arguments.directory)
+        game = XiangqiGame.from_fen(arguments.fen, quiet=True)
+        result = tablebases.probe(game)
+        print(json.dumps({"result": result and result[0], "plies": result and result[1],
+                          "move": tablebases.best_move(game)}))
+        tablebases.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())